@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Command line utility for automatically processing new raw datasets on the ToTS archive drive"""
+
+import argparse
+import os
+import pathlib
+import shlex
+import subprocess
+import sys
+
+from . import scheduler
+
+_scripts_dir = pathlib.Path(__file__).resolve().parent
+
+def main():
+    """Process raw datasets which don't have results archives yet, as they appear."""
+    parser = argparse.ArgumentParser(
+        prog='tots-autoprocess',
+        description=(
+            'Process raw ToTS PlanktoScope datasets which don\'t have results archives yet, across '
+            'one or more processing directories, picking up new datasets as they\'re added'
+        ),
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        default=False,
+        help='Print additional information for troubleshooting',
+    )
+    parser.add_argument(
+        'archives_root',
+        type=str,
+        help='Directory of raw dataset archives (e.g. tots-ps-acq-588.tar.gz) and results archives',
+    )
+    parser.add_argument(
+        'adjustment',
+        type=str,
+        help='Brightness adjustment (e.g. 5%%) to apply to the raw frames before processing',
+    )
+    parser.add_argument(
+        '-p', '--processing-dir',
+        type=str,
+        action='append',
+        default=None,
+        help=(
+            'Processing directory (e.g. /home/pi/data) to process datasets in; repeat this option '
+            'to process multiple datasets at once, one in each processing directory'
+        ),
+    )
+    parser.add_argument(
+        '--command',
+        type=str,
+        default=shlex.quote(os.fspath(_scripts_dir / 'tots-process-remotely.sh')),
+        help=(
+            'Command to process each dataset, which is run with the archives root, the processing '
+            'directory, the acquisition ID, and the brightness adjustment as arguments'
+        ),
+    )
+    parser.add_argument(
+        '--clean-command',
+        type=str,
+        default='sudo ' + shlex.quote(os.fspath(_scripts_dir / 'tots-clean.sh')),
+        help=(
+            'Command to clean up each processing directory before starting, which is run with the '
+            'processing directory as an argument; use an empty string to skip cleaning up'
+        ),
+    )
+    parser.add_argument(
+        '--rescan-interval',
+        type=float,
+        default=None,
+        help=(
+            'Seconds between full rescans of the archives root (by default, 60 if changes to it '
+            'can\'t be watched, and 900 otherwise)'
+        ),
+    )
+    parser.add_argument(
+        '--settle-time',
+        type=float,
+        default=30,
+        help=(
+            'Seconds for which a raw dataset archive found by a rescan must be left unmodified '
+            'before it\'s processed, in case it\'s still being copied'
+        ),
+    )
+    parser.add_argument(
+        '--claim-timeout',
+        type=float,
+        default=15 * 60,
+        help=(
+            'Seconds after which a claim on a dataset by a process on another host is considered '
+            'abandoned, if that process stops refreshing it'
+        ),
+    )
+    parser.add_argument(
+        '--exit-when-idle',
+        action='store_true',
+        default=False,
+        help='Exit once no datasets are left to process, instead of waiting for new datasets',
+    )
+    args = parser.parse_args()
+    processing_dirs = args.processing_dir or ['/home/pi/data']
+    if len(set(processing_dirs)) != len(processing_dirs):
+        parser.error('Each processing directory can only be specified once')
+    if args.clean_command:
+        for processing_dir in processing_dirs:
+            print(f'Cleaning up {processing_dir}...')
+            subprocess.run([*shlex.split(args.clean_command), processing_dir], check=True)
+    datasets_scheduler = scheduler.Scheduler(
+        args.archives_root, processing_dirs, shlex.split(args.command), args.adjustment,
+        rescan_interval=args.rescan_interval, settle_time=args.settle_time,
+        claim_timeout=args.claim_timeout, exit_when_idle=args.exit_when_idle,
+        verbose=args.verbose,
+    )
+    results = datasets_scheduler.run()
+    print(
+        f'Processed {len(results["done"])} datasets; {len(results["failed"])} failed',
+    )
+    if results['failed']:
+        print('Failed datasets:')
+        for dataset in results['failed']:
+            print(f'  - {dataset}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Notification of changes to the files in a directory, via the Linux inotify API
+
+Python's standard library doesn't expose inotify, so the C library's inotify functions are used
+through ctypes instead. If they can't be loaded (e.g. on other operating systems), watchers can't
+be made, and callers should fall back to periodically rescanning directories.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+# inotify bindings
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+
+_event_header = struct.Struct('iIII') # wd, mask, cookie, len (followed by len bytes of name)
+_read_size = 64 * 1024 # bytes; this fits hundreds of events
+
+_libc = None
+
+def _load_libc():
+    """Load the inotify functions of the C library, raising an OSError if they're unavailable."""
+    global _libc
+    if _libc is not None:
+        return _libc
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.restype = ctypes.c_int
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.restype = ctypes.c_int
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    except (OSError, AttributeError) as e:
+        raise OSError('Couldn\'t load the inotify functions of the C library') from e
+    _libc = libc
+    return _libc
+
+def available():
+    """Check whether directories can be watched, i.e. whether inotify can be loaded via ctypes."""
+    try:
+        _load_libc()
+    except OSError:
+        return False
+    return True
+
+class Watcher:
+    """A watch on the entries of a directory.
+
+    Raises an OSError if the directory can't be watched. Watchers should be closed when they're no
+    longer needed, e.g. by using them as context managers.
+    """
+
+    def __init__(
+        self, directory,
+        mask=IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE,
+    ):
+        libc = _load_libc()
+        self._fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        mask |= IN_ONLYDIR | IN_DELETE_SELF | IN_MOVE_SELF
+        if libc.inotify_add_watch(self._fd, os.fsencode(directory), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, os.strerror(error), os.fspath(directory))
+
+    def fileno(self):
+        """Return the file descriptor of the watch, e.g. for select."""
+        return self._fd
+
+    def read(self, timeout=None):
+        """Wait up to the timeout (in seconds, or forever if None) for changes to the directory.
+
+        Returns a list of (mask, name) pairs for the changes, which is empty if the timeout elapsed
+        first. Events which aren't about an entry of the directory have an empty name; an event
+        with the IN_Q_OVERFLOW bit of its mask set means that some events were lost, and an event
+        with the IN_IGNORED bit set means that the directory is no longer watched (e.g. because it
+        was deleted or its filesystem was unmounted).
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buffer = os.read(self._fd, _read_size)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + _event_header.size <= len(buffer):
+            _, mask, _, name_size = _event_header.unpack_from(buffer, offset)
+            offset += _event_header.size
+            name = buffer[offset:offset + name_size].rstrip(b'\0')
+            offset += name_size
+            events.append((mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        """Stop watching the directory."""
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
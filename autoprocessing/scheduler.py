@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+"""Scheduling of the processing of raw PlanktoScope datasets on the archive drive"""
+
+import json
+import os
+import pathlib
+import socket
+import subprocess
+import threading
+import time
+
+from ecotaxa.catalog import store as catalog_store
+from . import inotify
+
+claims_dir_name = '.tots-claims'
+
+# Index of datasets
+
+class DatasetIndex:
+    """The raw and results archives of datasets in the archives root, updated incrementally.
+
+    A full rescan of the archives root lists all archives, while individual updates (e.g. from
+    change notifications) add or remove single archives without listing the directory. Raw
+    archives found by a rescan are only considered ready to process once they haven't been modified
+    for the settle time, since they may still be being copied onto the drive; raw archives reported
+    by a notification that they were closed after writing (or moved into place) are ready at once.
+    """
+
+    def __init__(self, archives_root, settle_time=30):
+        self.archives_root = pathlib.Path(archives_root)
+        self.settle_time = settle_time
+        self.raw = {} # dataset -> time after which its raw archive is ready to process
+        self.results = set()
+
+    def rescan(self):
+        """List the archives root to rebuild the index from scratch."""
+        raw = {}
+        results = set()
+        now = time.time()
+        with os.scandir(self.archives_root) as entries:
+            for entry in entries:
+                parsed = catalog_store.parse_archive_name(entry.name)
+                if parsed is None:
+                    continue
+                dataset, is_results = parsed
+                if is_results:
+                    results.add(dataset)
+                    continue
+                try:
+                    modified = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                ready_time = modified + self.settle_time
+                if dataset in self.raw:
+                    # Keep the readiness of archives which were already known to be ready
+                    ready_time = min(ready_time, self.raw[dataset])
+                raw[dataset] = ready_time if ready_time > now else 0
+        self.raw = raw
+        self.results = results
+
+    def update(self, name, present):
+        """Record that the named file was added to (and finished) or removed from the root.
+
+        Returns True if the file is an archive of a dataset, and False otherwise.
+        """
+        parsed = catalog_store.parse_archive_name(name)
+        if parsed is None:
+            return False
+        dataset, is_results = parsed
+        if is_results:
+            if present:
+                self.results.add(dataset)
+            else:
+                self.results.discard(dataset)
+        elif present:
+            self.raw[dataset] = 0
+        else:
+            self.raw.pop(dataset, None)
+        return True
+
+    def mark_processed(self, dataset):
+        """Record that the dataset now has a results archive."""
+        self.results.add(dataset)
+
+    def unprocessed(self, exclude=()):
+        """List the datasets which are ready to process but have no results archive yet.
+
+        Datasets are listed in natural sort order (as by `ls -v`), skipping any excluded datasets.
+        """
+        now = time.time()
+        return sorted(
+            (
+                dataset for dataset, ready_time in self.raw.items()
+                if ready_time <= now and dataset not in self.results and dataset not in exclude
+            ),
+            key=catalog_store.natural_sort_key,
+        )
+
+    def next_ready_time(self):
+        """Determine when the next unsettled raw archive will be ready (None if there are none)."""
+        pending = [
+            ready_time for dataset, ready_time in self.raw.items()
+            if ready_time > 0 and dataset not in self.results
+        ]
+        return min(pending, default=None)
+
+# Claims
+
+class Claims:
+    """Exclusive claims on datasets, held as files so that they're shared between processes.
+
+    A dataset is claimed by exclusively creating a claim file named after it in the claims
+    directory, which records the host, process, and processing directory of the claim. The holder
+    of a claim should refresh it (with heartbeat) while processing the dataset, and release it
+    afterwards. If the holder crashes, its claim becomes stale: immediately, if the holder was a
+    process on the same host which no longer exists, or otherwise once the claim hasn't been
+    refreshed for the timeout. Stale claims are broken by the next attempt to claim the dataset.
+    """
+
+    def __init__(self, claims_dir, timeout=15 * 60):
+        self.claims_dir = pathlib.Path(claims_dir)
+        self.timeout = timeout
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+
+    def _path(self, dataset):
+        return self.claims_dir / f'{dataset}.claim'
+
+    def claim(self, dataset, processing_dir=None):
+        """Try to claim the dataset, returning True if the claim was made and False otherwise."""
+        self.claims_dir.mkdir(parents=True, exist_ok=True)
+        path = self._path(dataset)
+        contents = json.dumps({
+            'host': self.host,
+            'pid': self.pid,
+            'processing_dir': None if processing_dir is None else os.fspath(processing_dir),
+            'claimed_at': time.time(),
+        })
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                if not self._break_if_stale(path):
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as claim_file:
+                claim_file.write(contents)
+            return True
+        return False
+
+    def heartbeat(self, dataset):
+        """Refresh the claim on the dataset, so that it doesn't become stale."""
+        try:
+            os.utime(self._path(dataset))
+        except FileNotFoundError:
+            pass
+
+    def release(self, dataset):
+        """Release the claim on the dataset."""
+        try:
+            os.remove(self._path(dataset))
+        except FileNotFoundError:
+            pass
+
+    def _is_stale(self, path):
+        """Determine whether the claim file is stale."""
+        try:
+            modified = path.stat().st_mtime
+        except FileNotFoundError:
+            return False
+        try:
+            with open(path, 'r') as claim_file:
+                contents = json.loads(claim_file.read() or '{}')
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError):
+            # A claim file which can't be parsed may be in the middle of being written
+            contents = {}
+        if contents.get('host') == self.host and isinstance(contents.get('pid'), int):
+            if contents['pid'] == self.pid:
+                return False
+            if not _process_exists(contents['pid']):
+                return True
+        return time.time() - modified > self.timeout
+
+    def _break_if_stale(self, path):
+        """Remove the claim file if it's stale, returning True if it was removed.
+
+        The claim file is renamed to a unique name before being removed, so that when multiple
+        processes try to break the same stale claim at once, only one of them succeeds (and none of
+        them removes a fresh claim made by another process in the meantime).
+        """
+        if not self._is_stale(path):
+            return False
+        tombstone = path.with_name(
+            f'{path.name}.stale-{self.host}-{self.pid}-{threading.get_ident()}',
+        )
+        try:
+            os.rename(path, tombstone)
+        except FileNotFoundError:
+            return False
+        if not self._is_stale(tombstone):
+            # Another process replaced the stale claim with a fresh one just before the rename
+            try:
+                os.rename(tombstone, path)
+            except OSError:
+                pass
+            return False
+        os.remove(tombstone)
+        return True
+
+def _process_exists(pid):
+    """Determine whether a process with the PID exists on this host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+# Scheduling
+
+class Scheduler:
+    """A queue of unprocessed datasets, dispatched to a worker for each processing directory.
+
+    The archives root is watched for changes (if inotify is available) so that new raw and results
+    archives are picked up as soon as they're written, and it's fully rescanned at the rescan
+    interval in case any changes were missed (e.g. on filesystems which don't report changes).
+    Each worker claims the next unprocessed dataset (see Claims), then runs the command with the
+    archives root, its processing directory, the dataset, and the brightness adjustment as
+    arguments, as `tots-process-remotely.sh` expects. Datasets whose command fails are retried only
+    when the scheduler is restarted.
+    """
+
+    def __init__(
+        self, archives_root, processing_dirs, command, adjustment, rescan_interval=None,
+        settle_time=30, claim_timeout=15 * 60, heartbeat_interval=30, exit_when_idle=False,
+        verbose=False,
+    ):
+        self.archives_root = pathlib.Path(archives_root)
+        self.processing_dirs = [pathlib.Path(processing_dir) for processing_dir in processing_dirs]
+        self.command = list(command)
+        self.adjustment = adjustment
+        self.rescan_interval = rescan_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.exit_when_idle = exit_when_idle
+        self.verbose = verbose
+        self.index = DatasetIndex(self.archives_root, settle_time=settle_time)
+        self.claims = Claims(self.archives_root / claims_dir_name, timeout=claim_timeout)
+        self._condition = threading.Condition()
+        self._active = set()
+        self._failed = set()
+        self._stopping = False
+        self._results = {'done': [], 'failed': []}
+
+    def run(self):
+        """Process datasets until interrupted (or until idle, if the scheduler should exit then).
+
+        Returns a dict listing the datasets which were processed and those which failed.
+        """
+        watcher = None
+        if inotify.available():
+            try:
+                watcher = inotify.Watcher(self.archives_root)
+            except OSError as e:
+                print(f'Warning: couldn\'t watch {self.archives_root} for changes: {e}')
+        rescan_interval = self.rescan_interval
+        if rescan_interval is None:
+            rescan_interval = 60 if watcher is None else 15 * 60
+        with self._condition:
+            self.index.rescan()
+        last_rescan = time.monotonic()
+        workers = [
+            threading.Thread(
+                target=self._work, args=(processing_dir,), name=f'worker-{processing_dir}',
+            )
+            for processing_dir in self.processing_dirs
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            while not self._is_done():
+                timeout = max(last_rescan + rescan_interval - time.monotonic(), 0)
+                with self._condition:
+                    next_ready_time = self.index.next_ready_time()
+                if next_ready_time is not None:
+                    timeout = min(timeout, max(next_ready_time - time.time(), 0) + 0.1)
+                timeout = min(timeout, 1) if self.exit_when_idle else timeout
+                rescan = time.monotonic() - last_rescan >= rescan_interval
+                if watcher is not None and not rescan:
+                    rescan = self._apply_events(watcher.read(timeout))
+                elif not rescan:
+                    time.sleep(timeout)
+                    rescan = time.monotonic() - last_rescan >= rescan_interval
+                with self._condition:
+                    if rescan:
+                        if self.verbose:
+                            print(f'Rescanning {self.archives_root}...')
+                        self.index.rescan()
+                        last_rescan = time.monotonic()
+                    self._condition.notify_all()
+        except KeyboardInterrupt:
+            print('Stopping after the datasets being processed...')
+        finally:
+            with self._condition:
+                self._stopping = True
+                self._condition.notify_all()
+            for worker in workers:
+                worker.join()
+            if watcher is not None:
+                watcher.close()
+        return self._results
+
+    def _apply_events(self, events):
+        """Update the index from change notifications, returning True if a rescan is needed."""
+        rescan = False
+        with self._condition:
+            for mask, name in events:
+                if mask & (inotify.IN_Q_OVERFLOW | inotify.IN_IGNORED):
+                    rescan = True
+                elif mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF):
+                    rescan = True
+                elif mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO):
+                    self.index.update(name, present=True)
+                elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                    self.index.update(name, present=False)
+                # Newly-created files are only added once they're closed after writing
+        if rescan:
+            print(f'Warning: lost track of changes in {self.archives_root}; rescanning it...')
+        return rescan
+
+    def _is_done(self):
+        """Determine whether the scheduler should stop, because it's idle and should exit then."""
+        if not self.exit_when_idle:
+            return False
+        with self._condition:
+            if self._active:
+                return False
+            return (
+                not self.index.unprocessed(exclude=self._failed) and
+                self.index.next_ready_time() is None
+            )
+
+    def _claim_next(self, processing_dir):
+        """Claim the next unprocessed dataset, returning None if there are none to claim.
+
+        This must be called with the condition's lock held.
+        """
+        for dataset in self.index.unprocessed(exclude=self._active | self._failed):
+            if self.claims.claim(dataset, processing_dir=processing_dir):
+                self._active.add(dataset)
+                return dataset
+        return None
+
+    def _work(self, processing_dir):
+        """Process datasets in the processing directory, one at a time, until stopping."""
+        while True:
+            with self._condition:
+                dataset = None
+                while not self._stopping:
+                    dataset = self._claim_next(processing_dir)
+                    if dataset is not None:
+                        break
+                    self._condition.wait()
+                if dataset is None:
+                    return
+            succeeded = False
+            try:
+                succeeded = self._process(dataset, processing_dir)
+            finally:
+                self.claims.release(dataset)
+                with self._condition:
+                    self._active.discard(dataset)
+                    if succeeded:
+                        self.index.mark_processed(dataset)
+                        self._results['done'].append(dataset)
+                    elif not self._stopping:
+                        self._failed.add(dataset)
+                        self._results['failed'].append(dataset)
+                    self._condition.notify_all()
+
+    def _process(self, dataset, processing_dir):
+        """Run the command on the dataset, refreshing its claim until the command exits.
+
+        Returns True if the command succeeded, and False otherwise.
+        """
+        print(f'Processing dataset {dataset} in {processing_dir}...')
+        command = [
+            *self.command, os.fspath(self.archives_root), os.fspath(processing_dir), dataset,
+            self.adjustment,
+        ]
+        start_time = time.monotonic()
+        try:
+            process = subprocess.Popen(command)
+        except OSError as e:
+            print(f'Error: couldn\'t process dataset {dataset}: {e}')
+            return False
+        while True:
+            try:
+                process.wait(timeout=self.heartbeat_interval)
+                break
+            except subprocess.TimeoutExpired:
+                self.claims.heartbeat(dataset)
+        elapsed = time.monotonic() - start_time
+        if process.returncode != 0:
+            print(
+                f'Error: processing dataset {dataset} failed with exit code {process.returncode} '
+                f'after {elapsed:.0f} s; it will be skipped until the scheduler is restarted',
+            )
+            return False
+        print(f'Done processing dataset {dataset} in {elapsed:.0f} s!')
+        return True
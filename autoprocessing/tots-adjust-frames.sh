@@ -3,7 +3,11 @@
 processing_dir="$1" # e.g. /home/pi/data
 id="$2"
 adjustment="$3" # e.g. 5%
+scripts_root="$(dirname "$(realpath "$BASH_SOURCE")")"
 
-for file in $processing_dir/img/*/*/*/*.jpg; do
-  magick "$file" -evaluate add "$adjustment" "$file"
-done
+# Datasets listed in the brightness adjustment lists get their listed adjustment instead
+tots-frames adjust \
+  --dataset "$id" \
+  --adjustments "$scripts_root/../project-metadata/brightness-adjustments" \
+  --adjustment "$adjustment" \
+  "$processing_dir/img"
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Command line utility for benchmarking the processing of synthetic PlanktoScope datasets"""
+
+import argparse
+import json
+import pathlib
+import sys
+import tempfile
+
+from ecotaxa import files
+from . import suite
+from . import synthetic
+
+def main():
+    """Generate synthetic PlanktoScope datasets or benchmark their processing."""
+    parser = argparse.ArgumentParser(
+        # The benchmarks aren't installed with the tools, so they're run from a clone of the repo
+        prog='python -m benchmarks.cli',
+        description='Benchmark the processing of synthetic PlanktoScope datasets',
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        default=False,
+        help='Print additional information for troubleshooting',
+    )
+    subparsers = parser.add_subparsers()
+    setup_generate_parser(subparsers.add_parser('generate'))
+    setup_run_parser(subparsers.add_parser('run'))
+    args = parser.parse_args()
+    args.func(args)
+
+def _add_data_arguments(parser):
+    """Add arguments to the (sub)parser for the shape of the synthetic datasets."""
+    parser.add_argument(
+        '--objects',
+        type=int,
+        default=synthetic.default_num_objects,
+        help='Number of objects in each results archive',
+    )
+    parser.add_argument(
+        '--image-size',
+        type=files.parse_size,
+        default=synthetic.default_image_size,
+        help='Average size (e.g. 16k) of each object image',
+    )
+    parser.add_argument(
+        '--columns',
+        type=int,
+        default=synthetic.default_num_columns,
+        help='Number of columns in the metadata file of each EcoTaxa export archive',
+    )
+    parser.add_argument(
+        '--acquisitions',
+        type=int,
+        default=1000,
+        help='Number of acquisitions in the log sheet',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed for generating the synthetic datasets',
+    )
+
+# generate subcommand
+
+def setup_generate_parser(parser):
+    """Set up a (sub)parser for generating synthetic results archives and a logsheet."""
+    parser.add_argument(
+        'output',
+        type=str,
+        help='Directory in which to save the results archives and the log sheet directory',
+    )
+    parser.add_argument(
+        '--datasets',
+        type=int,
+        default=1,
+        help='Number of results archives to generate (for the first acquisitions in the log sheet)',
+    )
+    _add_data_arguments(parser)
+    parser.set_defaults(func=lambda args: generate_datasets(
+        args.output, num_datasets=args.datasets, num_objects=args.objects,
+        image_size=args.image_size, num_columns=args.columns,
+        num_acquisitions=args.acquisitions, seed=args.seed, verbose=args.verbose,
+    ))
+
+def generate_datasets(
+    output_dir, num_datasets=1, num_objects=synthetic.default_num_objects,
+    image_size=synthetic.default_image_size, num_columns=synthetic.default_num_columns,
+    num_acquisitions=1000, seed=0, verbose=False,
+):
+    """Generate synthetic results archives and a matching logsheet in the output directory.
+
+    The results archives are named as `{acquisition-id}-results.tar.gz`, and the TSV files of the
+    logsheet's tables are saved in a `logsheet` subdirectory, so that the output directory can be
+    used as input to the other tools. The output directory is created if it doesn't exist.
+    """
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    acq_ids = [f'tots-ps-acq-{i}' for i in range(max(num_acquisitions, num_datasets))]
+    for acq_id in acq_ids[:num_datasets]:
+        results_path = output_dir / f'{acq_id}-results.tar.gz'
+        if verbose:
+            print(f'Generating {results_path}...')
+        synthetic.generate_results_archive(
+            results_path, acq_id, num_objects=num_objects, image_size=image_size,
+            num_columns=num_columns, seed=seed,
+        )
+    logsheet_dir = output_dir / 'logsheet'
+    logsheet_dir.mkdir(exist_ok=True)
+    if verbose:
+        print(f'Generating a log sheet with {len(acq_ids)} acquisitions in {logsheet_dir}...')
+    synthetic.generate_logsheet(logsheet_dir, acq_ids, seed=seed)
+
+# run subcommand
+
+def setup_run_parser(parser):
+    """Set up a (sub)parser for running the benchmarks."""
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='Number of times to run each benchmark (the fastest run is reported)',
+    )
+    parser.add_argument(
+        '--stages',
+        type=str,
+        nargs='+',
+        choices=list(suite.stages.keys()),
+        default=None,
+        help='Benchmarks to run, instead of all of them',
+    )
+    parser.add_argument(
+        '--baseline',
+        type=str,
+        default=None,
+        help='Path of a JSON file of baseline results to compare the results with',
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.25,
+        help=(
+            'Fraction by which the time or peak memory usage of a benchmark may exceed the '
+            'baseline before it\'s reported as a regression'
+        ),
+    )
+    parser.add_argument(
+        '--save',
+        type=str,
+        default=None,
+        help='Path of a JSON file in which to save the results (e.g. as a new baseline)',
+    )
+    parser.add_argument(
+        '--data-dir',
+        type=str,
+        default=None,
+        help=(
+            'Directory in which to generate the synthetic datasets and run the benchmarks (by '
+            'default, a temporary directory which is deleted afterwards)'
+        ),
+    )
+    _add_data_arguments(parser)
+    parser.set_defaults(func=lambda args: sys.exit(run_benchmarks(
+        num_objects=args.objects, image_size=args.image_size, num_columns=args.columns,
+        num_acquisitions=args.acquisitions, seed=args.seed, repeat=args.repeat,
+        selected_stages=args.stages, baseline_path=args.baseline, tolerance=args.tolerance,
+        save_path=args.save, data_dir=args.data_dir, verbose=args.verbose,
+    )))
+
+def run_benchmarks(
+    num_objects=synthetic.default_num_objects, image_size=synthetic.default_image_size,
+    num_columns=synthetic.default_num_columns, num_acquisitions=1000, seed=0, repeat=3,
+    selected_stages=None, baseline_path=None, tolerance=0.25, save_path=None, data_dir=None,
+    verbose=False,
+):
+    """Benchmark the processing stages on synthetic datasets, comparing them with a baseline.
+
+    The synthetic datasets are generated in the data directory (or a temporary directory) before
+    any benchmarks are run. The results of the benchmarks are printed, and they're saved to a JSON
+    file (together with the parameters of the synthetic datasets and a description of the machine)
+    if a path is provided; such a file can then be used as a baseline. Baselines are only compared
+    with results for synthetic datasets generated with the same parameters.
+
+    Returns 1 if any benchmark regressed from the baseline beyond the tolerance, and 0 otherwise.
+    """
+    parameters = {
+        'objects': num_objects,
+        'image_size': image_size,
+        'columns': num_columns,
+        'acquisitions': num_acquisitions,
+        'seed': seed,
+    }
+    with tempfile.TemporaryDirectory(prefix='tots-ps-benchmark-') as temp_dir:
+        work_dir = pathlib.Path(data_dir if data_dir is not None else temp_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        paths = suite.prepare_data(
+            work_dir, num_objects=num_objects, image_size=image_size, num_columns=num_columns,
+            num_acquisitions=num_acquisitions, seed=seed, verbose=verbose,
+        )
+        suite_results = suite.run_suite(
+            paths, work_dir, repeat=repeat, selected_stages=selected_stages, verbose=verbose,
+        )
+
+    baseline = None
+    if baseline_path is not None:
+        with open(baseline_path, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('parameters') != parameters:
+            print(
+                f'Not comparing with the baseline in {baseline_path}, which was recorded with '
+                f'different parameters: {baseline.get("parameters")}',
+            )
+            baseline = None
+    _print_results(suite_results, None if baseline is None else baseline['stages'])
+
+    if save_path is not None:
+        with files.atomic_output(save_path, mode='w') as save_file:
+            json.dump({
+                'parameters': parameters,
+                'environment': suite.describe_environment(),
+                'stages': suite_results,
+            }, save_file, indent=2)
+        print(f'Saved results to {save_path}')
+
+    if baseline is None:
+        return 0
+    regressions = suite.compare(suite_results, baseline['stages'], tolerance=tolerance)
+    if not regressions:
+        print(f'No regressions beyond {tolerance:.0%} of the baseline')
+        return 0
+    print('Regressions:')
+    for name, metric, result, baseline_result in regressions:
+        print(f'  - {name} {metric}: {result:,.3f} (baseline: {baseline_result:,.3f})')
+    return 1
+
+def _print_results(suite_results, baseline_results=None):
+    """Print a table of the results of the benchmarks, relative to the baseline if provided."""
+    name_width = max(len('benchmark'), *(len(name) for name in suite_results.keys()))
+    header = f'  {"benchmark":<{name_width}}  {"time (s)":>8}  {"MiB/s":>8}  {"items/s":>10}'
+    header += f'  {"peak (MiB)":>10}'
+    if baseline_results is not None:
+        header += f'  {"vs. baseline":>12}'
+    print('Results:')
+    print(header)
+    for name, result in suite_results.items():
+        line = (
+            f'  {name:<{name_width}}  {result["seconds"]:>8.3f}  '
+            f'{result["throughput_mib_s"]:>8.1f}  {result["items_per_s"]:>10,.0f}  '
+            f'{result["peak_memory_bytes"] / 1024 / 1024:>10.1f}'
+        )
+        baseline = None if baseline_results is None else baseline_results.get(name)
+        if baseline is not None:
+            line += f'  {result["seconds"] / baseline["seconds"] - 1:>+12.1%}'
+        print(line)
+
+if __name__ == '__main__':
+    main()
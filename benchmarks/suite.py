@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the stages of processing PlanktoScope results archives and logsheets"""
+
+import gc
+import os
+import pathlib
+import platform
+import shutil
+import time
+import tracemalloc
+import zipfile
+
+from ecotaxa import files
+from ecotaxa.export_metadata import ecotaxa as export_ecotaxa
+from ecotaxa.export_metadata import results
+from ecotaxa.split_archives import ecotaxa as split_ecotaxa
+from logsheet import tables
+from . import synthetic
+
+# Fields and values to correct in the rewrite_metadata benchmark, like generated corrections:
+_corrections = {
+    'sample_id': 'tots-ps-sample-1',
+    'object_lat': '71.3947',
+    'object_lon': '-158.4567',
+    'object_depth_min': '15',
+    'object_depth_max': '15',
+    'sample_sampling_gear': 'single_location',
+}
+
+def prepare_data(
+    data_dir, num_objects=synthetic.default_num_objects, image_size=synthetic.default_image_size,
+    num_columns=synthetic.default_num_columns, num_acquisitions=1000, seed=0, verbose=False,
+):
+    """Generate the synthetic inputs of the benchmarks in the data directory.
+
+    This makes one results archive (for the first acquisition) and a logsheet with the specified
+    number of acquisitions. The EcoTaxa export archive and its metadata file are also extracted
+    from the results archive, as inputs for the later stages.
+
+    Returns a dict of the paths of the inputs, along with the number of objects.
+    """
+    data_dir = pathlib.Path(data_dir)
+    acq_ids = [f'tots-ps-acq-{i}' for i in range(max(num_acquisitions, 1))]
+    paths = {
+        'results': data_dir / f'{acq_ids[0]}-results.tar.gz',
+        'export': data_dir / f'{acq_ids[0]}-export.zip',
+        'metadata': data_dir / 'ecotaxa_export.tsv',
+        'logsheet': data_dir / 'logsheet',
+    }
+    if verbose:
+        print(f'Generating a results archive with {num_objects} objects...')
+    synthetic.generate_results_archive(
+        paths['results'], acq_ids[0], num_objects=num_objects, image_size=image_size,
+        num_columns=num_columns, seed=seed,
+    )
+    with open(paths['results'], 'rb') as results_file, open(paths['export'], 'wb') as export_file:
+        results.extract_ecotaxa_export(results_file, export_file)
+    with (
+        zipfile.ZipFile(paths['export'], mode='r') as export_zip,
+        export_zip.open('ecotaxa_export.tsv') as input_metadata_file,
+        open(paths['metadata'], 'wb') as metadata_file,
+    ):
+        shutil.copyfileobj(input_metadata_file, metadata_file)
+    if verbose:
+        print(f'Generating a log sheet with {len(acq_ids)} acquisitions...')
+    paths['logsheet'].mkdir(exist_ok=True)
+    synthetic.generate_logsheet(paths['logsheet'], acq_ids, seed=seed)
+    paths['num_objects'] = num_objects
+    return paths
+
+# Stages
+
+def _stage_extract(paths, work_dir):
+    """Extract the EcoTaxa export archive from the results archive (without an index)."""
+    with (
+        open(paths['results'], 'rb') as results_file,
+        open(work_dir / 'extracted.zip', 'wb') as export_file,
+    ):
+        results.extract_ecotaxa_export(results_file, export_file)
+    return os.path.getsize(paths['results']), paths['num_objects']
+
+def _stage_rewrite_metadata(paths, work_dir):
+    """Correct fields of the metadata file as a stream, like ecotaxa-metadata-edit does."""
+    with (
+        open(paths['metadata'], 'r', encoding='utf-8', newline='') as input_metadata_file,
+        files.spooled_temporary_file(
+            mode='w+', encoding='utf-8', newline='',
+        ) as output_metadata_file,
+    ):
+        export_ecotaxa.stream_rewrite_metadata(
+            input_metadata_file, output_metadata_file, _corrections,
+        )
+    return os.path.getsize(paths['metadata']), paths['num_objects']
+
+def _stage_replace_metadata_file(paths, work_dir):
+    """Write a copy of the EcoTaxa export archive with a replaced metadata file."""
+    with (
+        open(paths['export'], 'rb') as input_file,
+        open(work_dir / 'replaced.zip', 'wb') as output_file,
+        open(paths['metadata'], 'rb') as replacement_file,
+    ):
+        export_ecotaxa._replace_metadata_file(input_file, output_file, replacement_file)
+    return os.path.getsize(paths['export']), paths['num_objects']
+
+def _stage_chunk_archive(paths, work_dir):
+    """Write the first of two chunks of the EcoTaxa export archive."""
+    with (
+        open(paths['export'], 'rb') as input_file,
+        open(work_dir / 'chunk0.zip', 'wb') as output_file,
+    ):
+        split_ecotaxa.chunk_archive(input_file, 2, 0, output_file)
+    return os.path.getsize(paths['export']), paths['num_objects']
+
+def _stage_load_logsheet(paths, work_dir):
+    """Load and join the tables of the logsheet."""
+    table_paths = {path.stem: path for path in paths['logsheet'].glob('*.tsv')}
+    table_files = {
+        table_name: open(path, 'r', newline='') for table_name, path in table_paths.items()
+    }
+    try:
+        joined_rows, _ = tables.load(table_files)
+    finally:
+        for table_file in table_files.values():
+            table_file.close()
+    return sum(os.path.getsize(path) for path in table_paths.values()), len(joined_rows)
+
+stages = {
+    'extract': _stage_extract,
+    'rewrite_metadata': _stage_rewrite_metadata,
+    '_replace_metadata_file': _stage_replace_metadata_file,
+    'chunk_archive': _stage_chunk_archive,
+    'tables.load': _stage_load_logsheet,
+}
+
+def run_stage(stage, paths, work_dir, repeat=3):
+    """Benchmark a stage, returning its best time and throughput and its peak memory usage.
+
+    The stage is timed over the specified number of repetitions, and the fastest repetition is
+    reported (as the one least disturbed by other activity on the machine). Peak memory usage (of
+    Python allocations, as traced by tracemalloc) is measured in a separate repetition, since
+    tracing slows down allocations.
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start_time = time.perf_counter()
+        num_bytes, num_items = stage(paths, work_dir)
+        times.append(time.perf_counter() - start_time)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        stage(paths, work_dir)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    best_time = min(times)
+    result = {
+        'seconds': best_time,
+        'mean_seconds': sum(times) / len(times),
+        'bytes': num_bytes,
+        'throughput_mib_s': num_bytes / max(best_time, 1e-9) / 1024 / 1024,
+        'peak_memory_bytes': peak_memory,
+    }
+    result['items'] = num_items
+    result['items_per_s'] = num_items / max(best_time, 1e-9)
+    return result
+
+def run_suite(paths, work_dir, repeat=3, selected_stages=None, verbose=False):
+    """Benchmark all stages (or the selected stages), returning a dict of results by stage."""
+    suite_results = {}
+    for name, stage in stages.items():
+        if selected_stages is not None and name not in selected_stages:
+            continue
+        if verbose:
+            print(f'Running benchmark {name}...')
+        suite_results[name] = run_stage(stage, paths, work_dir, repeat=repeat)
+    return suite_results
+
+def describe_environment():
+    """Describe the machine and Python interpreter which the benchmarks were run on."""
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'system': platform.system(),
+        'cpu_count': os.cpu_count(),
+    }
+
+# Baselines
+
+def compare(suite_results, baseline_results, tolerance=0.25):
+    """Compare the results of the suite with the baseline results of the same stages.
+
+    Returns a list of the regressions, as (stage, metric, result, baseline) tuples, where the time
+    or peak memory usage of a stage exceeds that of the baseline by more than the tolerance (as a
+    fraction of the baseline). Stages which aren't in the baseline are ignored.
+    """
+    regressions = []
+    for name, result in suite_results.items():
+        baseline = baseline_results.get(name)
+        if baseline is None:
+            continue
+        for metric in ('seconds', 'peak_memory_bytes'):
+            if result[metric] > baseline[metric] * (1 + tolerance):
+                regressions.append((name, metric, result[metric], baseline[metric]))
+    return regressions
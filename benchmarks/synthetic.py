@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""Generation of synthetic PlanktoScope results archives and logsheets for benchmarking"""
+
+import csv
+import io
+import pathlib
+import random
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from ecotaxa import metadata
+from logsheet import tables
+
+default_num_objects = 2000
+default_image_size = 16 * 1024 # bytes
+default_num_columns = 60
+
+# These are the fields which the logsheet's corrections apply to, as in PlanktoScope exports:
+_base_fields = {
+    'img_file_name': '[t]',
+    'object_id': '[t]',
+    'object_lat': '[f]',
+    'object_lon': '[f]',
+    'object_date': '[t]',
+    'object_time': '[t]',
+    'object_depth_min': '[f]',
+    'object_depth_max': '[f]',
+    'sample_id': '[t]',
+    'sample_operator': '[t]',
+    'sample_sampling_gear': '[t]',
+    'acq_id': '[t]',
+    'acq_local_datetime': '[t]',
+}
+
+# Results archives
+
+def generate_results_archive(
+    output_path, acq_id, num_objects=default_num_objects, image_size=default_image_size,
+    num_columns=default_num_columns, seed=0,
+):
+    """Generate a synthetic results archive for the acquisition at the specified path.
+
+    The results archive is laid out as made by the ToTS autoprocessing scripts: an `objects/`
+    directory of segmented object images, followed by an `export/ecotaxa/` directory with a single
+    EcoTaxa export archive. The EcoTaxa export archive holds a copy of each object image and an
+    `ecotaxa_export.tsv` metadata file whose second row gives the `[t]`/`[f]` type of each field.
+
+    Object images are incompressible (as JPEG files are), and their sizes are spread uniformly
+    between half and one-and-a-half times the specified image size. The metadata file has the
+    specified number of columns (at least as many as the fields which the logsheet's corrections
+    apply to), padded out with numeric object feature columns.
+    """
+    if num_columns < len(_base_fields):
+        raise ValueError(f'Metadata files need at least {len(_base_fields)} columns')
+    rng = random.Random(f'{seed}:{acq_id}')
+    field_types = dict(_base_fields)
+    for i in range(num_columns - len(_base_fields)):
+        field_types[f'object_feature{i}'] = '[f]'
+    object_dir = f'objects/2023-06-25/{acq_id}/{acq_id}_1'
+    export_name = f'export/ecotaxa/ecotaxa_{acq_id}.zip'
+    mtime = time.time()
+
+    with (
+        tarfile.open(output_path, mode='w:gz', compresslevel=6) as results_tar,
+        tempfile.TemporaryFile(prefix='tots-ps-benchmark-', suffix='.zip') as export_file,
+    ):
+        for directory in _parent_dirs(object_dir):
+            _add_directory(results_tar, directory, mtime)
+        metadata_file = io.StringIO(newline='')
+        writer = metadata.make_writer(
+            metadata_file, list(field_types.keys()), list(field_types.values()),
+        )
+        export_zip = zipfile.ZipFile(export_file, mode='w', compression=zipfile.ZIP_DEFLATED)
+        with export_zip:
+            for i in range(num_objects):
+                image_name = f'{acq_id}_{i}.jpg'
+                image = _make_image(rng, image_size)
+                _add_file(results_tar, f'{object_dir}/{image_name}', image, mtime)
+                export_zip.writestr(image_name, image)
+                row = _make_row(rng, acq_id, i, image_name, field_types)
+                writer.writerow([row[field] for field in field_types.keys()])
+            export_zip.writestr('ecotaxa_export.tsv', metadata_file.getvalue().encode('utf-8'))
+        for directory in _parent_dirs(export_name.rsplit('/', 1)[0]):
+            _add_directory(results_tar, directory, mtime)
+        tarinfo = tarfile.TarInfo(export_name)
+        tarinfo.size = export_file.tell()
+        tarinfo.mtime = mtime
+        export_file.seek(0)
+        results_tar.addfile(tarinfo, export_file)
+
+def _parent_dirs(path):
+    """List the directory and its parent directories, from the outermost to the innermost."""
+    parts = path.split('/')
+    return ['/'.join(parts[:i + 1]) for i in range(len(parts))]
+
+def _add_directory(results_tar, name, mtime):
+    """Add a directory entry to the tarfile."""
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.type = tarfile.DIRTYPE
+    tarinfo.mode = 0o755
+    tarinfo.mtime = mtime
+    results_tar.addfile(tarinfo)
+
+def _add_file(results_tar, name, contents, mtime):
+    """Add a regular file with the specified contents to the tarfile."""
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(contents)
+    tarinfo.mtime = mtime
+    results_tar.addfile(tarinfo, io.BytesIO(contents))
+
+def _make_image(rng, image_size):
+    """Make the contents of an incompressible fake JPEG file of roughly the specified size."""
+    size = rng.randint(image_size // 2, image_size * 3 // 2)
+    return b'\xff\xd8\xff\xe0' + rng.randbytes(max(size - 6, 0)) + b'\xff\xd9'
+
+def _make_row(rng, acq_id, index, image_name, field_types):
+    """Make the metadata row of an object, with plausible values for each field."""
+    row = {
+        'img_file_name': image_name,
+        'object_id': f'{acq_id}_{index}',
+        'object_lat': '-90.0000',
+        'object_lon': '0.0000',
+        'object_date': '2023-06-25',
+        'object_time': '22:54:40',
+        'object_depth_min': '0',
+        'object_depth_max': '0',
+        'sample_id': 'SKQ',
+        'sample_operator': 'planktoscope',
+        'sample_sampling_gear': 'net',
+        'acq_id': acq_id,
+        'acq_local_datetime': '2023-06-26T19:15:45',
+    }
+    for field in field_types.keys():
+        if field not in row:
+            row[field] = f'{rng.uniform(0, 1000):.3f}'
+    return row
+
+# Logsheets
+
+def generate_logsheet(output_dir, acq_ids, num_extra_columns=10, seed=0):
+    """Generate synthetic TSV files of the logsheet's tables in the output directory.
+
+    Each acquisition gets its own adjusted sample and source sample, and the tables have the
+    columns which are loaded from the logsheet (see logsheet.tables) along with the specified number
+    of extra columns (which aren't loaded), as the real logsheet has many more columns than are
+    used. Returns a dict associating table names with the paths of their TSV files.
+    """
+    rng = random.Random(f'{seed}:logsheet')
+    output_dir = pathlib.Path(output_dir)
+    table_rows = {'src': [], 'adj': [], 'acq': []}
+    for i, acq_id in enumerate(acq_ids):
+        src_id = f'source-{i}'
+        adj_id = f'adjusted-{i}'
+        depth = str(rng.randint(2, 50))
+        table_rows['src'].append({
+            'id': src_id,
+            'type': rng.choice(['CTD Niskin', 'Net Vert', 'Ice Core']),
+            'station_id': f'S{i % 200:03d}',
+            'cast_id': str(rng.randint(1, 10)),
+            'arrigo_id': str(rng.randint(1, 30)),
+            'depth_min': depth,
+            'depth_max': depth,
+            'start_date_utc': '2023-06-17',
+            'start_time_utc': f'{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00',
+            'start_lat': f'{rng.uniform(60, 75):.4f}',
+            'start_lon': f'{rng.uniform(-170, -150):.4f}',
+        })
+        table_rows['adj'].append({
+            'id': adj_id,
+            'src_id': src_id,
+            'dilution_factor': f'{rng.uniform(0, 2):.3f}',
+        })
+        table_rows['acq'].append({
+            'id': acq_id,
+            'operator': 'Test Operator',
+            'adj_id': adj_id,
+            'start_time_local': '2023-06-17 12:00',
+            'acq_id': f'SKQ-ToTS_S{i % 200:03d}_{acq_id}',
+        })
+    table_paths = {}
+    for table_name, rows in table_rows.items():
+        column_names = tables._column_names[table_name]
+        extra_columns = [f'Extra Column {j}' for j in range(num_extra_columns)]
+        table_paths[table_name] = output_dir / f'{table_name}.tsv'
+        with open(table_paths[table_name], 'w', newline='') as table_file:
+            writer = csv.writer(table_file, delimiter='\t', lineterminator='\n')
+            writer.writerow(list(column_names.values()) + extra_columns)
+            for row in rows:
+                writer.writerow(
+                    [row[key] for key in column_names.keys()] +
+                    [f'{rng.random():.6f}' for _ in extra_columns],
+                )
+    return table_paths
@@ -1,15 +1,368 @@
 # -*- coding: utf-8 -*-
 """Handling of PlanktoScope ecotaxa export archives"""
 
+import copy
+import io
+import struct
+import time
 import zipfile
+import zlib
 
-def extract_metadata_file(export_archive, output_metadata_file):
-    """Extract the metadata file of an EcoTaxa export archive to the specified output file.
+_copy_block_size = 1024 * 1024 # bytes
 
-    The cursor of the output file is left at the end of the file."""
-    with (
-        zipfile.ZipFile(export_archive, mode='r') as export_zip,
-        export_zip.open('ecotaxa_export.tsv') as metadata_file,
+def open_metadata_file(export_zip):
+    """Open the metadata file of an opened EcoTaxa export zip file as a text stream for reading.
+
+    The metadata file is decompressed incrementally as it's read, rather than all at once.
+    """
+    return io.TextIOWrapper(export_zip.open('ecotaxa_export.tsv'), encoding='utf-8', newline='')
+
+def write_metadata_file(output_zip, metadata_file, compress_type=zipfile.ZIP_DEFLATED):
+    """Write the metadata file to an EcoTaxa export zip file opened for writing.
+
+    The metadata file is compressed and written in bounded-size blocks. The cursor of the metadata
+    file must be at the appropriate location before the function is called, and it is left at the
+    end of the file when the function returns.
+    """
+    zipinfo = zipfile.ZipInfo('ecotaxa_export.tsv', date_time=time.localtime(time.time())[:6])
+    zipinfo.compress_type = compress_type
+    zipinfo.external_attr = 0o600 << 16 # this matches what ZipFile.writestr does
+    with output_zip.open(zipinfo, mode='w') as output_file:
+        while block := metadata_file.read(_copy_block_size):
+            if isinstance(block, str):
+                block = block.encode('utf-8')
+            output_file.write(block)
+
+# Raw copying of zip file members
+
+_local_header_signature = b'PK\x03\x04'
+_local_header_size = 30 # bytes, not including the variable-length filename and extra field
+_central_entry_size = 46 # bytes, not including the variable-length filename, extra, and comment
+_data_descriptor_flag = 0x08
+_data_descriptor_size = 24 # bytes, in the largest (ZIP64) format with a signature
+_zip64_extra_id = 0x0001
+_zip64_size_limit = 0xFFFFFFFF
+# The end of central directory record, with the ZIP64 end of central directory record and locator
+end_of_archive_size = 22 + 56 + 20 # bytes
+
+def copy_member(input_zip, zipinfo, output_zip):
+    """Copy a member of the input zip file to the output zip file without recompressing it.
+
+    The compressed bytes, CRC and header fields of the member are copied verbatim, so the time
+    needed only depends on the compressed size of the member. The output zip file must have been
+    opened for writing, and it must not have any other members open for writing.
+
+    This relies on internals of the zipfile module (the same ones it uses for writing members),
+    since zipfile has no public API for copying members between archives.
+    """
+    input_zip.fp.seek(zipinfo.header_offset)
+    local_header = input_zip.fp.read(_local_header_size)
+    if len(local_header) != _local_header_size or not local_header.startswith(
+        _local_header_signature,
     ):
-        output_metadata_file.write(metadata_file.read().decode('utf-8'))
-        output_metadata_file.flush()
+        raise zipfile.BadZipFile(f'Bad local file header for {zipinfo.filename}')
+    filename_length, extra_length = struct.unpack('<HH', local_header[26:30])
+    input_zip.fp.seek(filename_length + extra_length, 1)
+
+    output_info = copy.copy(zipinfo)
+    # The CRC and sizes are known up-front, so they go in the local header instead of a descriptor
+    output_info.flag_bits &= ~_data_descriptor_flag
+    # ZIP64 fields are regenerated by zipfile as needed for the header offset in the output zip file
+    output_info.extra = _strip_zip64_extra(zipinfo.extra)
+    output_info.header_offset = output_zip.fp.tell()
+    output_zip._writecheck(output_info)
+    output_zip._didModify = True
+    output_zip.fp.write(output_info.FileHeader(zip64=None))
+    remaining_size = zipinfo.compress_size
+    while remaining_size > 0:
+        block = input_zip.fp.read(min(remaining_size, _copy_block_size))
+        if not block:
+            raise zipfile.BadZipFile(f'Truncated compressed data for {zipinfo.filename}')
+        output_zip.fp.write(block)
+        remaining_size -= len(block)
+    output_zip.filelist.append(output_info)
+    output_zip.NameToInfo[output_info.filename] = output_info
+    output_zip.start_dir = output_zip.fp.tell()
+
+def copied_member_size(zipinfo, zip64_offset=False):
+    """Determine how many bytes copy_member adds to an output zip file for the member.
+
+    This includes the member's local header, its compressed data, and its entry in the central
+    directory. If the member might be written at an offset beyond 4 GiB in the output zip file,
+    zip64_offset should be set, to account for the ZIP64 field needed to record its offset.
+    """
+    filename_size = len(zipinfo.filename.encode('utf-8'))
+    extra_size = len(_strip_zip64_extra(zipinfo.extra))
+    local_header_size = _local_header_size + filename_size + extra_size
+    central_entry_size = _central_entry_size + filename_size + extra_size + len(zipinfo.comment)
+    zip64_sizes = max(zipinfo.file_size, zipinfo.compress_size) > _zip64_size_limit
+    if zip64_sizes:
+        local_header_size += _zip64_extra_size(2)
+    if zip64_sizes or zip64_offset:
+        central_entry_size += _zip64_extra_size(3)
+    return local_header_size + zipinfo.compress_size + central_entry_size
+
+def metadata_file_size_bound(metadata_size, zip64_offset=False):
+    """Determine an upper bound on how many bytes write_metadata_file adds to an output zip file.
+
+    The metadata size is the uncompressed size (in bytes) of the metadata file. The bound accounts
+    for the file's local header, its compressed data (in the worst case of incompressible data), a
+    data descriptor, and its entry in the central directory; zip64_offset has the same meaning as
+    for copied_member_size.
+    """
+    filename_size = len('ecotaxa_export.tsv')
+    size = _local_header_size + filename_size + _central_entry_size + filename_size
+    size += _deflate_bound(metadata_size) + _data_descriptor_size
+    if zip64_offset:
+        size += _zip64_extra_size(3)
+    return size
+
+def _deflate_bound(size):
+    """Determine an upper bound on the size of the raw deflate stream of data of the given size.
+
+    This is the bound computed by zlib's deflateBound for the default compression parameters used by
+    zipfile, without the zlib wrapper.
+    """
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 7
+
+def _zip64_extra_size(num_values):
+    """Determine the size of a ZIP64 extra field with the specified number of 8-byte values."""
+    return 4 + 8 * num_values
+
+def _strip_zip64_extra(extra):
+    """Remove any ZIP64 extended information fields from the extra field of a zip file member."""
+    stripped_fields = []
+    i = 0
+    while i + 4 <= len(extra):
+        field_id, field_size = struct.unpack('<HH', extra[i:i + 4])
+        if field_id != _zip64_extra_id:
+            stripped_fields.append(extra[i:i + 4 + field_size])
+        i += 4 + field_size
+    return b''.join(stripped_fields)
+
+# Sequential reading of zip files
+
+_local_header_format = '<4sHHHHHIIIHH'
+_utf8_filename_flag = 0x800
+_data_descriptor_signature = b'PK\x07\x08'
+_skip_block_size = 64 * 1024 # bytes
+
+def open_streamed_metadata_file(export_stream):
+    """Open the metadata file of an EcoTaxa export archive which can only be read sequentially.
+
+    This is useful for reading the metadata file of an EcoTaxa export archive while it's still being
+    decompressed from a results archive. The local headers of the archive's members are parsed in
+    order, and the compressed data of members preceding the metadata file is skipped without being
+    decompressed, unless the local header of a member doesn't record its compressed size (e.g.
+    because the archive was itself written as a stream). Returns a text stream which decompresses
+    the metadata file incrementally as it's read.
+
+    Raises a KeyError if the archive has no metadata file.
+    """
+    stream = _SequentialReader(export_stream)
+    while True:
+        local_header = stream.read(_local_header_size)
+        if len(local_header) < _local_header_size or not local_header.startswith(
+            _local_header_signature,
+        ):
+            # We've reached the central directory without finding the metadata file
+            raise KeyError('There is no item named \'ecotaxa_export.tsv\' in the archive')
+        (
+            _, _, flag_bits, compress_type, _, _, _, compress_size, file_size,
+            filename_length, extra_length,
+        ) = struct.unpack(_local_header_format, local_header)
+        filename = stream.read(filename_length).decode(
+            'utf-8' if flag_bits & _utf8_filename_flag else 'cp437',
+        )
+        extra = stream.read(extra_length)
+        zip64 = _zip64_size_limit in (compress_size, file_size)
+        if zip64:
+            file_size, compress_size = _read_zip64_sizes(extra, file_size, compress_size)
+        size_known = not (flag_bits & _data_descriptor_flag and compress_size == 0)
+        if compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise NotImplementedError(f'Compression method {compress_type} of {filename}')
+
+        if filename == 'ecotaxa_export.tsv':
+            if not size_known and compress_type == zipfile.ZIP_STORED:
+                # The end of the member can only be found by scanning through all of its data
+                member_file = io.BytesIO()
+                _skip_stored_member(stream, output_file=member_file)
+                member_file.seek(0)
+            else:
+                member_file = io.BufferedReader(_StreamedMemberReader(
+                    stream, compress_type, compress_size if size_known else None,
+                ))
+            return io.TextIOWrapper(member_file, encoding='utf-8', newline='')
+        if size_known:
+            stream.skip(compress_size)
+        elif compress_type == zipfile.ZIP_STORED:
+            compress_size = _skip_stored_member(stream)
+        else:
+            compress_size = _StreamedMemberReader(stream, compress_type, None).skip_to_end()
+        if flag_bits & _data_descriptor_flag:
+            descriptor_size = 20 if zip64 or compress_size > _zip64_size_limit else 12
+            if stream.peek(4) == _data_descriptor_signature:
+                descriptor_size += 4
+            stream.skip(descriptor_size)
+
+def _read_zip64_sizes(extra, file_size, compress_size):
+    """Read the sizes of a member from the ZIP64 extended information field of its local header."""
+    i = 0
+    while i + 4 <= len(extra):
+        field_id, field_size = struct.unpack('<HH', extra[i:i + 4])
+        if field_id == _zip64_extra_id:
+            values = extra[i + 4:i + 4 + field_size]
+            if file_size == _zip64_size_limit and len(values) >= 8:
+                file_size = struct.unpack('<Q', values[:8])[0]
+                values = values[8:]
+            if compress_size == _zip64_size_limit and len(values) >= 8:
+                compress_size = struct.unpack('<Q', values[:8])[0]
+            break
+        i += 4 + field_size
+    return file_size, compress_size
+
+def _skip_stored_member(stream, output_file=None):
+    """Skip over the data of a stored member whose size isn't recorded in its local header.
+
+    The end of the member's data is found by searching for a data descriptor whose CRC and size
+    match the data preceding it. If an output file is provided, the member's data is written to it.
+    Returns the size of the member's data.
+    """
+    crc = 0
+    size = 0
+    pending = b''
+    while True:
+        block = stream.read_block(_skip_block_size)
+        if not block:
+            raise EOFError('Zip file ended in the middle of a member')
+        pending += block
+        start = 0
+        while (i := pending.find(_data_descriptor_signature, start)) != -1:
+            descriptor = pending[i + 4:i + 16]
+            if len(descriptor) < 12:
+                break # we need more data to check this candidate
+            # The sizes are little-endian, so this also works for ZIP64 data descriptors
+            descriptor_crc, descriptor_size = struct.unpack('<II', descriptor[:8])
+            if (
+                descriptor_size == (size + i) & _zip64_size_limit
+                and descriptor_crc == zlib.crc32(pending[:i], crc)
+            ):
+                if output_file is not None:
+                    output_file.write(pending[:i])
+                stream.push_back(pending[i:])
+                return size + i
+            start = i + 1
+        # Keep any data which might be the start of a data descriptor
+        keep_start = i if i != -1 else max(len(pending) - len(_data_descriptor_signature) + 1, 0)
+        crc = zlib.crc32(pending[:keep_start], crc)
+        size += keep_start
+        if output_file is not None:
+            output_file.write(pending[:keep_start])
+        pending = pending[keep_start:]
+
+class _SequentialReader:
+    """A wrapper for a sequentially-readable file, with support for pushing data back."""
+
+    def __init__(self, file):
+        self._file = file
+        self._pushed_back = b''
+
+    def read(self, size):
+        """Read up to the specified number of bytes, returning fewer only at the end of the file."""
+        data = self._pushed_back[:size]
+        self._pushed_back = self._pushed_back[size:]
+        while len(data) < size:
+            block = self._file.read(size - len(data))
+            if not block:
+                break
+            data += block
+        return data
+
+    def read_block(self, size):
+        """Read at most the specified number of bytes, returning no bytes only at the file's end."""
+        if self._pushed_back:
+            return self.read(min(size, len(self._pushed_back)))
+        return self._file.read(size)
+
+    def peek(self, size):
+        """Read up to the specified number of bytes without consuming them."""
+        data = self.read(size)
+        self.push_back(data)
+        return data
+
+    def push_back(self, data):
+        """Return data to the front of the stream, so that it will be read again."""
+        self._pushed_back = data + self._pushed_back
+
+    def skip(self, size):
+        """Skip over the specified number of bytes, raising an EOFError if the file ends first."""
+        while size > 0:
+            block = self.read_block(min(size, _skip_block_size))
+            if not block:
+                raise EOFError('Zip file ended in the middle of a member')
+            size -= len(block)
+
+class _StreamedMemberReader(io.RawIOBase):
+    """A reader for the decompressed data of a member of a zip file being read sequentially.
+
+    If the compressed size of the member is unknown, the member must be deflate-compressed, and its
+    end is found by decompressing it; any data read past the end is pushed back onto the stream.
+    """
+
+    def __init__(self, stream, compress_type, compress_size):
+        super().__init__()
+        self._stream = stream
+        self._remaining_size = compress_size
+        self._consumed_size = 0
+        self._decompressor = None
+        if compress_type == zipfile.ZIP_DEFLATED:
+            self._decompressor = zlib.decompressobj(-15)
+        self._unconsumed = b''
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._eof:
+            data = self._next_output(len(buffer))
+            if data:
+                buffer[:len(data)] = data
+                return len(data)
+        return 0
+
+    def skip_to_end(self):
+        """Read to the end of the member, discarding the data; returns the compressed size."""
+        while not self._eof:
+            self._next_output(_skip_block_size)
+        return self._consumed_size
+
+    def _next_output(self, max_size):
+        """Decompress up to the specified number of bytes, which might be no bytes at all."""
+        if not self._unconsumed:
+            read_size = _skip_block_size
+            if self._remaining_size is not None:
+                read_size = min(read_size, self._remaining_size)
+            compressed = self._stream.read_block(read_size) if read_size > 0 else b''
+            if not compressed:
+                if self._remaining_size and self._remaining_size > 0:
+                    raise EOFError('Zip file ended in the middle of a member')
+                self._eof = True
+                return b''
+            self._consumed_size += len(compressed)
+            if self._remaining_size is not None:
+                self._remaining_size -= len(compressed)
+            if self._decompressor is None:
+                if self._remaining_size == 0:
+                    self._eof = True
+                return compressed # the data is stored without compression
+            self._unconsumed = compressed
+        data = self._decompressor.decompress(self._unconsumed, max_size)
+        self._unconsumed = self._decompressor.unconsumed_tail
+        if self._decompressor.eof:
+            self._eof = True
+            unused_data = self._decompressor.unused_data
+            if unused_data:
+                self._consumed_size -= len(unused_data)
+                self._stream.push_back(unused_data)
+        return data
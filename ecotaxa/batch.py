@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Batch processing of PlanktoScope datasets with a bounded pool of worker processes"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import os
+import time
+import traceback
+
+from . import profiling
+
+def resolve_jobs(jobs):
+    """Determine the number of worker processes to use, where 0 means one per CPU core."""
+    if jobs is None or jobs < 0:
+        raise ValueError(f'Invalid number of jobs: {jobs}')
+    if jobs == 0:
+        return os.cpu_count() or 1
+    return jobs
+
+def parse_jobs(value):
+    """Parse a number of worker processes (0 for one per CPU core), for use as an argparse type."""
+    jobs = int(value)
+    if jobs < 0:
+        raise argparse.ArgumentTypeError(f'must be at least 0, not {jobs}')
+    return jobs
+
+def read_dataset_list(list_file):
+    """Read a list of dataset names (e.g. acquisition IDs) from a file-like object, one per line.
+
+    Blank lines and lines starting with `#` are ignored.
+    """
+    datasets = []
+    for line in list_file:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        datasets.append(line)
+    return datasets
+
+def run_tasks(tasks, jobs=1, on_result=None):
+    """Run the tasks, with up to the specified number of tasks being processed at any time.
+
+    Each task should be provided as a (dataset name, function, args, kwargs) tuple. The function
+    may return a (status, message) pair or a (status, message, data) triple, where the status is
+    'done' or 'skipped' and the data is any picklable value to pass back from the task; if it
+    returns None, the task is considered done. If the function raises an exception, the task is
+    considered failed, but the remaining tasks are still run.
+
+    With a single job, tasks are run one-by-one in the current process and their output is printed
+    directly. With more jobs, tasks are run in a pool of worker processes; only as many tasks as
+    there are workers are submitted at any time (to bound the amount of temporary storage and memory
+    in use), and the output of each task is captured and printed together once the task finishes.
+
+    If a callback function is provided, it's called with the result dict of each task as soon as
+    the task finishes. If profiling is enabled (see the profiling module), each task is recorded as
+    a dataset in the profile, including in worker processes.
+
+    Returns a list of result dicts (one per task, in order of completion) with the keys 'dataset',
+    'status', 'message', 'data', and 'wall_time'.
+    """
+    jobs = resolve_jobs(jobs)
+    results = []
+    if jobs == 1:
+        for task in tasks:
+            result = _run_task(task, capture_output=False)
+            results.append(result)
+            _print_result(result)
+            if on_result is not None:
+                on_result(result)
+        return results
+
+    tasks = iter(tasks)
+    profiling_settings = profiling.settings()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=None if profiling_settings is None else profiling.enable,
+        initargs=profiling_settings or (),
+    ) as executor:
+        in_flight = set()
+        try:
+            while True:
+                while len(in_flight) < jobs:
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    in_flight.add(executor.submit(_run_task, task, capture_output=True))
+                if not in_flight:
+                    break
+                finished, in_flight = concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in finished:
+                    result = future.result()
+                    results.append(result)
+                    print(result.pop('log'), end='')
+                    _print_result(result)
+                    if on_result is not None:
+                        on_result(result)
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    return results
+
+def _run_task(task, capture_output=False):
+    """Run the task, recording its status and wall time and (if requested) its output."""
+    dataset, function, args, kwargs = task
+    log = io.StringIO()
+    start_time = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if capture_output:
+            stack.enter_context(contextlib.redirect_stdout(log))
+            stack.enter_context(contextlib.redirect_stderr(log))
+        profile = stack.enter_context(profiling.dataset(dataset))
+        try:
+            status, message, *data = function(*args, **kwargs) or ('done', '')
+        except Exception as e: # failures should only affect the dataset which failed
+            traceback.print_exc()
+            status, message, data = 'failed', f'{type(e).__name__}: {e}', []
+        profile.set(status=status)
+    result = {
+        'dataset': dataset,
+        'status': status,
+        'message': message,
+        'data': data[0] if data else None,
+        'wall_time': time.perf_counter() - start_time,
+    }
+    if capture_output:
+        result['log'] = log.getvalue()
+    return result
+
+def _print_result(result):
+    """Print a one-line summary of the result of a task."""
+    line = f'[{result["status"]}] {result["dataset"]} ({result["wall_time"]:.1f} s)'
+    if result['message']:
+        line += f': {result["message"]}'
+    print(line)
+    print()
+
+def print_summary(results, wall_time=None):
+    """Print a table summarizing the results of the tasks of a batch."""
+    print('Summary:')
+    if not results:
+        print('  (no datasets were processed)')
+        return
+    name_width = max(len('dataset'), *(len(result['dataset']) for result in results))
+    print(f'  {"dataset":<{name_width}}  {"status":<7}  {"time (s)":>8}  message')
+    for result in sorted(results, key=lambda result: result['dataset']):
+        print(
+            f'  {result["dataset"]:<{name_width}}  {result["status"]:<7}  '
+            f'{result["wall_time"]:>8.1f}  {result["message"]}',
+        )
+    counts = {status: 0 for status in ('done', 'skipped', 'failed')}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    totals = ', '.join(f'{count} {status}' for status, count in counts.items())
+    if wall_time is not None:
+        totals += f' in {wall_time:.1f} s'
+    print(f'  Total: {totals}')
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Command line utility for the catalog of PlanktoScope datasets on the archive drive"""
+
+import argparse
+import sys
+import time
+
+from . import refresh
+from . import store
+
+_statuses = ['unprocessed', 'processed', 'all']
+
+def main():
+    """Refresh or query the catalog of datasets in an archives root."""
+    parser = argparse.ArgumentParser(
+        prog='tots-catalog',
+        description=(
+            'Keep a catalog of the raw and results archives of PlanktoScope datasets on the '
+            'archive drive, so that they can be listed without reading the archives'
+        ),
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        default=False,
+        help='Print additional information for troubleshooting',
+    )
+    parser.add_argument(
+        '--catalog',
+        type=str,
+        default=None,
+        help=(
+            'Path of the catalog database (default: `.tots-catalog.sqlite` in the archives root; '
+            'other tools only consult the catalog at the default path)'
+        ),
+    )
+    subparsers = parser.add_subparsers()
+    setup_refresh_parser(subparsers.add_parser('refresh'))
+    setup_list_parser(subparsers.add_parser('list'))
+    setup_show_parser(subparsers.add_parser('show'))
+    args = parser.parse_args()
+    args.func(args)
+
+def _connect(args):
+    """Open the catalog database selected by the command-line arguments."""
+    return store.connect(args.catalog or store.default_path(args.archives_root))
+
+def _add_archives_root_argument(parser):
+    """Add the archives root as a positional argument of a (sub)parser."""
+    parser.add_argument(
+        'archives_root',
+        type=str,
+        help='Directory with the raw and results archives of datasets (e.g. /mnt/archives)',
+    )
+
+# refresh subcommand
+
+def setup_refresh_parser(parser):
+    """Set up a (sub)parser for refreshing the catalog."""
+    _add_archives_root_argument(parser)
+    parser.add_argument(
+        '--scan',
+        action='store_true',
+        default=False,
+        help=(
+            'Also read new or changed results archives to count the rows of their metadata files '
+            '(and, for results archives without indexes, to find their EcoTaxa export archives)'
+        ),
+    )
+    parser.set_defaults(func=lambda args: refresh_datasets(
+        _connect(args), args.archives_root, scan=args.scan, verbose=args.verbose,
+    ))
+
+def refresh_datasets(connection, archives_root, scan=False, verbose=False):
+    """Refresh the catalog from the archives root, and report what changed."""
+    start_time = time.perf_counter()
+    changed = refresh.refresh_catalog(connection, archives_root, scan=scan, verbose=verbose)
+    if verbose:
+        for change, acq_ids in changed.items():
+            for acq_id in acq_ids:
+                print(f'{change.capitalize()} {acq_id}')
+    print(
+        f'Added {len(changed["added"])}, updated {len(changed["updated"])}, and removed '
+        f'{len(changed["removed"])} datasets in {time.perf_counter() - start_time:.2f} s',
+    )
+
+# list subcommand
+
+def setup_list_parser(parser):
+    """Set up a (sub)parser for listing the datasets in the catalog."""
+    _add_archives_root_argument(parser)
+    parser.add_argument(
+        '--status',
+        type=str,
+        choices=_statuses,
+        default='all',
+        help='Only list datasets with the specified processing status',
+    )
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        default=False,
+        help='Refresh the catalog (without scanning results archives) before listing datasets',
+    )
+    parser.add_argument(
+        '--ids',
+        action='store_true',
+        default=False,
+        help='Only print the acquisition IDs of the datasets',
+    )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=None,
+        help='Maximum number of datasets to list',
+    )
+    parser.set_defaults(func=lambda args: list_datasets(
+        _connect(args), args.archives_root, status=args.status, refresh_first=args.refresh,
+        ids_only=args.ids, limit=args.limit,
+    ))
+
+def list_datasets(
+    connection, archives_root, status='all', refresh_first=False, ids_only=False, limit=None,
+):
+    """Print the cataloged datasets with the status, in natural order of their acquisition IDs."""
+    if refresh_first:
+        refresh.refresh_catalog(connection, archives_root)
+    entries = [
+        entry for entry in store.load_entries(connection)
+        if status == 'all' or store.status(entry) == status
+    ]
+    if limit is not None:
+        entries = entries[:limit]
+    for entry in entries:
+        if ids_only:
+            print(entry['acq_id'])
+            continue
+        print('\t'.join([
+            entry['acq_id'],
+            store.status(entry),
+            _format_count(entry['objects'], 'objects'),
+            _format_count(entry['metadata_rows'], 'metadata rows'),
+        ]))
+
+def _format_count(count, noun):
+    """Format a count of things, which is unknown if it's None."""
+    return f'? {noun}' if count is None else f'{count} {noun}'
+
+# show subcommand
+
+def setup_show_parser(parser):
+    """Set up a (sub)parser for showing the catalog entry of a dataset."""
+    _add_archives_root_argument(parser)
+    parser.add_argument(
+        'acq_id',
+        type=str,
+        help='tots-ps acquisition ID of the dataset',
+    )
+    parser.set_defaults(func=lambda args: show_dataset(_connect(args), args.acq_id))
+
+def show_dataset(connection, acq_id):
+    """Print the catalog entry of the dataset."""
+    entry = store.load_entry(connection, acq_id)
+    if entry is None:
+        sys.exit(f'{acq_id} is not in the catalog')
+    print(f'status: {store.status(entry)}')
+    for column in store.columns[1:]:
+        print(f'{column}: {"" if entry[column] is None else entry[column]}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Incremental refreshing of the catalog of datasets from the archives on the archive drive"""
+
+import os
+import pathlib
+import tarfile
+
+from .. import archive
+from .. import metadata
+from .. import tarindex
+from ..export_metadata import results
+from ..pack_results import results as pack_results
+from . import store
+
+count_suffix = '-results-count.txt'
+
+# Entry fields which are only recomputed when a results archive (or its sidecar files) changes
+_results_fields = [
+    'objects', 'metadata_rows', 'export_member', 'export_offset', 'export_size', 'scanned',
+]
+
+def refresh_catalog(connection, archives_root, scan=False, verbose=False):
+    """Update the catalog with the archives currently in the archives root.
+
+    Only the archives root is listed and the archives are stat'd; the details of a results archive
+    (its object count and the location of its EcoTaxa export archive) are only recomputed if the
+    size or modification time of the results archive, of its index, or of its object count file
+    changed since the catalog was last refreshed. If scan is set, results archives which haven't
+    been scanned yet are also read to count the rows of their metadata files (and, for results
+    archives without an index, to find their EcoTaxa export archives and count their objects).
+
+    Returns a dict with the lists of acquisition IDs which were added, updated, and removed.
+    """
+    archives_root = pathlib.Path(archives_root)
+    previous = {entry['acq_id']: entry for entry in store.load_entries(connection)}
+    current = {}
+    sidecars = {}
+    with os.scandir(archives_root) as dir_entries:
+        for dir_entry in dir_entries:
+            if dir_entry.name.endswith(tarindex.index_suffix) or dir_entry.name.endswith(
+                count_suffix,
+            ):
+                sidecars[dir_entry.name] = dir_entry
+                continue
+            parsed = store.parse_archive_name(dir_entry.name)
+            if parsed is None or not dir_entry.is_file():
+                continue
+            acq_id, is_results = parsed
+            stat = dir_entry.stat()
+            entry = current.setdefault(acq_id, dict.fromkeys(store.columns))
+            entry['acq_id'] = acq_id
+            prefix = 'results' if is_results else 'raw'
+            entry[f'{prefix}_name'] = dir_entry.name
+            entry[f'{prefix}_size'] = stat.st_size
+            entry[f'{prefix}_mtime_ns'] = stat.st_mtime_ns
+
+    changed = {'added': [], 'updated': [], 'removed': []}
+    for acq_id, entry in current.items():
+        if entry['results_name'] is not None:
+            entry['index_mtime_ns'] = _sidecar_mtime_ns(
+                sidecars, f'{entry["results_name"]}{tarindex.index_suffix}',
+            )
+            entry['count_mtime_ns'] = _sidecar_mtime_ns(sidecars, f'{acq_id}{count_suffix}')
+        old_entry = previous.get(acq_id)
+        if old_entry is not None and _same_results(old_entry, entry) and (
+            old_entry['scanned'] or not scan or entry['results_name'] is None
+        ):
+            for field in _results_fields:
+                entry[field] = old_entry[field]
+        elif entry['results_name'] is not None:
+            if verbose:
+                print(f'Examining {entry["results_name"]}...')
+            entry.update(_examine_results(archives_root, entry, scan=scan))
+        if old_entry is None:
+            changed['added'].append(acq_id)
+        elif any(entry[field] != old_entry[field] for field in store.columns[:-1]):
+            changed['updated'].append(acq_id)
+    changed['removed'] = [acq_id for acq_id in previous.keys() if acq_id not in current]
+
+    store.save_entries(
+        connection, [current[acq_id] for acq_id in changed['added'] + changed['updated']],
+    )
+    store.delete_entries(connection, changed['removed'])
+    return changed
+
+def _sidecar_mtime_ns(sidecars, name):
+    """Determine the modification time of a sidecar file in the archives root, if it exists."""
+    dir_entry = sidecars.get(name)
+    if dir_entry is None:
+        return None
+    try:
+        return dir_entry.stat().st_mtime_ns
+    except OSError:
+        return None
+
+def _same_results(old_entry, entry):
+    """Determine whether the results archive of a dataset and its sidecar files are unchanged."""
+    return all(old_entry[field] == entry[field] for field in [
+        'results_name', 'results_size', 'results_mtime_ns', 'index_mtime_ns', 'count_mtime_ns',
+    ])
+
+def _examine_results(archives_root, entry, scan=False):
+    """Determine the details of the dataset's results archive for its catalog entry.
+
+    Up-to-date indexes are used when available, so that results archives only need to be read when
+    scanning. Otherwise, the object count is taken from the object count file saved next to the
+    results archive, if it has one.
+    """
+    results_path = archives_root / entry['results_name']
+    details = dict.fromkeys(_results_fields)
+    details['scanned'] = 0
+    index = tarindex.load_index(results_path)
+    if index is None:
+        details['objects'] = _read_count(archives_root / f'{entry["acq_id"]}{count_suffix}')
+        if scan:
+            details.update(_scan_results(results_path))
+        return details
+
+    details['objects'] = index.get('objects')
+    if details['objects'] is None:
+        details['objects'] = sum(
+            1 for name in tarindex.member_names(index) if pack_results.is_object_image(name)
+        )
+    try:
+        export_member = results._identify_indexed_ecotaxa_export_file(index)
+    except ValueError:
+        return details
+    for name, offset, size in index['members']:
+        if name == export_member:
+            details.update(export_member=name, export_offset=offset, export_size=size)
+    if scan:
+        with (
+            open(results_path, 'rb') as results_archive,
+            results.open_ecotaxa_metadata(results_archive) as metadata_file,
+        ):
+            details['metadata_rows'] = _count_rows(metadata_file)
+        details['scanned'] = 1
+    return details
+
+def _scan_results(results_path):
+    """Read an unindexed results archive in a single pass to determine its details.
+
+    The EcoTaxa export archive is only recorded if the results archive has exactly one.
+    """
+    details = {'objects': 0, 'scanned': 1}
+    export_members = 0
+    with (
+        open(results_path, 'rb') as results_archive,
+        tarfile.open(fileobj=results_archive, mode='r|gz') as results_tar,
+    ):
+        for tarinfo in results_tar:
+            if not tarinfo.isreg():
+                continue
+            if pack_results.is_object_image(tarinfo.name):
+                details['objects'] += 1
+            if not results._is_ecotaxa_export_file(tarinfo):
+                continue
+            export_members += 1
+            details.update(
+                export_member=tarinfo.name, export_offset=tarinfo.offset_data,
+                export_size=tarinfo.size,
+            )
+            with (
+                results_tar.extractfile(tarinfo) as ecotaxa_archive,
+                archive.open_streamed_metadata_file(ecotaxa_archive) as metadata_file,
+            ):
+                details['metadata_rows'] = _count_rows(metadata_file)
+    if export_members != 1:
+        details.update(export_member=None, export_offset=None, export_size=None)
+        details['metadata_rows'] = None
+    return details
+
+def _read_count(count_path):
+    """Read the object count file of a results archive, or return None if it's missing or bad."""
+    try:
+        with open(count_path, 'r') as count_file:
+            return int(count_file.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def _count_rows(metadata_file):
+    """Count the data rows (i.e. objects) in a metadata file."""
+    _, _, data_rows = metadata.read_rows(metadata_file)
+    return sum(1 for _ in data_rows)
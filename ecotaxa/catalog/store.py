@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Storage of a catalog of the raw and results archives of datasets in a SQLite database"""
+
+import datetime
+import os
+import pathlib
+import re
+import sqlite3
+
+catalog_filename = '.tots-catalog.sqlite'
+
+# Raw datasets are archived as `{dataset}.tar.gz`, and their results as `{dataset}-results.tar.gz`
+_archive_pattern = re.compile(r'^(tots-ps-acq-.*?)(-results)?\.tar\.gz$', re.IGNORECASE)
+_natural_sort_pattern = re.compile(r'(\d+)')
+
+# Columns of the datasets table, besides the acquisition ID:
+_columns = {
+    'raw_name': 'TEXT',
+    'raw_size': 'INTEGER',
+    'raw_mtime_ns': 'INTEGER',
+    'results_name': 'TEXT',
+    'results_size': 'INTEGER',
+    'results_mtime_ns': 'INTEGER',
+    'index_mtime_ns': 'INTEGER', # of the results archive's index, if it had one
+    'count_mtime_ns': 'INTEGER', # of the results archive's object count file, if it had one
+    'objects': 'INTEGER',
+    'metadata_rows': 'INTEGER',
+    'export_member': 'TEXT',
+    'export_offset': 'INTEGER',
+    'export_size': 'INTEGER',
+    'scanned': 'INTEGER', # whether the results archive was read to count its metadata rows
+    'refreshed_at': 'TEXT',
+}
+columns = ['acq_id', *_columns.keys()]
+
+# Archive names
+
+def parse_archive_name(name):
+    """Determine the dataset of an archive file, and whether the archive holds its results.
+
+    Returns a (dataset, is_results) pair, or None if the file isn't an archive of a dataset.
+    """
+    match = _archive_pattern.match(name)
+    if match is None:
+        return None
+    return match.group(1), match.group(2) is not None
+
+def natural_sort_key(name):
+    """Make a key to sort names with their numbers in numerical order, like `ls -v`."""
+    return [
+        int(part) if i % 2 else part.lower()
+        for i, part in enumerate(_natural_sort_pattern.split(name))
+    ]
+
+def status(entry):
+    """Determine whether a cataloged dataset is 'processed' (i.e. it has a results archive)."""
+    return 'processed' if entry['results_name'] is not None else 'unprocessed'
+
+# Database
+
+def default_path(archives_root):
+    """Determine the default path of the catalog of the archives in the directory."""
+    return pathlib.Path(archives_root) / catalog_filename
+
+def connect(database_path, read_only=False):
+    """Open the SQLite database of the catalog, creating its table if needed.
+
+    A read-only connection can only be made to an existing catalog; sqlite3.OperationalError is
+    raised if it doesn't exist.
+    """
+    if read_only:
+        uri = pathlib.Path(os.path.abspath(database_path)).as_uri()
+        return sqlite3.connect(f'{uri}?mode=ro', uri=True)
+    connection = sqlite3.connect(database_path)
+    definitions = ['acq_id TEXT PRIMARY KEY']
+    definitions.extend(f'{column} {column_type}' for column, column_type in _columns.items())
+    with connection:
+        connection.execute(f'CREATE TABLE IF NOT EXISTS datasets ({", ".join(definitions)})')
+        # This index makes lookups of results archives by name (see lookup_export_member) fast
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS datasets_results_name ON datasets (results_name)',
+        )
+    return connection
+
+def load_entries(connection):
+    """Load the entries of all datasets in the catalog, as dicts in natural order of their IDs."""
+    rows = connection.execute(f'SELECT {", ".join(columns)} FROM datasets')
+    entries = [dict(zip(columns, row)) for row in rows]
+    return sorted(entries, key=lambda entry: natural_sort_key(entry['acq_id']))
+
+def load_entry(connection, acq_id):
+    """Load the entry of the dataset as a dict, or None if the dataset isn't in the catalog."""
+    row = connection.execute(
+        f'SELECT {", ".join(columns)} FROM datasets WHERE acq_id = ?', (acq_id,),
+    ).fetchone()
+    return None if row is None else dict(zip(columns, row))
+
+def save_entries(connection, entries):
+    """Insert or replace the entries of datasets in the catalog."""
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    with connection:
+        connection.executemany(
+            f'INSERT OR REPLACE INTO datasets ({", ".join(columns)}) '
+            f'VALUES ({", ".join("?" * len(columns))})',
+            [
+                [now if column == 'refreshed_at' else entry.get(column) for column in columns]
+                for entry in entries
+            ],
+        )
+
+def delete_entries(connection, acq_ids):
+    """Remove the datasets from the catalog."""
+    with connection:
+        connection.executemany(
+            'DELETE FROM datasets WHERE acq_id = ?', [(acq_id,) for acq_id in acq_ids],
+        )
+
+# Lookups by tools
+
+def lookup_export_member(results_path):
+    """Look up the EcoTaxa export archive of a results archive in the catalog next to it, if any.
+
+    The catalog is only consulted if it's at the default path in the results archive's directory,
+    and only if the results archive hasn't changed (in size or modification time) since it was
+    cataloged. Returns the path of the EcoTaxa export archive within the results archive, which the
+    catalog only records once it's known to be the only one; otherwise returns None.
+    """
+    if results_path is None:
+        return None
+    results_path = pathlib.Path(os.fsdecode(results_path))
+    database_path = default_path(results_path.parent)
+    try:
+        stat = os.stat(results_path)
+        if not database_path.exists():
+            return None
+        connection = connect(database_path, read_only=True)
+        try:
+            row = connection.execute(
+                'SELECT export_member FROM datasets '
+                'WHERE results_name = ? AND results_size = ? AND results_mtime_ns = ?',
+                (results_path.name, stat.st_size, stat.st_mtime_ns),
+            ).fetchone()
+        finally:
+            connection.close()
+    except (OSError, sqlite3.Error): # the catalog is only used to save time, so it's optional
+        return None
+    return None if row is None else row[0]
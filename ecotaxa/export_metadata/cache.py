@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Build cache for skipping EcoTaxa export archives whose inputs haven't changed"""
+
+import hashlib
+import importlib.metadata
+import json
+import os
+
+from .. import files
+
+# Increment this whenever a change to the tool changes its outputs for the same inputs:
+_cache_format = 2
+manifest_filename = '.ecotaxa-metadata-edit-cache.json'
+
+_hash_block_size = 1024 * 1024 # bytes
+
+def tool_version():
+    """Determine the version of the tool, for invalidating cached outputs made by other versions."""
+    try:
+        package_version = importlib.metadata.version('tots-planktoscope-analysis')
+    except importlib.metadata.PackageNotFoundError:
+        package_version = 'unknown'
+    return f'{package_version}+cache{_cache_format}'
+
+# Manifests
+
+def load_manifest(manifest_path):
+    """Load the manifest of cached outputs, as a dict associating dataset names to cache entries.
+
+    A missing or unreadable manifest is treated as an empty manifest.
+    """
+    try:
+        with open(manifest_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(manifest, dict):
+        return {}
+    return manifest
+
+def save_manifest(manifest, manifest_path):
+    """Atomically save the manifest of cached outputs."""
+    with files.atomic_output(manifest_path, mode='w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+def fingerprint_inputs(input_paths, entry=None):
+    """Fingerprint the input files, which should be provided as a dict associating names to paths.
+
+    Inputs are identified by their contents, but the hash of an input file is reused from the cache
+    entry (if provided) when the file's size and modification time are unchanged.
+    """
+    previous_inputs = (entry or {}).get('inputs', {})
+    return {
+        name: fingerprint_input(path, previous_inputs.get(name))
+        for name, path in input_paths.items()
+    }
+
+def make_entry(input_fingerprints, output_paths):
+    """Make a cache entry for the fingerprinted inputs and the resulting output files.
+
+    Output files should be provided as a dict associating names to paths. Outputs are identified by
+    their size and modification time.
+    """
+    return {
+        'key': _compute_key(input_fingerprints),
+        'inputs': input_fingerprints,
+        'outputs': {name: _stat_output(path) for name, path in output_paths.items()},
+    }
+
+def is_fresh(entry, input_fingerprints, output_paths):
+    """Check whether the cache entry is still valid for the fingerprinted inputs and the outputs."""
+    if entry is None or entry.get('key') != _compute_key(input_fingerprints):
+        return False
+    for name, path in output_paths.items():
+        if entry.get('outputs', {}).get(name) != _stat_output(path):
+            return False
+    return True
+
+def fingerprint_input(path, previous_fingerprint=None):
+    """Fingerprint an input file by its size, modification time, and SHA-256 hash.
+
+    The file is only hashed if its size or modification time differs from the previous fingerprint.
+    """
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if (
+        previous_fingerprint is not None
+        and previous_fingerprint.get('size') == fingerprint['size']
+        and previous_fingerprint.get('mtime_ns') == fingerprint['mtime_ns']
+        and 'sha256' in previous_fingerprint
+    ):
+        fingerprint['sha256'] = previous_fingerprint['sha256']
+        return fingerprint
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while block := file.read(_hash_block_size):
+            file_hash.update(block)
+    fingerprint['sha256'] = file_hash.hexdigest()
+    return fingerprint
+
+def _compute_key(input_fingerprints):
+    """Compute the cache key of a set of input files, from their hashes and the tool version."""
+    key = hashlib.sha256(tool_version().encode('utf-8'))
+    for name in sorted(input_fingerprints.keys()):
+        key.update(f'\0{name}\0{input_fingerprints[name]["sha256"]}'.encode('utf-8'))
+    return key.hexdigest()
+
+def _stat_output(path):
+    """Identify an output file by its size and modification time, or None if it doesn't exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
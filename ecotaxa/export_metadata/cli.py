@@ -4,15 +4,23 @@
 """Command line utility for editing metadata in EcoTaxa export archives"""
 
 import argparse
-import io
+import contextlib
 import json
 import math
 import os
 import pathlib
-import tempfile
+import sqlite3
+import sys
+import time
 
+from .. import batch
+from .. import files
+from .. import profiling
+from ..catalog import store as catalog_store
+from . import cache
 from . import ecotaxa
 from . import results
+from . import store
 
 def main():
     """Edit the metadata in the specified EcoTaxa export archive(s)."""
@@ -26,11 +34,24 @@ def main():
         default=False,
         help='Print additional information for troubleshooting',
     )
+    parser.add_argument(
+        '--profile',
+        type=str,
+        default=None,
+        help=(
+            'Path of a file to append JSON lines to, recording the time, I/O, and memory usage of '
+            'each stage of processing each dataset'
+        ),
+    )
     subparsers = parser.add_subparsers()
     setup_single_parser(subparsers.add_parser('single'))
     setup_batch_parser(subparsers.add_parser('batch'))
+    setup_audit_parser(subparsers.add_parser('audit'))
+    setup_import_changes_parser(subparsers.add_parser('import-changes'))
+    setup_query_changes_parser(subparsers.add_parser('query-changes'))
     args = parser.parse_args()
-    args.func(args)
+    with profiling.session(args.profile, tool=parser.prog):
+        args.func(args)
 
 # single subcommand
 
@@ -56,53 +77,144 @@ def setup_single_parser(parser):
         type=argparse.FileType(mode='w'),
         help='Path of JSON file to create listing the changes made',
     )
+    _add_memory_cap_argument(parser)
+    _add_changes_store_argument(parser)
     parser.set_defaults(func=lambda args: process_single_results_archive(
-        args.input, args.corrections, args.output, args.changes, verbose=args.verbose,
+        args.input, args.corrections, args.output, args.changes,
+        memory_cap=args.memory_cap, changes_store=args.changes_store, verbose=args.verbose,
     ))
 
+def _add_memory_cap_argument(parser):
+    """Add an argument to the (sub)parser for the memory cap of intermediate files."""
+    parser.add_argument(
+        '--memory-cap',
+        type=files.parse_size,
+        default=files.default_memory_cap,
+        help=(
+            'Maximum size (e.g. 256M) of intermediate files to keep in memory before spilling them '
+            'to disk; 0 keeps them on disk'
+        ),
+    )
+
+def _add_changes_store_argument(parser):
+    """Add an argument to the (sub)parser for a database to also record metadata changes in."""
+    parser.add_argument(
+        '--changes-store',
+        type=str,
+        default=None,
+        help=(
+            'Path of a SQLite database of metadata changes (created if it doesn\'t exist) to also '
+            'record the changes made in, for the query-changes subcommand'
+        ),
+    )
+
 def process_single_results_archive(
-    results_archive_file, corrections, ecotaxa_export_file, changes_file, verbose=False,
+    results_archive_file, corrections, ecotaxa_export_file, changes_file,
+    memory_cap=files.default_memory_cap, changes_store=None, verbose=False,
 ):
     """Extract the EcoTaxa export archive from the results archive, correcting metadata.
 
     The corrections dict specifies the values of metadata fields to correct in the EcoTaxa export
     archive; it can instead be provided as a file-like object containing a JSON string representing
-    the corrections dict.
+    the corrections dict. The corrections dict may also specify per-object overrides (see
+    ecotaxa.split_corrections), which are applied as the metadata file is streamed.
+
+    Intermediate files (the extracted EcoTaxa export archive and the rewritten metadata file) are
+    kept in memory unless they grow beyond the memory cap, in which case they're spilled to
+    temporary files on disk.
 
-    Changes made to the metadata are recorded as a JSON string in the changes file.
+    Changes made to the metadata are recorded as a JSON string in the changes file. If the path of
+    a database of metadata changes is provided, they're also recorded there, under the acquisition
+    ID in the name of the results archive (`{acquisition-id}-results.tar.gz`) or, failing that, in
+    the name of the changes file (`{acquisition-id}.json`).
     """
-    if isinstance(corrections, io.IOBase):
-        corrections = json.load(corrections)
+    corrections, object_overrides = _load_corrections(corrections, verbose=verbose)
     if verbose:
-        print('Corrections to make where needed:')
-        for field, value in corrections.items():
-            print(f'  - {field}: {value}')
-    with tempfile.TemporaryFile(prefix='tots-ps-', suffix='.zip') as ecotaxa_archive:
-        if verbose:
-            print(f'Loading results archive {results_archive_file.name}...')
-        results.extract_ecotaxa_export(results_archive_file, ecotaxa_archive, verbose=verbose)
+        print(f'Loading results archive {results_archive_file.name}...')
+    with results.open_ecotaxa_export(
+        results_archive_file, memory_cap=memory_cap, verbose=verbose,
+    ) as ecotaxa_archive:
         if verbose:
-            print(f'Extracted EcoTaxa export archive size: {_print_size(ecotaxa_archive.tell())}')
-        updated_fields = ecotaxa.update_metadata_file(
+            ecotaxa_archive.seek(0, os.SEEK_END)
+            print(f'EcoTaxa export archive size: {_print_size(ecotaxa_archive.tell())}')
+            ecotaxa_archive.seek(0)
+        updated_fields = ecotaxa.rewrite_metadata_file(
             ecotaxa_archive,
             ecotaxa_export_file,
-            lambda metadata_file: ecotaxa.rewrite_metadata(
-                metadata_file, corrections, verbose=verbose,
+            lambda input_metadata_file, output_metadata_file: ecotaxa.stream_rewrite_metadata(
+                input_metadata_file, output_metadata_file, corrections,
+                object_overrides=object_overrides, verbose=verbose,
             ),
+            memory_cap=memory_cap,
             verbose=verbose,
         )
-    changes = {}
-    for field, old_values in updated_fields.items():
-        changes[field] = {
-            'new_value': corrections[field],
-            'old_values': sorted(list(old_values)),
-        }
+    changes = _summarize_changes(corrections, updated_fields, verbose=verbose)
     if verbose:
-        print('Changes (with previous values):')
-        for field, field_changes in changes.items():
-            print(f'  - {field}: {", ".join(field_changes["old_values"])}')
         print(f'Recording changes to {changes_file.name}...')
     json.dump(changes, changes_file, indent=2)
+    if changes_store is not None:
+        acq_id = _identify_dataset(results_archive_file, changes_file)
+        if verbose:
+            print(f'Recording changes of {acq_id} to {changes_store}...')
+        with contextlib.closing(store.connect(changes_store)) as connection:
+            store.record_changes(connection, {acq_id: (changes, changes_file.name)})
+
+def _identify_dataset(results_archive_file, changes_file):
+    """Determine the acquisition ID of a dataset from the names of its results or changes files."""
+    parsed = catalog_store.parse_archive_name(os.path.basename(results_archive_file.name))
+    if parsed is not None and parsed[1]:
+        return parsed[0]
+    return pathlib.Path(changes_file.name).stem
+
+def _load_corrections(corrections, verbose=False):
+    """Load the corrections dict, if it's provided as a file-like object containing JSON.
+
+    Returns the field-wide corrections and the per-object overrides, as ecotaxa.load_corrections
+    does.
+    """
+    corrections, object_overrides = ecotaxa.load_corrections(corrections)
+    if verbose:
+        print('Corrections to make where needed:')
+        for field, value in corrections.items():
+            print(f'  - {field}: {value}')
+        if object_overrides is not None:
+            object_fields, object_index = object_overrides
+            print(
+                f'Per-object overrides for {len(object_index)} objects of fields: '
+                f'{", ".join(object_fields)}',
+            )
+    return corrections, object_overrides
+
+def _summarize_changes(corrections, updated_fields, verbose=False):
+    """Describe the changes made to metadata fields, with their new and previous values."""
+    changes = ecotaxa.describe_changes(corrections, updated_fields)
+    if verbose:
+        print('Changes (with previous values):')
+        for field, field_changes in changes.items():
+            print(
+                f'  - {field} ({field_changes["num_objects"]} objects): '
+                f'{", ".join(field_changes["old_values"])}',
+            )
+    return changes
+
+def _fingerprinted_input_paths(corrections_path, results_path):
+    """Determine the input files of a dataset whose contents determine its outputs.
+
+    These are the corrections file, the results archive, and the per-object overrides table (if
+    the corrections file refers to one).
+    """
+    input_paths = {'corrections': corrections_path, 'results': results_path}
+    try:
+        with open(corrections_path, 'r') as corrections_file:
+            corrections = json.load(corrections_file)
+    except ValueError:
+        return input_paths # the error will be reported when the corrections are applied
+    overrides_path = ecotaxa.object_overrides_path(
+        corrections, base_dir=os.path.dirname(corrections_path),
+    )
+    if overrides_path is not None:
+        input_paths['object_overrides'] = overrides_path
+    return input_paths
 
 def _print_size(size_bytes):
     """Nicely print the size of a file.
@@ -140,12 +252,45 @@ def setup_batch_parser(parser):
         type=str,
         help='Directory in which to create JSON files listing the metadata changes made',
     )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=batch.parse_jobs,
+        default=1,
+        help='Number of results archives to process in parallel (0 to use all CPU cores)',
+    )
+    parser.add_argument(
+        '-f', '--force',
+        action='store_true',
+        default=False,
+        help='Reprocess all results archives, even if their inputs haven\'t changed since last run',
+    )
+    _add_memory_cap_argument(parser)
+    _add_changes_store_argument(parser)
+    _add_datasets_argument(parser)
     parser.set_defaults(func=lambda args: process_all_results_archives(
-        args.input, args.corrections, args.output, args.changes, verbose=args.verbose,
+        args.input, args.corrections, args.output, args.changes,
+        jobs=args.jobs, force=args.force, memory_cap=args.memory_cap,
+        acq_ids=None if args.datasets is None else batch.read_dataset_list(args.datasets),
+        changes_store=args.changes_store, verbose=args.verbose,
     ))
 
+def _add_datasets_argument(parser):
+    """Add an argument to the (sub)parser for a list of datasets to process."""
+    parser.add_argument(
+        '-d', '--datasets',
+        type=argparse.FileType(mode='r'),
+        default=None,
+        help=(
+            'Path of a text file listing the acquisition IDs (one per line) of the datasets to '
+            'process, instead of all datasets with corrections files; use - to read the list from '
+            'stdin'
+        ),
+    )
+
 def process_all_results_archives(
-    results_dir, corrections_dir, ecotaxa_export_dir, changes_dir, verbose=False,
+    results_dir, corrections_dir, ecotaxa_export_dir, changes_dir,
+    jobs=1, force=False, memory_cap=files.default_memory_cap, acq_ids=None, changes_store=None,
+    verbose=False,
 ):
     """Extract EcoTaxa export archives from the results archives, correcting metadata.
 
@@ -159,9 +304,77 @@ def process_all_results_archives(
     name of each archive will be `{acquisition-id}-export.zip`.
 
     The metadata changes made for each EcoTaxa export archive according to metadata corrections will
-    be saved to the changes directory. The name of each file will be `{acquisition-id}.json`.
+    be saved to the changes directory. The name of each file will be `{acquisition-id}.json`. If
+    the path of a database of metadata changes is provided, the changes of each processed dataset
+    are also recorded there as soon as the dataset is done.
+
+    If a list of acquisition IDs is provided, only those datasets are processed.
+
+    Up to the specified number of jobs will process results archives in parallel. A failure with one
+    results archive doesn't prevent the other results archives from being processed; instead, a
+    summary of the results for all results archives is printed at the end.
+
+    A manifest of the hashes of the inputs used to make each EcoTaxa export archive is kept in the
+    export directory, so that results archives are skipped if neither they nor their corrections
+    files have changed since their outputs were made (unless processing is forced). Outputs are
+    written atomically, so an interrupted batch can simply be re-run to resume it.
     """
-    for corrections_path in os.listdir(corrections_dir):
+    manifest_path = pathlib.Path(ecotaxa_export_dir).joinpath(cache.manifest_filename)
+    manifest = cache.load_manifest(manifest_path)
+    tasks = []
+    for acq_id, corrections_path in _find_corrections_files(
+        corrections_dir, acq_ids=acq_ids, verbose=verbose,
+    ):
+        tasks.append((acq_id, _process_dataset, (
+            corrections_path,
+            pathlib.Path(results_dir).joinpath(acq_id + '-results.tar.gz'),
+            pathlib.Path(ecotaxa_export_dir).joinpath(acq_id + '-export.zip'),
+            pathlib.Path(changes_dir).joinpath(acq_id + '.json'),
+        ), {
+            'cache_entry': None if force else manifest.get(acq_id),
+            'memory_cap': memory_cap,
+            'verbose': verbose,
+        }))
+
+    connection = None if changes_store is None else store.connect(changes_store)
+
+    def record_result(result):
+        if result['data'] is None:
+            return
+        manifest[result['dataset']] = result['data']
+        cache.save_manifest(manifest, manifest_path)
+        if connection is not None and result['status'] == 'done':
+            changes_path = pathlib.Path(changes_dir).joinpath(result['dataset'] + '.json')
+            with open(changes_path, 'r') as changes_file:
+                changes = json.load(changes_file)
+            store.record_changes(connection, {result['dataset']: (changes, changes_path)})
+
+    start_time = time.perf_counter()
+    try:
+        task_results = batch.run_tasks(tasks, jobs=jobs, on_result=record_result)
+    finally:
+        if connection is not None:
+            connection.close()
+    batch.print_summary(task_results, wall_time=time.perf_counter() - start_time)
+
+def _find_corrections_files(corrections_dir, acq_ids=None, verbose=False):
+    """List the acquisition IDs and paths of the metadata corrections files in the directory.
+
+    If a list of acquisition IDs is provided, only the corrections files for those acquisitions are
+    listed, in the same order.
+    """
+    if acq_ids is not None:
+        corrections_files = []
+        for acq_id in acq_ids:
+            corrections_path = pathlib.Path(corrections_dir).joinpath(acq_id + '.json')
+            if not corrections_path.is_file():
+                print(f'Skipping dataset {acq_id} because it has no corrections file!')
+                continue
+            corrections_files.append((acq_id, corrections_path))
+        return corrections_files
+
+    corrections_files = []
+    for corrections_path in sorted(os.listdir(corrections_dir)):
         corrections_path = pathlib.Path(corrections_dir).joinpath(corrections_path)
         if not corrections_path.suffix == '.json':
             if verbose:
@@ -169,25 +382,262 @@ def process_all_results_archives(
                     f'Skipping corrections file {corrections_path} because it\'s not a JSON file!',
                 )
             continue
-        acq_id = corrections_path.stem
-        results_path = pathlib.Path(results_dir).joinpath(acq_id + '-results.tar.gz')
-        try:
+        corrections_files.append((corrections_path.stem, corrections_path))
+    return corrections_files
+
+def _process_dataset(
+    corrections_path, results_path, export_path, changes_path,
+    cache_entry=None, memory_cap=files.default_memory_cap, verbose=False,
+):
+    """Process the results archive of a single dataset in a batch.
+
+    If the cache entry shows that the outputs are up-to-date with the inputs, nothing is processed.
+
+    Returns a (status, message, cache entry) triple for batch.run_tasks.
+    """
+    output_paths = {'export': export_path, 'changes': changes_path}
+    try:
+        input_paths = _fingerprinted_input_paths(corrections_path, results_path)
+        input_fingerprints = cache.fingerprint_inputs(input_paths, cache_entry)
+        if cache.is_fresh(cache_entry, input_fingerprints, output_paths):
+            return ('skipped', 'up-to-date with results archive and corrections', cache_entry)
+        with (
+            open(corrections_path, 'r') as corrections_file,
+            open(results_path, 'rb') as results_file,
+        ):
             with (
-                open(corrections_path, 'r') as corrections_file,
-                open(results_path, 'rb') as results_file,
+                files.atomic_output(export_path, mode='wb') as export_file,
+                files.atomic_output(changes_path, mode='w') as changes_file,
             ):
-                export_path = pathlib.Path(ecotaxa_export_dir).joinpath(acq_id + '-export.zip')
-                changes_path = pathlib.Path(changes_dir).joinpath(acq_id + '.json')
-                with (
-                    open(export_path, 'wb') as export_file,
-                    open(changes_path, 'w') as changes_file,
-                ):
-                    process_single_results_archive(
-                        results_file, corrections_file, export_file, changes_file, verbose=verbose,
-                    )
-        except OSError as e:
-            print(f'Skipped {acq_id} due to an unopenable file (e.g. missing results archive): {e}')
-        print()
+                process_single_results_archive(
+                    results_file, corrections_file, export_file, changes_file,
+                    memory_cap=memory_cap, verbose=verbose,
+                )
+    except OSError as e:
+        return ('skipped', f'unopenable file (e.g. missing results archive): {e}', None)
+    return ('done', '', cache.make_entry(input_fingerprints, output_paths))
+
+# audit subcommand
+
+def setup_audit_parser(parser):
+    """Set up a (sub)parser for determining metadata changes without making them."""
+    parser.add_argument(
+        'input',
+        type=str,
+        help='Directory of results archives, ending in `-results.tar.gz`',
+    )
+    parser.add_argument(
+        'corrections',
+        type=str,
+        help='Directory of EcoTaxa metadata corrections JSON files',
+    )
+    parser.add_argument(
+        'report',
+        type=str,
+        help='Path of a JSON file to create listing the metadata changes needed for all datasets',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=batch.parse_jobs,
+        default=1,
+        help='Number of results archives to audit in parallel (0 to use all CPU cores)',
+    )
+    _add_datasets_argument(parser)
+    parser.set_defaults(func=lambda args: audit_all_results_archives(
+        args.input, args.corrections, args.report, jobs=args.jobs,
+        acq_ids=None if args.datasets is None else batch.read_dataset_list(args.datasets),
+        verbose=args.verbose,
+    ))
+
+def audit_all_results_archives(
+    results_dir, corrections_dir, report_path, jobs=1, acq_ids=None, verbose=False,
+):
+    """Determine the metadata changes which the corrections would make, without making them.
+
+    The results archives and corrections files should be provided in the same way as for
+    process_all_results_archives, optionally with a list of acquisition IDs to audit. Only the
+    metadata file of each EcoTaxa export archive is read (without extracting the EcoTaxa export
+    archive or decompressing any of its images), and no EcoTaxa export archives are written; this
+    is much faster if the results archives have indexes (see the results-archive-index command),
+    since then only a small part of each results archive needs to be decompressed.
+
+    The changes for all datasets are saved together to the report file, as a JSON object
+    associating each acquisition ID with the changes (in the same format as the changes files made
+    by process_all_results_archives) which would be made to its EcoTaxa export archive.
+    """
+    tasks = []
+    for acq_id, corrections_path in _find_corrections_files(
+        corrections_dir, acq_ids=acq_ids, verbose=verbose,
+    ):
+        tasks.append((acq_id, _audit_dataset, (
+            corrections_path,
+            pathlib.Path(results_dir).joinpath(acq_id + '-results.tar.gz'),
+        ), {'verbose': verbose}))
+
+    start_time = time.perf_counter()
+    task_results = batch.run_tasks(tasks, jobs=jobs)
+    report = {
+        result['dataset']: result['data']
+        for result in sorted(task_results, key=lambda result: result['dataset'])
+        if result['data'] is not None
+    }
+    with files.atomic_output(report_path, mode='w') as report_file:
+        json.dump(report, report_file, indent=2)
+    batch.print_summary(task_results, wall_time=time.perf_counter() - start_time)
+    print(f'Recorded changes for {len(report)} datasets to {report_path}')
+
+def audit_single_results_archive(results_archive_file, corrections, verbose=False):
+    """Determine the metadata changes which the corrections would make to the results archive.
+
+    The corrections are provided in the same way as for process_single_results_archive. Returns
+    the changes which would be made, in the same format as the changes file written by
+    process_single_results_archive.
+    """
+    corrections, object_overrides = _load_corrections(corrections, verbose=verbose)
+    if verbose:
+        print(f'Loading results archive {results_archive_file.name}...')
+    with (
+        profiling.stage('rewrite_metadata'),
+        results.open_ecotaxa_metadata(results_archive_file, verbose=verbose) as metadata_file,
+    ):
+        updated_fields = ecotaxa.stream_rewrite_metadata(
+            metadata_file, None, corrections, object_overrides=object_overrides, verbose=verbose,
+        )
+    return _summarize_changes(corrections, updated_fields, verbose=verbose)
+
+def _audit_dataset(corrections_path, results_path, verbose=False):
+    """Audit the results archive of a single dataset in a batch.
+
+    Returns a (status, message, changes) triple for batch.run_tasks.
+    """
+    try:
+        with (
+            open(corrections_path, 'r') as corrections_file,
+            open(results_path, 'rb') as results_file,
+        ):
+            changes = audit_single_results_archive(results_file, corrections_file, verbose=verbose)
+    except OSError as e:
+        return ('skipped', f'unopenable file (e.g. missing results archive): {e}', None)
+    message = f'would change {len(changes)} fields' if changes else 'no changes needed'
+    return ('done', message, changes)
+
+# import-changes subcommand
+
+def setup_import_changes_parser(parser):
+    """Set up a (sub)parser to import changes files into a database of metadata changes."""
+    parser.add_argument(
+        'database',
+        type=str,
+        help='Path of the SQLite database of metadata changes (created if it doesn\'t exist)',
+    )
+    parser.add_argument(
+        'changes',
+        type=str,
+        help='Directory of JSON files listing the metadata changes made, e.g. by `batch`',
+    )
+    parser.set_defaults(func=lambda args: import_changes_files(
+        args.database, args.changes, verbose=args.verbose,
+    ))
+
+def import_changes_files(database_path, changes_dir, verbose=False):
+    """Import the changes files in the directory into the database of metadata changes.
+
+    The name of each changes file should be `{acquisition-id}.json`, as for the changes files made
+    by process_all_results_archives. Files which aren't valid JSON (e.g. empty files left by a
+    failed run) are skipped. All changes files are imported in a single transaction, replacing any
+    previously-recorded changes of the same datasets.
+    """
+    dataset_changes = {}
+    for changes_path in sorted(pathlib.Path(changes_dir).glob('*.json')):
+        try:
+            with open(changes_path, 'r') as changes_file:
+                changes = json.load(changes_file)
+        except ValueError as e:
+            print(f'Skipping changes file {changes_path} because it\'s not valid JSON: {e}')
+            continue
+        dataset_changes[changes_path.stem] = (changes, changes_path)
+    with contextlib.closing(store.connect(database_path)) as connection:
+        store.record_changes(connection, dataset_changes, verbose=verbose)
+    print(f'Imported the changes of {len(dataset_changes)} datasets into {database_path}')
+
+# query-changes subcommand
+
+def setup_query_changes_parser(parser):
+    """Set up a (sub)parser to find metadata changes in a database of metadata changes."""
+    parser.add_argument(
+        'database',
+        type=str,
+        help='Path of the SQLite database of metadata changes',
+    )
+    parser.add_argument(
+        '--field',
+        type=str,
+        default=None,
+        help='Only find changes to the metadata field (e.g. object_lat)',
+    )
+    parser.add_argument(
+        '--value',
+        type=str,
+        default=None,
+        help='Only find changes which set or replaced the value (e.g. -90.0000)',
+    )
+    parser.add_argument(
+        '--match',
+        type=str,
+        choices=['any', 'new', 'old'],
+        default='any',
+        help='Whether the value given by --value must be a new value, an old value, or either',
+    )
+    parser.add_argument(
+        '--dataset',
+        type=str,
+        default=None,
+        help='Only find changes to the dataset with the acquisition ID',
+    )
+    parser.add_argument(
+        '--ids',
+        action='store_true',
+        default=False,
+        help=(
+            'Only print the acquisition IDs of the datasets with matching changes, e.g. for the '
+            '--datasets option of the batch subcommand'
+        ),
+    )
+    parser.set_defaults(func=lambda args: query_changes(
+        args.database, field=args.field, value=args.value, match=args.match,
+        acq_id=args.dataset, ids_only=args.ids,
+    ))
+
+def query_changes(
+    database_path, field=None, value=None, match='any', acq_id=None, ids_only=False,
+):
+    """Print the recorded metadata changes matching the filters, one change per line.
+
+    The database is only read, so a database which doesn't exist is reported as an error instead of
+    being created.
+    """
+    try:
+        with contextlib.closing(store.connect(database_path, read_only=True)) as connection:
+            changes = store.query_changes(
+                connection, field=field, value=value, match=match, acq_id=acq_id,
+            )
+    except sqlite3.Error as e:
+        sys.exit(f'Error: couldn\'t read the database of metadata changes at {database_path}: {e}')
+    if ids_only:
+        for changed_acq_id in dict.fromkeys(change['acq_id'] for change in changes):
+            print(changed_acq_id)
+        return
+    for change in changes:
+        new_values = [] if change['new_value'] is None else [change['new_value']]
+        if change['object_new_values']:
+            new_values.append(f'{len(change["object_new_values"])} per-object values')
+        print('\t'.join([
+            change['acq_id'],
+            change['field'],
+            ', '.join(change['old_values']),
+            '->',
+            ', '.join(new_values),
+        ]))
 
 if __name__ == '__main__':
     main()
@@ -1,29 +1,52 @@
 # -*- coding: utf-8 -*-
 """Handling of PlanktoScope ecotaxa export files"""
 
-import collections
 import csv
-import tempfile
+import io
+import json
+import os
 import zipfile
 
 from .. import archive
+from .. import files
 from .. import metadata
+from .. import profiling
 
 # EcoTaxa export archives
 
-def update_metadata_file(input_export_archive, output_export_archive, updater, verbose=False):
-    """Update the metadata file of an input EcoTaxa export archive with an updater function.
+def rewrite_metadata_file(
+    input_export_archive, output_export_archive, rewriter,
+    memory_cap=files.default_memory_cap, verbose=False,
+):
+    """Rewrite the metadata file of an input EcoTaxa export archive with a rewriter function.
 
     The result is written to the output archive.
 
-    The updater function must take one positional argument specifying a file object to the metadata
-    file. If it returns a result, that result is passed back up."""
-    with tempfile.TemporaryFile(
-        mode='w+', prefix='tots-ps-ecotaxa-metadata', suffix='.tsv',
+    The rewriter function must take two positional arguments specifying a file object to read the
+    original metadata file from and a file object to write the rewritten metadata file to; the
+    original metadata file is streamed directly out of the input archive, and the rewritten metadata
+    file is kept in memory unless it grows beyond the memory cap. If the rewriter function returns
+    a result, that result is passed back up."""
+    with files.spooled_temporary_file(
+        memory_cap=memory_cap, mode='w+', encoding='utf-8', newline='',
+        prefix='tots-ps-ecotaxa-metadata', suffix='.tsv',
     ) as metadata_file:
-        archive.extract_metadata_file(input_export_archive, metadata_file)
-        metadata_file.seek(0)
-        result = updater(metadata_file)
+        with (
+            profiling.stage('rewrite_metadata') as stage,
+            zipfile.ZipFile(input_export_archive, mode='r') as input_zip,
+            archive.open_metadata_file(input_zip) as input_metadata_file,
+        ):
+            result = rewriter(input_metadata_file, metadata_file)
+            if stage:
+                stage.add(
+                    bytes_read=input_zip.getinfo('ecotaxa_export.tsv').file_size,
+                    bytes_written=metadata_file.tell(),
+                )
+        if verbose:
+            print(
+                f'Wrote {files.spilled_size(metadata_file, memory_cap):,} bytes of the rewritten '
+                'metadata file to temporary storage',
+            )
         metadata_file.seek(0)
         if verbose:
             print(f'Writing updated EcoTaxa export archive to {output_export_archive.name}...')
@@ -35,42 +58,237 @@ def _replace_metadata_file(input_export_archive, output_export_archive, replacem
 
     The result is written to the output export file.
 
+    All other members of the input export file are copied over without being decompressed and
+    recompressed, so only the replacement file needs to be compressed.
+
     The cursor of the replacement file must be at the appropriate location before the function is
     called, and it is left at the end of the file when the function returns.
     """
-    with (
-        zipfile.ZipFile(input_export_archive, mode='r') as input_zip,
-        zipfile.ZipFile(output_export_archive, mode='w') as output_zip,
-    ):
-        for zipinfo in input_zip.infolist():
-            if zipinfo.filename == 'ecotaxa_export.tsv':
-                continue
-            output_zip.writestr(zipinfo, input_zip.read(zipinfo))
-        output_zip.writestr('ecotaxa_export.tsv', replacement_file.read())
-
-# EcoTaxa metadata tables
-
-def rewrite_metadata(metadata_file, overrides, verbose=False):
-    """Rewrite columns of the EcoTaxa object metadata TSV file based on the dict of overrides.
-
-    The cursor of the table file must be at the appropriate location before the function is called,
-    and it is left at the end of the file."""
-    field_types, data_rows = metadata.read_file(metadata_file)
-    if verbose:
-        print(f'Number of objects: {len(data_rows)}')
-    updated_fields = _rewrite_row_fields(data_rows, overrides)
-    metadata_file.seek(0)
-    metadata_file.truncate()
-    metadata.write_file(metadata_file, field_types, data_rows)
-    return updated_fields
-
-def _rewrite_row_fields(data_rows, overrides):
-    """Update the values of certain fields of each row based on the dict of overrides."""
-    updated_columns = collections.defaultdict(set)
+    with profiling.stage('write_archive') as stage:
+        with (
+            zipfile.ZipFile(input_export_archive, mode='r') as input_zip,
+            zipfile.ZipFile(output_export_archive, mode='w') as output_zip,
+        ):
+            metadata_compress_type = zipfile.ZIP_DEFLATED
+            for zipinfo in input_zip.infolist():
+                if zipinfo.filename == 'ecotaxa_export.tsv':
+                    metadata_compress_type = zipinfo.compress_type
+                    continue
+                archive.copy_member(input_zip, zipinfo, output_zip)
+            archive.write_metadata_file(
+                output_zip, replacement_file, compress_type=metadata_compress_type,
+            )
+        if stage:
+            stage.add(
+                bytes_read=profiling.file_size(input_export_archive),
+                bytes_written=profiling.file_size(output_export_archive),
+            )
+
+# Per-object overrides
+
+object_overrides_key = 'object_overrides'
+
+def split_corrections(corrections, base_dir=None):
+    """Separate the per-object overrides from the field-wide corrections of a corrections dict.
+
+    In addition to field names associated with corrected values for all objects, a corrections dict
+    may have an `object_overrides` key with per-object overrides of field values (see
+    load_object_overrides), which take precedence over the field-wide corrections. A relative path
+    of an overrides table is resolved relative to the base directory (e.g. the directory of the
+    corrections file).
+
+    Returns the dict of field-wide corrections, and the loaded per-object overrides (or None).
+    """
+    corrections = dict(corrections)
+    object_overrides = corrections.pop(object_overrides_key, None)
+    if object_overrides is not None:
+        object_overrides = load_object_overrides(object_overrides, base_dir=base_dir)
+    return corrections, object_overrides
+
+def load_corrections(corrections):
+    """Load a corrections dict and separate its per-object overrides, as split_corrections does.
+
+    The corrections dict can instead be provided as a file-like object containing a JSON string
+    representing the corrections dict; then a relative path of a per-object overrides table is
+    resolved relative to the directory of the corrections file.
+    """
+    base_dir = None
+    if isinstance(corrections, io.IOBase):
+        base_dir = os.path.dirname(getattr(corrections, 'name', ''))
+        corrections = json.load(corrections)
+    return split_corrections(corrections, base_dir=base_dir)
+
+def object_overrides_path(corrections, base_dir=None):
+    """Determine the path of the per-object overrides table of a corrections dict, if it has one."""
+    object_overrides = corrections.get(object_overrides_key)
+    if not isinstance(object_overrides, str):
+        return None
+    return os.path.join(base_dir or '', object_overrides)
+
+def load_object_overrides(object_overrides, base_dir=None):
+    """Load per-object overrides of metadata field values into a hash index by object ID.
+
+    The overrides can be provided as a dict associating object IDs with dicts of field names and
+    overridden values. Alternatively, they can be provided as the path of a TSV file (relative to
+    the base directory, if provided) with an `object_id` column and a column for each overridden
+    field; empty values in the table mean that the field isn't overridden for that object.
+
+    Returns a tuple of the overridden field names, and a dict associating each object ID with a
+    tuple of its overridden values (in the order of the field names, with None for fields which
+    aren't overridden for the object).
+    """
+    if isinstance(object_overrides, str):
+        with open(os.path.join(base_dir or '', object_overrides), 'r', newline='') as table_file:
+            reader = csv.reader(table_file, **_overrides_tsv_format)
+            header = next(reader, [])
+            try:
+                id_column = header.index('object_id')
+            except ValueError as e:
+                raise KeyError('object_id') from e
+            fields = tuple(field for i, field in enumerate(header) if i != id_column)
+            index = {}
+            for row in reader:
+                if not row:
+                    continue
+                row.extend([''] * (len(header) - len(row)))
+                object_id = row[id_column]
+                if object_id in index:
+                    raise KeyError(f'Duplicate object_id {object_id} found!')
+                index[object_id] = tuple(
+                    value if value != '' else None
+                    for i, value in enumerate(row) if i != id_column
+                )
+        return fields, index
+
+    fields = tuple(sorted({
+        field for object_fields in object_overrides.values() for field in object_fields.keys()
+    }))
+    index = {
+        object_id: tuple(object_fields.get(field) for field in fields)
+        for object_id, object_fields in object_overrides.items()
+    }
+    return fields, index
+
+_overrides_tsv_format = {
+    'dialect': 'unix',
+    'delimiter': '\t',
+    'quoting': csv.QUOTE_MINIMAL,
+}
+
+# Streaming rewrites
+
+def describe_changes(overrides, updated_fields):
+    """Describe the changes made to metadata fields by rewriting them based on the overrides.
+
+    The updated fields should be provided as a dict associating each updated field with a dict of
+    its changes, as returned by stream_rewrite_metadata. Returns a dict associating each updated
+    field with a dict of its field-wide new value (if it has one), a sorted list of its per-object
+    new values (if it has any), a sorted list of its old values, and the number of objects changed.
+    """
+    changes = {}
+    for field, field_changes in updated_fields.items():
+        changes[field] = {}
+        if field in overrides:
+            changes[field]['new_value'] = overrides[field]
+        if field_changes['object_new_values']:
+            changes[field]['object_new_values'] = sorted(field_changes['object_new_values'])
+        changes[field]['old_values'] = sorted(list(field_changes['old_values']))
+        changes[field]['num_objects'] = field_changes['num_objects']
+    return changes
+
+def stream_rewrite_metadata(
+    input_metadata_file, output_metadata_file, overrides, object_overrides=None, verbose=False,
+):
+    """Stream the EcoTaxa object metadata TSV file, rewriting its columns based on the overrides.
+
+    Per-object overrides, as loaded by load_object_overrides, may also be provided; they're looked
+    up by the object ID of each row as it's streamed, and they take precedence over the field-wide
+    overrides.
+
+    Rows are read, rewritten, and written one at a time, so memory usage doesn't depend on the
+    number of objects. Returns a dict associating each updated field with a dict of its changes:
+    the set of its 'old_values', the set of its 'object_new_values' from per-object overrides, and
+    the number of objects changed ('num_objects'). If the output table file is None, the rewritten
+    rows are discarded instead of being written, so that the changes can be determined without
+    making them.
+
+    The cursors of the table files must be at the appropriate locations before the function is
+    called, and they are left at the ends of the files."""
+    field_names, field_types, data_rows = metadata.read_rows(input_metadata_file)
+
+    def find_column(field):
+        try:
+            return field_names.index(field)
+        except ValueError as e:
+            raise KeyError(field) from e
+
+    column_changes = {}
+    def track_column(column):
+        return column_changes.setdefault(
+            column, {'old_values': set(), 'object_new_values': set(), 'num_objects': 0},
+        )
+
+    override_columns = [
+        (column, value, track_column(column))
+        for column, value in ((find_column(field), value) for field, value in overrides.items())
+    ]
+    object_fields, object_index = object_overrides or ((), {})
+    object_columns = [(column, track_column(column)) for column in map(find_column, object_fields)]
+    id_column = find_column('object_id') if object_index else None
+
+    num_fields = len(field_names)
+    writer = None
+    if output_metadata_file is not None:
+        writer = metadata.make_writer(output_metadata_file, field_names, field_types)
+    num_rows = 0
+    num_overridden_rows = 0
     for row in data_rows:
-        for key, value in overrides.items():
-            old_value = row[key]
-            if old_value != value:
-                updated_columns[key].add(old_value)
-                row[key] = value
-    return updated_columns
+        if len(row) < num_fields:
+            row.extend([''] * (num_fields - len(row)))
+        object_values = None
+        if id_column is not None:
+            object_values = object_index.get(row[id_column])
+        if object_values is None:
+            for column, value, changes in override_columns:
+                old_value = row[column]
+                if old_value != value:
+                    changes['old_values'].add(old_value)
+                    changes['num_objects'] += 1
+                    row[column] = value
+        else:
+            num_overridden_rows += 1
+            overridden_columns = set()
+            for (column, changes), value in zip(object_columns, object_values):
+                if value is None:
+                    continue
+                overridden_columns.add(column)
+                old_value = row[column]
+                if old_value != value:
+                    changes['old_values'].add(old_value)
+                    changes['object_new_values'].add(value)
+                    changes['num_objects'] += 1
+                    row[column] = value
+            for column, value, changes in override_columns:
+                if column in overridden_columns:
+                    continue
+                old_value = row[column]
+                if old_value != value:
+                    changes['old_values'].add(old_value)
+                    changes['num_objects'] += 1
+                    row[column] = value
+        if writer is not None:
+            writer.writerow(row)
+        num_rows += 1
+    profiling.add(objects=num_rows)
+    if verbose:
+        print(f'Number of objects: {num_rows}')
+        if object_index:
+            print(
+                f'Number of objects with per-object overrides: {num_overridden_rows} '
+                f'(of {len(object_index)} objects in the overrides)',
+            )
+    return {
+        field_names[column]: changes
+        for column, changes in column_changes.items()
+        if changes['num_objects']
+    }
@@ -1,37 +1,226 @@
 # -*- coding: utf-8 -*-
 """Handling of PlanktoScope results archives in the ToTS project"""
 
+import contextlib
+import os
 import tarfile
+import time
+import zipfile
+
+from .. import archive
+from .. import files
+from .. import profiling
+from .. import tarindex
+from ..catalog import store as catalog_store
+
+_copy_block_size = 1024 * 1024 # bytes
+
+@contextlib.contextmanager
+def open_ecotaxa_export(results_archive, memory_cap=files.default_memory_cap, verbose=False):
+    """Open the EcoTaxa export archive of a results archive file as a seekable binary file.
+
+    If the results archive has an up-to-date index (see the tarindex module), the EcoTaxa export
+    archive is read directly out of the results archive, without being written anywhere. Otherwise,
+    it's extracted to a temporary file which is kept in memory unless it grows beyond the memory
+    cap. Either way, the cursor of the file is at the start of the EcoTaxa export archive.
+    """
+    index = tarindex.load_index(_get_path(results_archive))
+    if index is not None:
+        if verbose:
+            print(f'Using index {tarindex.index_path(results_archive.name)}...')
+        export_filename = _identify_indexed_ecotaxa_export_file(index)
+        if verbose:
+            print(f'Reading {export_filename} directly from the results archive...')
+        with tarindex.open_member(results_archive, index, export_filename) as ecotaxa_archive:
+            yield ecotaxa_archive
+        return
+
+    with files.spooled_temporary_file(
+        memory_cap=memory_cap, prefix='tots-ps-', suffix='.zip',
+    ) as ecotaxa_archive:
+        extract_ecotaxa_export(results_archive, ecotaxa_archive, verbose=verbose)
+        if verbose:
+            print(
+                f'Wrote {files.spilled_size(ecotaxa_archive, memory_cap):,} bytes of the '
+                'extracted EcoTaxa export archive to temporary storage',
+            )
+        ecotaxa_archive.seek(0)
+        yield ecotaxa_archive
+
+@contextlib.contextmanager
+def open_ecotaxa_metadata(results_archive, verbose=False):
+    """Open the metadata file of the EcoTaxa export archive of a results archive as a text stream.
+
+    Only the metadata file is decompressed from the EcoTaxa export archive, and nothing is written
+    anywhere. If the results archive has an up-to-date index (see the tarindex module), only the
+    parts of the results archive holding the metadata file and the zip central directory are
+    decompressed. Otherwise, the results archive is decompressed in a single forward pass, and the
+    local headers of the EcoTaxa export archive are parsed as it streams by, so that the images
+    preceding the metadata file are skipped over without being decompressed from the zip file. The
+    rest of the results archive is still scanned once the metadata file has been read, and a
+    ValueError is raised if the results archive has multiple EcoTaxa export archives or none at all,
+    unless the catalog of datasets (see the catalog package) already records that the unchanged
+    results archive has a single EcoTaxa export archive.
+    """
+    index = tarindex.load_index(_get_path(results_archive))
+    if index is not None:
+        if verbose:
+            print(f'Using index {tarindex.index_path(results_archive.name)}...')
+        export_filename = _identify_indexed_ecotaxa_export_file(index)
+        if verbose:
+            print(f'Reading the metadata file of {export_filename}...')
+        with (
+            tarindex.open_member(results_archive, index, export_filename) as ecotaxa_archive,
+            zipfile.ZipFile(ecotaxa_archive, mode='r') as export_zip,
+            archive.open_metadata_file(export_zip) as metadata_file,
+        ):
+            yield metadata_file
+        return
+
+    cataloged_filename = _lookup_cataloged_ecotaxa_export_file(results_archive, verbose=verbose)
+    export_filename = None
+    with tarfile.open(fileobj=results_archive, mode='r|gz') as results_tar:
+        for tarinfo in results_tar:
+            if not _is_ecotaxa_export_file(tarinfo):
+                continue
+            if export_filename is not None:
+                raise ValueError(
+                    'Results archive has multiple EcoTaxa export archives, but only one is allowed',
+                )
+            export_filename = tarinfo.name
+            if verbose:
+                print(f'Reading the metadata file of {export_filename}...')
+            with (
+                results_tar.extractfile(tarinfo) as ecotaxa_archive,
+                archive.open_streamed_metadata_file(ecotaxa_archive) as metadata_file,
+            ):
+                yield metadata_file
+            if export_filename == cataloged_filename:
+                break
+    if export_filename is None:
+        raise ValueError('Couldn\'t find any EcoTaxa export archives in the results archive')
 
 def extract_ecotaxa_export(results_archive, output_file, verbose=False):
-    """Extract the EcoTaxa export archive of a results archive file to the specified output file."""
-    with tarfile.open(fileobj=results_archive, mode='r:gz') as results_tar:
-        export_filename = _identify_ecotaxa_export_file(results_tar)
+    """Extract the EcoTaxa export archive of a results archive file to the specified output file.
+
+    If the results archive has an up-to-date index (see the tarindex module), the EcoTaxa export
+    archive is decompressed directly from the nearest checkpoint preceding it. Otherwise, the
+    results archive is decompressed in a single forward pass, and the EcoTaxa export archive is
+    streamed to the output file in bounded-size blocks as soon as it's found. The rest of the
+    results archive is still scanned afterwards, and a ValueError is raised if the results archive
+    has multiple EcoTaxa export archives or none at all, unless the catalog of datasets (see the
+    catalog package) already records that the unchanged results archive has a single one.
+    """
+    index = tarindex.load_index(_get_path(results_archive))
+    if index is not None:
         if verbose:
-            print(f'Extracting {export_filename}...')
-        with results_tar.extractfile(export_filename) as ecotaxa_archive:
-            output_file.write(ecotaxa_archive.read())
-            output_file.flush()
+            print(f'Using index {tarindex.index_path(results_archive.name)}...')
+        export_filename = _identify_indexed_ecotaxa_export_file(index)
+        with (
+            profiling.stage('extract') as stage,
+            tarindex.open_member(results_archive, index, export_filename) as ecotaxa_archive,
+        ):
+            copied_size = _extract_member(
+                ecotaxa_archive, export_filename, output_file, verbose=verbose,
+            )
+            stage.add(bytes_written=copied_size)
+        return
+
+    cataloged_filename = _lookup_cataloged_ecotaxa_export_file(results_archive, verbose=verbose)
+    export_filename = None
+    with (
+        profiling.stage('extract') as stage,
+        tarfile.open(fileobj=results_archive, mode='r|gz') as results_tar,
+    ):
+        for tarinfo in results_tar:
+            if not _is_ecotaxa_export_file(tarinfo):
+                continue
+            if export_filename is not None:
+                raise ValueError(
+                    'Results archive has multiple EcoTaxa export archives, but only one is allowed',
+                )
+            export_filename = tarinfo.name
+            with results_tar.extractfile(tarinfo) as ecotaxa_archive:
+                copied_size = _extract_member(
+                    ecotaxa_archive, export_filename, output_file, verbose=verbose,
+                )
+                stage.add(bytes_written=copied_size)
+            if export_filename == cataloged_filename:
+                break
+        if stage:
+            stage.add(bytes_read=profiling.file_size(results_archive))
+    if export_filename is None:
+        raise ValueError('Couldn\'t find any EcoTaxa export archives in the results archive')
+
+def _get_path(file):
+    """Determine the path of an opened file, or None if it's not a file on the filesystem."""
+    name = getattr(file, 'name', None)
+    if not isinstance(name, (str, bytes, os.PathLike)):
+        return None
+    return name
 
-def _identify_ecotaxa_export_file(results_tar):
-    """Determine the path (within the results archive tarfile) of the EcoTaxa export archive.
+def _lookup_cataloged_ecotaxa_export_file(results_archive, verbose=False):
+    """Look up the EcoTaxa export archive of an unindexed results archive in the catalog.
+
+    Returns None if the results archive isn't a file cataloged with a single EcoTaxa export archive,
+    in which case the whole results archive must be scanned.
+    """
+    export_filename = catalog_store.lookup_export_member(_get_path(results_archive))
+    if verbose and export_filename is not None:
+        print(f'Using the catalog entry of {results_archive.name}...')
+    return export_filename
+
+def _extract_member(member_file, member_name, output_file, verbose=False):
+    """Stream the opened member of a results archive to the specified output file.
+
+    Returns the number of bytes extracted.
+    """
+    if verbose:
+        print(f'Extracting {member_name}...')
+    start_time = time.perf_counter()
+    copied_size = _copy_blocks(member_file, output_file)
+    output_file.flush()
+    if verbose:
+        elapsed = max(time.perf_counter() - start_time, 1e-9)
+        print(
+            f'Extracted {copied_size:,} bytes in {elapsed:.2f} s '
+            f'({copied_size / elapsed / 1024 / 1024:,.1f} MiB/s)',
+        )
+    return copied_size
+
+def _copy_blocks(input_file, output_file, block_size=_copy_block_size):
+    """Copy the input file to the output file in blocks of at most the specified size.
+
+    Returns the number of bytes copied.
+    """
+    copied_size = 0
+    while True:
+        block = input_file.read(block_size)
+        if not block:
+            return copied_size
+        output_file.write(block)
+        copied_size += len(block)
+
+def _identify_indexed_ecotaxa_export_file(index):
+    """Determine the path (within the indexed results archive) of the EcoTaxa export archive.
 
     This function assumes that the results archive only has a single EcoTaxa export archive, and
-    raises a ValueError if this assumption is violated.
+    raises a ValueError if this assumption is violated. It only needs the index of the results
+    archive.
     """
-    export_file = None
-    for tarinfo in results_tar:
-        if not tarinfo.isreg():
-            continue
-        if not tarinfo.name.startswith('export/'):
-            continue
-        if not tarinfo.name.endswith('.zip'):
-            continue
-        if export_file is not None:
-            raise ValueError(
-                'Results archive has multiple EcoTaxa export archives, but only one is allowed',
-            )
-        export_file = tarinfo.name
-    if export_file is None:
+    export_files = [name for name in tarindex.member_names(index) if _is_ecotaxa_export_name(name)]
+    if len(export_files) > 1:
+        raise ValueError(
+            'Results archive has multiple EcoTaxa export archives, but only one is allowed',
+        )
+    if not export_files:
         raise ValueError('Couldn\'t find any EcoTaxa export archives in the results archive')
-    return export_file
+    return export_files[0]
+
+def _is_ecotaxa_export_file(tarinfo):
+    """Determine whether the member of a results archive tarfile is an EcoTaxa export archive."""
+    return tarinfo.isreg() and _is_ecotaxa_export_name(tarinfo.name)
+
+def _is_ecotaxa_export_name(name):
+    """Determine whether the path of a regular file in a results archive is of an export archive."""
+    return name.startswith('export/') and name.endswith('.zip')
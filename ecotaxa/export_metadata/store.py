@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Storage of the metadata changes made to EcoTaxa export archives in a SQLite database."""
+
+import datetime
+import json
+import os
+import pathlib
+import sqlite3
+
+from ..catalog import store as catalog_store
+
+_value_kinds = {
+    'old': 'old_values',
+    'object_new': 'object_new_values',
+}
+
+def connect(database_path, read_only=False):
+    """Open the SQLite database of metadata changes, creating its tables if needed.
+
+    A read-only connection can only be made to an existing database; sqlite3.OperationalError is
+    raised if it doesn't exist.
+    """
+    if read_only:
+        uri = pathlib.Path(os.path.abspath(database_path)).as_uri()
+        return sqlite3.connect(f'{uri}?mode=ro', uri=True)
+    connection = sqlite3.connect(database_path)
+    with connection:
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS datasets '
+            '(acq_id TEXT PRIMARY KEY, source TEXT, recorded_at TEXT)',
+        )
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS changes ('
+            'acq_id TEXT NOT NULL REFERENCES datasets (acq_id), field TEXT NOT NULL, '
+            'new_value TEXT, num_objects INTEGER, PRIMARY KEY (acq_id, field))',
+        )
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS change_values ('
+            'acq_id TEXT NOT NULL, field TEXT NOT NULL, kind TEXT NOT NULL, value TEXT, '
+            'FOREIGN KEY (acq_id, field) REFERENCES changes (acq_id, field))',
+        )
+        # These indexes make lookups of changes by field and value fast across all datasets
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS changes_field ON changes (field, new_value)',
+        )
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS change_values_value ON change_values (value, kind)',
+        )
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS change_values_acq_id ON change_values (acq_id, field)',
+        )
+    return connection
+
+def record_changes(connection, dataset_changes, verbose=False):
+    """Record the metadata changes made to the EcoTaxa export archives of datasets.
+
+    The changes should be provided as a dict associating each acquisition ID with a (changes,
+    source) pair, where the changes are in the same format as the changes files written by the
+    ecotaxa-metadata-edit command, and the source is the path of the changes file (or None). Any
+    previously-recorded changes of the same datasets are replaced, all in a single transaction.
+    """
+    recorded_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    with connection:
+        for acq_id, (changes, source) in dataset_changes.items():
+            if verbose:
+                print(f'Recording {len(changes)} changed fields of {acq_id}...')
+            connection.execute('DELETE FROM change_values WHERE acq_id = ?', (acq_id,))
+            connection.execute('DELETE FROM changes WHERE acq_id = ?', (acq_id,))
+            connection.execute(
+                'INSERT OR REPLACE INTO datasets (acq_id, source, recorded_at) VALUES (?, ?, ?)',
+                (acq_id, None if source is None else str(source), recorded_at),
+            )
+            connection.executemany(
+                'INSERT INTO changes (acq_id, field, new_value, num_objects) VALUES (?, ?, ?, ?)',
+                [
+                    (
+                        acq_id, field, _to_text(field_changes.get('new_value')),
+                        field_changes.get('num_objects'),
+                    )
+                    for field, field_changes in changes.items()
+                ],
+            )
+            connection.executemany(
+                'INSERT INTO change_values (acq_id, field, kind, value) VALUES (?, ?, ?, ?)',
+                [
+                    (acq_id, field, kind, _to_text(value))
+                    for field, field_changes in changes.items()
+                    for kind, key in _value_kinds.items()
+                    for value in field_changes.get(key, [])
+                ],
+            )
+
+def _to_text(value):
+    """Represent a metadata value as text, as it appears in EcoTaxa metadata files."""
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+def query_changes(connection, field=None, value=None, match='any', acq_id=None):
+    """Find recorded changes to metadata fields, filtered by field, value, and/or dataset.
+
+    If a value is provided, only changes which set the field to that value (if match is 'new'),
+    which replaced that value (if match is 'old'), or either (if match is 'any') are found; values
+    set by per-object overrides count as new values. Returns a list of dicts with the acquisition
+    ID, field, field-wide new value, old values, per-object new values, and number of objects of
+    each change, in natural order of acquisition IDs and then by field.
+    """
+    conditions = []
+    parameters = []
+    if field is not None:
+        conditions.append('changes.field = ?')
+        parameters.append(field)
+    if acq_id is not None:
+        conditions.append('changes.acq_id = ?')
+        parameters.append(acq_id)
+    if value is not None:
+        kinds = {'new': ['object_new'], 'old': ['old'], 'any': ['old', 'object_new']}[match]
+        value_conditions = [
+            '(changes.acq_id, changes.field) IN (SELECT acq_id, field FROM change_values '
+            f'WHERE value = ? AND kind IN ({", ".join("?" * len(kinds))}))',
+        ]
+        parameters.extend([value, *kinds])
+        if match != 'old':
+            value_conditions.append('changes.new_value = ?')
+            parameters.append(value)
+        conditions.append(f'({" OR ".join(value_conditions)})')
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+    found = {}
+    for row_acq_id, row_field, new_value, num_objects in connection.execute(
+        f'SELECT acq_id, field, new_value, num_objects FROM changes {where}', parameters,
+    ):
+        found[(row_acq_id, row_field)] = {
+            'acq_id': row_acq_id,
+            'field': row_field,
+            'new_value': new_value,
+            **{key: [] for key in _value_kinds.values()},
+            'num_objects': num_objects,
+        }
+    for row_acq_id, row_field, kind, row_value in connection.execute(
+        'SELECT found.acq_id, found.field, found.kind, found.value FROM changes '
+        'JOIN change_values AS found '
+        'ON found.acq_id = changes.acq_id AND found.field = changes.field '
+        f'{where} ORDER BY found.value',
+        parameters,
+    ):
+        found[(row_acq_id, row_field)][_value_kinds[kind]].append(row_value)
+    return [
+        found[key] for key in sorted(
+            found.keys(), key=lambda key: (catalog_store.natural_sort_key(key[0]), key[1]),
+        )
+    ]
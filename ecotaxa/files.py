@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Handling of output files, temporary files, and file sizes"""
+
+import contextlib
+import os
+import pathlib
+import re
+import tempfile
+
+default_memory_cap = 64 * 1024 * 1024 # bytes
+
+@contextlib.contextmanager
+def atomic_output(path, mode='wb'):
+    """Open a temporary file which replaces the file at the specified path once it's fully written.
+
+    The temporary file is created in the same directory as the path, so that it can be renamed into
+    place. If an exception is raised before the file is fully written, the temporary file is
+    deleted and any existing file at the path is left untouched.
+    """
+    path = pathlib.Path(path)
+    output_file = tempfile.NamedTemporaryFile(
+        mode=mode, dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp', delete=False,
+    )
+    try:
+        with output_file:
+            yield output_file
+            output_file.flush()
+            os.fsync(output_file.fileno())
+        os.chmod(output_file.name, 0o666 & ~_get_umask())
+        os.replace(output_file.name, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(output_file.name)
+        raise
+
+def _get_umask():
+    """Determine the current umask, which temporary files don't respect."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+def spooled_temporary_file(memory_cap=default_memory_cap, **kwargs):
+    """Open a temporary file which is kept in memory until it grows beyond the memory cap.
+
+    A memory cap of 0 means that the temporary file is always stored on disk. Any other keyword
+    arguments are passed on to tempfile.SpooledTemporaryFile.
+    """
+    if memory_cap == 0:
+        return tempfile.TemporaryFile(**kwargs)
+    return _SpooledTemporaryFile(max_size=memory_cap, **kwargs)
+
+class _SpooledTemporaryFile(tempfile.SpooledTemporaryFile):
+    """A spooled temporary file with the IOBase methods which zipfile needs.
+
+    Before Python 3.11, tempfile.SpooledTemporaryFile lacks readable(), seekable(), and writable(),
+    so zipfile can't read members of a zip archive in a spooled temporary file.
+    """
+
+    def readable(self):
+        return self._file.readable()
+
+    def seekable(self):
+        return self._file.seekable()
+
+    def writable(self):
+        return self._file.writable()
+
+def spilled_size(spooled_file, memory_cap=default_memory_cap):
+    """Determine how much of a temporary file (with its cursor at the end) was written to disk."""
+    size = spooled_file.tell()
+    if memory_cap == 0 or size > memory_cap:
+        return size
+    return 0
+
+_size_units = {
+    '': 1,
+    'k': 1024, 'kib': 1024, 'kb': 1000,
+    'm': 1024 ** 2, 'mib': 1024 ** 2, 'mb': 1000 ** 2,
+    'g': 1024 ** 3, 'gib': 1024 ** 3, 'gb': 1000 ** 3,
+    't': 1024 ** 4, 'tib': 1024 ** 4, 'tb': 1000 ** 4,
+}
+
+def parse_size(size):
+    """Parse a human-readable size (e.g. '500MB' or '64M') as a number of bytes.
+
+    Single-letter units and IEC units (e.g. 'MiB') are powers of 1024, while SI units (e.g. 'MB')
+    are powers of 1000. Raises a ValueError if the size can't be parsed.
+    """
+    match = re.fullmatch(r'\s*([0-9]+(?:\.[0-9]*)?)\s*([a-zA-Z]*)\s*', size)
+    if match is None or match.group(2).lower() not in _size_units:
+        raise ValueError(f'Invalid size: {size}')
+    return int(float(match.group(1)) * _size_units[match.group(2).lower()])
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Command line utility for indexing PlanktoScope results archives for random access"""
+
+import argparse
+import os
+import pathlib
+import time
+
+from .. import batch
+from .. import tarindex
+
+def main():
+    """Index the specified results archive(s), or read members from an indexed results archive."""
+    parser = argparse.ArgumentParser(
+        prog='results-archive-index',
+        description='Index PlanktoScope results archives for fast reading of individual files',
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        default=False,
+        help='Print additional information for troubleshooting',
+    )
+    subparsers = parser.add_subparsers()
+    setup_single_parser(subparsers.add_parser('single'))
+    setup_batch_parser(subparsers.add_parser('batch'))
+    setup_extract_parser(subparsers.add_parser('extract'))
+    args = parser.parse_args()
+    args.func(args)
+
+# single subcommand
+
+def setup_single_parser(parser):
+    """Set up a (sub)parser for indexing a single results archive."""
+    parser.add_argument(
+        'input',
+        type=str,
+        help='Path of the results archive to index',
+    )
+    parser.add_argument(
+        '--span',
+        type=int,
+        default=tarindex.default_span,
+        help='Number of uncompressed bytes between checkpoints in the index',
+    )
+    parser.set_defaults(func=lambda args: index_single_results_archive(
+        args.input, span=args.span, verbose=args.verbose,
+    ))
+
+def index_single_results_archive(input_path, span=tarindex.default_span, verbose=False):
+    """Build an index for the results archive, saving it next to the results archive."""
+    if not tarindex.available():
+        raise OSError('Results archives can\'t be indexed because zlib couldn\'t be loaded')
+    tarindex.build_index(input_path, span=span, verbose=verbose)
+
+# batch subcommand
+
+def setup_batch_parser(parser):
+    """Set up a (sub)parser for indexing multiple results archives."""
+    parser.add_argument(
+        'input',
+        type=str,
+        help='Directory of results archives, ending in `-results.tar.gz`',
+    )
+    parser.add_argument(
+        '--span',
+        type=int,
+        default=tarindex.default_span,
+        help='Number of uncompressed bytes between checkpoints in each index',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=batch.parse_jobs,
+        default=1,
+        help='Number of results archives to index in parallel (0 to use all CPU cores)',
+    )
+    parser.add_argument(
+        '-f', '--force',
+        action='store_true',
+        default=False,
+        help='Re-index all results archives, even if they already have up-to-date indexes',
+    )
+    parser.set_defaults(func=lambda args: index_all_results_archives(
+        args.input, span=args.span, jobs=args.jobs, force=args.force, verbose=args.verbose,
+    ))
+
+def index_all_results_archives(
+    input_dir, span=tarindex.default_span, jobs=1, force=False, verbose=False,
+):
+    """Build an index for each results archive in the directory which doesn't have one yet.
+
+    The name of each results archive should be `{acquisition-id}-results.tar.gz`. Each index is
+    saved next to its results archive.
+    """
+    if not tarindex.available():
+        raise OSError('Results archives can\'t be indexed because zlib couldn\'t be loaded')
+    tasks = []
+    for archive_path in sorted(os.listdir(input_dir)):
+        if not archive_path.endswith('-results.tar.gz'):
+            continue
+        acq_id = archive_path.removesuffix('-results.tar.gz')
+        archive_path = pathlib.Path(input_dir).joinpath(archive_path)
+        tasks.append((acq_id, _index_dataset, (archive_path,), {
+            'span': span, 'force': force, 'verbose': verbose,
+        }))
+    start_time = time.perf_counter()
+    task_results = batch.run_tasks(tasks, jobs=jobs)
+    batch.print_summary(task_results, wall_time=time.perf_counter() - start_time)
+
+def _index_dataset(archive_path, span=tarindex.default_span, force=False, verbose=False):
+    """Index a single results archive in a batch.
+
+    Returns a (status, message) pair for batch.run_tasks.
+    """
+    if not force and tarindex.load_index(archive_path) is not None:
+        return ('skipped', 'already has an up-to-date index')
+    tarindex.build_index(archive_path, span=span, verbose=verbose)
+    return ('done', '')
+
+# extract subcommand
+
+def setup_extract_parser(parser):
+    """Set up a (sub)parser for extracting a single member of an indexed results archive."""
+    parser.add_argument(
+        'input',
+        type=argparse.FileType(mode='rb'),
+        help='Path of the indexed results archive',
+    )
+    parser.add_argument(
+        'member',
+        type=str,
+        help='Path of the member within the results archive, e.g. `export/ecotaxa/[...].zip`',
+    )
+    parser.add_argument(
+        'output',
+        type=argparse.FileType(mode='wb'),
+        help='Path of the file to save the member to',
+    )
+    parser.set_defaults(func=lambda args: extract_member(
+        args.input, args.member, args.output, verbose=args.verbose,
+    ))
+
+def extract_member(results_archive_file, member_name, output_file, verbose=False):
+    """Extract a member of the indexed results archive, without decompressing the whole archive."""
+    index = tarindex.load_index(results_archive_file.name)
+    if index is None:
+        raise ValueError(
+            f'{results_archive_file.name} has no up-to-date index; you should index it first',
+        )
+    if verbose:
+        print(f'Extracting {member_name} from {results_archive_file.name}...')
+    with tarindex.open_member(results_archive_file, index, member_name) as member_file:
+        while block := member_file.read(1024 * 1024):
+            output_file.write(block)
+
+if __name__ == '__main__':
+    main()
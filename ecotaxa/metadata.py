@@ -2,6 +2,7 @@
 """Handling of PlanktoScope ecotaxa metadata tables"""
 
 import csv
+import io
 
 _tsv_format = {
     'dialect': 'unix',
@@ -9,35 +10,36 @@ _tsv_format = {
     'quoting': csv.QUOTE_MINIMAL,
 }
 
-def read_file(metadata_file):
-    """Load the rows of a TSV file containing EcoTaxa object metadata, as a list of dicts per row.
+def read_rows(metadata_file):
+    """Lazily load the rows of a TSV file containing EcoTaxa object metadata, as lists of values.
 
-    Returns the first row of the file (containing numpy format specifiers) separately from the rows
-    containing actual data.
+    Returns the header row (containing field names), the first row of the file (containing numpy
+    format specifiers), and an iterator over the rows containing actual data. Rows are read one at a
+    time as the iterator is consumed, so memory usage doesn't depend on the number of rows.
 
     The cursor of the table file must be at the appropriate location before the function is called,
-    and it is left at the end of the file when the function returns.
+    and it is left at the end of the file once the iterator is exhausted.
     """
-    reader = csv.DictReader(metadata_file, **_tsv_format)
-    rownum = 0
-    field_types = {}
-    data_rows = []
-    for row in reader:
-        if rownum == 0:
-            field_types = row
-            rownum += 1
-            continue
-        data_rows.append(row)
-    return (field_types, data_rows)
-
-def write_file(output_metadata_file, field_types, data_rows):
-    """Write the EcoTaxa object metadata to a TSV file.
+    reader = csv.reader(metadata_file, **_tsv_format)
+    field_names = next(reader, [])
+    field_types = next(reader, [''] * len(field_names))
+    return (field_names, field_types, reader)
 
-    The cursor of the table file must be at the appropriate location before the function is called,
-    and it is left at the end of the file when the function returns.
+def make_writer(output_metadata_file, field_names, field_types):
+    """Start writing EcoTaxa object metadata to a TSV file, one list of values per row at a time.
+
+    The header row and the row of numpy format specifiers are written immediately. Returns a csv
+    writer for the remaining rows.
+
+    The cursor of the table file must be at the appropriate location before the function is called.
     """
-    writer = csv.DictWriter(output_metadata_file, field_types.keys(), **_tsv_format)
-    writer.writeheader()
+    writer = csv.writer(output_metadata_file, **_tsv_format)
+    writer.writerow(field_names)
     writer.writerow(field_types)
-    for row in data_rows:
-        writer.writerow(row)
+    return writer
+
+def row_size(row):
+    """Determine the size (in bytes) of a row of values, as written to a TSV file by make_writer."""
+    row_file = io.StringIO()
+    csv.writer(row_file, **_tsv_format).writerow(row)
+    return len(row_file.getvalue().encode('utf-8'))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Command line utility for packaging PlanktoScope processing outputs into results archives"""
+
+import argparse
+import pathlib
+import time
+
+from .. import files
+from .. import pgzip
+from .. import tarindex
+from . import results
+
+def main():
+    """Package the outputs in the specified processing directory into a results archive."""
+    parser = argparse.ArgumentParser(
+        prog='results-archive-pack',
+        description=(
+            'Package the EcoTaxa export archive and object images of a processed PlanktoScope '
+            'dataset into an indexed results archive, with a count of the objects'
+        ),
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        default=False,
+        help='Print additional information for troubleshooting',
+    )
+    parser.add_argument(
+        'processing_dir',
+        type=str,
+        help='Processing directory with export/ and objects/ subdirectories (e.g. /home/pi/data)',
+    )
+    parser.add_argument(
+        'acq_id',
+        type=str,
+        help='tots-ps acquisition ID of the processed dataset',
+    )
+    parser.add_argument(
+        'output',
+        type=str,
+        help=(
+            'Directory in which to save the results archive (`{acquisition-id}-results.tar.gz`), '
+            'its index, and its object count (`{acquisition-id}-results-count.txt`)'
+        ),
+    )
+    parser.add_argument(
+        '--level',
+        type=int,
+        choices=range(1, 10),
+        default=pgzip.default_level,
+        help='gzip compression level, from 1 (fastest) to 9 (smallest)',
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=0,
+        help='Number of threads to compress the results archive with (0 to use all CPU cores)',
+    )
+    parser.add_argument(
+        '--span',
+        type=int,
+        default=tarindex.default_span,
+        help='Number of uncompressed bytes between checkpoints in the index',
+    )
+    args = parser.parse_args()
+    pack_dataset(
+        args.processing_dir, args.acq_id, args.output, level=args.level, threads=args.threads,
+        span=args.span, verbose=args.verbose,
+    )
+
+def pack_dataset(
+    processing_dir, acq_id, output_dir, level=pgzip.default_level, threads=0,
+    span=tarindex.default_span, verbose=False,
+):
+    """Save the results archive, its index, and its object count for the processed dataset.
+
+    The object count is saved as a text file with the number of object images in the results
+    archive, as previously done by `ls -l objects/*/*/*/*.jpg | wc -l`.
+    """
+    output_dir = pathlib.Path(output_dir)
+    archive_path = output_dir / f'{acq_id}-results.tar.gz'
+    count_path = output_dir / f'{acq_id}-results-count.txt'
+    start_time = time.perf_counter()
+    index = results.pack_results_archive(
+        processing_dir, archive_path, level=level, threads=threads, span=span, verbose=verbose,
+    )
+    with files.atomic_output(count_path, mode='w') as count_file:
+        count_file.write(f'{index["objects"]}\n')
+    elapsed = time.perf_counter() - start_time
+    print(
+        f'Saved {archive_path} with {index["objects"]} objects in {elapsed:.1f} s '
+        f'({index["uncompressed_size"] / max(elapsed, 1e-9) / 1024 / 1024:,.1f} MiB/s)',
+    )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Packaging of PlanktoScope processing outputs into indexed results archives"""
+
+import os
+import pathlib
+import tarfile
+
+from .. import files
+from .. import pgzip
+from .. import tarindex
+
+# Results archives hold these directories of the processing directory, in this order:
+_export_dir = 'export'
+_objects_dir = 'objects'
+_object_suffix = '.jpg'
+
+def list_members(processing_dir):
+    """List the paths (relative to the processing directory) to put in the results archive.
+
+    The EcoTaxa export archives (`export/**/*.zip`) come first, right after their parent
+    directories, so that readers of the results archive reach them without passing over the object
+    images; the rest of the `export/` directory and the `objects/` directory follow. Directories are
+    listed before their contents, and entries of each directory are listed in sorted order.
+    """
+    processing_dir = pathlib.Path(processing_dir)
+    export_members = _walk(processing_dir, _export_dir)
+    export_archives = [
+        member for member in export_members
+        if member.endswith('.zip') and (processing_dir / member).is_file()
+    ]
+    leading = []
+    for member in export_archives:
+        for parent in reversed(pathlib.PurePosixPath(member).parents[:-1]):
+            if str(parent) not in leading:
+                leading.append(str(parent))
+        leading.append(member)
+    remaining = [member for member in export_members if member not in set(leading)]
+    return leading + remaining + _walk(processing_dir, _objects_dir)
+
+def _walk(root, name):
+    """List the directory (relative to the root) and everything in it, directories first."""
+    if not (pathlib.Path(root) / name).is_dir():
+        return []
+    members = [name]
+    with os.scandir(pathlib.Path(root) / name) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            member = f'{name}/{entry.name}'
+            if entry.is_dir(follow_symlinks=False):
+                members.extend(_walk(root, member))
+            else:
+                members.append(member)
+    return members
+
+def is_object_image(member):
+    """Determine whether a member of the results archive is an object image."""
+    return member.startswith(f'{_objects_dir}/') and member.endswith(_object_suffix)
+
+def pack_results_archive(
+    processing_dir, output_path, level=pgzip.default_level, threads=0,
+    span=tarindex.default_span, verbose=False,
+):
+    """Write the results archive of the processing directory to the output path in a single pass.
+
+    The results archive is a gzip-compressed tar archive of the `export/` and `objects/`
+    directories of the processing directory (see list_members for the order of its members),
+    compressed with the specified number of threads (0 for one per CPU core). The archive is
+    replaced atomically, and an index (see the tarindex module) is saved next to it, recording the
+    offset of each member and the number of object images, without the archive having to be read
+    back. Returns the index.
+    """
+    processing_dir = pathlib.Path(processing_dir)
+    members = list_members(processing_dir)
+    if not any(member.startswith(f'{_export_dir}/') for member in members):
+        raise ValueError(f'{processing_dir} has no {_export_dir}/ directory to archive')
+    if verbose:
+        print(f'Writing {len(members)} files and directories to {output_path}...')
+    indexed_members = []
+    num_objects = 0
+    with files.atomic_output(output_path) as output_file:
+        writer = pgzip.ParallelGzipWriter(output_file, level=level, threads=threads, span=span)
+        with writer:
+            with tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT) as results_tar:
+                for member in members:
+                    tarinfo = results_tar.gettarinfo(processing_dir / member, arcname=member)
+                    if tarinfo.isreg():
+                        with open(processing_dir / member, 'rb') as member_file:
+                            results_tar.addfile(tarinfo, member_file)
+                        # The member's data ends at the (block-padded) end of the stream so far
+                        data_blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+                        padded_size = (data_blocks + (remainder > 0)) * tarfile.BLOCKSIZE
+                        indexed_members.append(
+                            (member, results_tar.offset - padded_size, tarinfo.size),
+                        )
+                        num_objects += is_object_image(member)
+                    else:
+                        results_tar.addfile(tarinfo)
+    stat = os.stat(output_path)
+    index = tarindex.make_index(
+        span, writer.uncompressed_size, writer.checkpoints, indexed_members, objects=num_objects,
+    )
+    index['archive'] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    tarindex.save_index(index, output_path)
+    if verbose:
+        print(
+            f'Wrote {writer.uncompressed_size:,} bytes ({writer.compressed_size:,} compressed) '
+            f'with {num_objects} object images, indexed in {tarindex.index_path(output_path)}',
+        )
+    return index
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Multithreaded gzip compression in the style of pigz, with checkpoints for random access
+
+The uncompressed stream is split into fixed-size blocks which are compressed in parallel by a pool
+of threads (zlib releases the GIL while compressing). Each block is compressed with the 32 kiB of
+data preceding it as a preset dictionary, so that compression is nearly as good as compressing the
+stream in one go, and each block but the last ends with a sync flush, so that the compressed blocks
+can be concatenated into a single deflate stream in a standard gzip file. Since every sync flush
+leaves the compressed stream byte-aligned at a deflate block boundary, checkpoints (as used by the
+tarindex module) can be recorded for free while compressing, without decompressing the result.
+"""
+
+import collections
+import concurrent.futures
+import io
+import os
+import struct
+import time
+import zlib
+
+_window_size = 32 * 1024 # bytes; this is the maximum distance of a back-reference in deflate
+default_block_size = 1024 * 1024 # bytes of uncompressed data per block
+default_level = 6
+_raw_window_bits = -15 # write raw deflate data, with the gzip header and trailer written separately
+
+def _compress_block(data, dictionary, level, last):
+    """Compress a block of data as raw deflate data, with the preceding data as a dictionary."""
+    if dictionary:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, _raw_window_bits, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY,
+            dictionary,
+        )
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, _raw_window_bits)
+    flush_mode = zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    return compressor.compress(data) + compressor.flush(flush_mode)
+
+class ParallelGzipWriter(io.RawIOBase):
+    """A writable stream which compresses data written to it into a gzip file, using threads.
+
+    Compressed data is written to the output file in order, with no more than two blocks per thread
+    waiting to be written at any time (to bound memory usage). Closing the writer finishes the gzip
+    file, but it doesn't close the output file.
+
+    If a span is provided, checkpoints are recorded at block boundaries at least the span apart
+    (starting from the beginning of the stream), as (uncompressed offset, compressed offset,
+    unused bits, window) tuples in the same format as the checkpoints of the tarindex module.
+    """
+
+    def __init__(
+        self, output_file, level=default_level, threads=0, block_size=default_block_size,
+        span=None, mtime=None,
+    ):
+        super().__init__()
+        self._output_file = output_file
+        self._level = level
+        self._block_size = block_size
+        self._span = span
+        self._threads = threads or os.cpu_count() or 1
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._threads)
+        self._pending = collections.deque() # (future, uncompressed offset, checkpoint window)
+        self._buffer = bytearray()
+        self._window = b''
+        self._crc = 0
+        self._last_checkpoint = None
+        self.checkpoints = []
+        self.uncompressed_size = 0 # bytes submitted for compression so far
+        self.compressed_size = 0 # bytes written to the output file so far
+        self._write_header(int(time.time()) if mtime is None else int(mtime))
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed writer')
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            block = bytes(self._buffer[:self._block_size])
+            del self._buffer[:self._block_size]
+            self._submit(block, last=False)
+        return len(data)
+
+    def close(self):
+        """Compress any remaining data and finish the gzip file."""
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            self._buffer = bytearray()
+            while self._pending:
+                self._write_next()
+            self._output(struct.pack('<II', self._crc, self.uncompressed_size & 0xffffffff))
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            super().close()
+
+    def _write_header(self, mtime):
+        """Write a gzip header without a file name."""
+        if self._level == zlib.Z_BEST_COMPRESSION:
+            extra_flags = 2
+        elif self._level == zlib.Z_BEST_SPEED:
+            extra_flags = 4
+        else:
+            extra_flags = 0
+        # ID1, ID2, compression method (deflate), flags, mtime, extra flags, OS (Unix)
+        self._output(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, mtime & 0xffffffff, extra_flags, 3))
+
+    def _output(self, data):
+        self._output_file.write(data)
+        self.compressed_size += len(data)
+
+    def _submit(self, block, last):
+        """Submit a block for compression, writing out compressed blocks to bound memory usage."""
+        checkpoint_window = None
+        if self._span is not None and (
+            self._last_checkpoint is None
+            or self.uncompressed_size - self._last_checkpoint >= self._span
+        ):
+            checkpoint_window = self._window.rjust(_window_size, b'\0')
+            self._last_checkpoint = self.uncompressed_size
+        future = self._executor.submit(_compress_block, block, self._window, self._level, last)
+        self._pending.append((future, self.uncompressed_size, checkpoint_window))
+        self._crc = zlib.crc32(block, self._crc)
+        self.uncompressed_size += len(block)
+        if len(block) >= _window_size:
+            self._window = block[-_window_size:]
+        else:
+            self._window = (self._window + block)[-_window_size:]
+        while len(self._pending) > 2 * self._threads:
+            self._write_next()
+
+    def _write_next(self):
+        """Write the oldest pending block once it's compressed, recording its checkpoint if any."""
+        future, uncompressed_offset, checkpoint_window = self._pending.popleft()
+        compressed = future.result()
+        if checkpoint_window is not None and compressed:
+            self.checkpoints.append(
+                (uncompressed_offset, self.compressed_size, 0, checkpoint_window),
+            )
+        self._output(compressed)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""Optional instrumentation of the stages of processing datasets, recorded as JSON lines
+
+The peak resident set size in each record (`peak_rss_bytes`) is the peak while the record was
+active, even when a process handles several datasets: the process's memory high-water mark is
+reset as each record starts. This is only possible on Linux; elsewhere, the peak is None.
+"""
+
+import json
+import os
+import time
+
+_output_path = None
+_tool = None
+_records = [] # the records of the datasets being processed, from outermost to innermost
+
+def enable(output_path, tool=None):
+    """Enable profiling, appending records to the file at the specified path.
+
+    The tool name (e.g. `ecotaxa-metadata-edit`) is included in each record.
+    """
+    global _output_path, _tool
+    _output_path = os.fspath(output_path)
+    _tool = tool
+
+def enabled():
+    """Determine whether profiling is enabled."""
+    return _output_path is not None
+
+def settings():
+    """Return the arguments to pass to enable (e.g. in a worker process) to profile in the same way.
+
+    Returns None if profiling is disabled.
+    """
+    if _output_path is None:
+        return None
+    return (_output_path, _tool)
+
+class _Disabled:
+    """A no-op stand-in for stages and records when profiling is disabled."""
+
+    def __bool__(self):
+        return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add(self, **counts):
+        pass
+
+    def set(self, **fields):
+        pass
+
+_disabled = _Disabled()
+
+def session(output_path, tool=None):
+    """Enable profiling (if an output path is provided) for a whole run of a command.
+
+    Returns a context manager for the record of the run, which gets any stages run outside of the
+    records of individual datasets; if profiling isn't enabled, a no-op object is returned.
+    """
+    if output_path is None:
+        return _disabled
+    enable(output_path, tool=tool)
+    return _Record(None)
+
+def dataset(name):
+    """Record the processing of the named dataset, as a context manager.
+
+    Stages run while the record is active are attributed to the dataset. The record is written to
+    the profile when the context manager exits, with a 'failed' status if an exception was raised
+    (unless a status was set on the record).
+    """
+    if _output_path is None:
+        return _disabled
+    return _Record(name)
+
+def stage(name):
+    """Record a stage of processing of the current dataset, as a context manager.
+
+    If profiling is disabled, a shared no-op object is returned instead; it's falsy, so that callers
+    can skip computing anything which is only needed for the profile.
+
+    Counts of the bytes read and written and the objects processed can be added to the stage (with
+    the add method) while it's active. Stages with the same name are combined in the record of the
+    dataset, with the number of times the stage was run; nested stages each count their own time.
+    """
+    if _output_path is None or not _records:
+        return _disabled
+    return _Stage(_records[-1], name)
+
+def add(**counts):
+    """Add counts (bytes_read, bytes_written, or objects) to the innermost active stage, if any."""
+    if _output_path is None or not _records or not _records[-1].stages:
+        return
+    _records[-1].stages[-1].add(**counts)
+
+def file_size(file):
+    """Determine the size of a seekable file without moving its cursor, or None if unseekable.
+
+    This should only be called when profiling is enabled.
+    """
+    try:
+        position = file.tell()
+        size = file.seek(0, os.SEEK_END)
+        file.seek(position)
+    except (AttributeError, OSError, ValueError):
+        return None
+    return size
+
+def _reset_peak_rss():
+    """Reset the peak resident set size of the current process to its current resident set size.
+
+    Returns whether the peak could be reset; this is only possible on Linux.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+    except OSError:
+        return False
+    return True
+
+def _peak_rss():
+    """Determine the peak resident set size (in bytes) of the current process since it was reset.
+
+    Returns None if it can't be determined (i.e. other than on Linux).
+    """
+    try:
+        with open('/proc/self/status', 'r') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024 # the value is in kilobytes
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+class _Record:
+    """The record of processing a dataset."""
+
+    def __init__(self, name):
+        self.name = name
+        self.fields = {}
+        self.totals = {}
+        self.stages = [] # the active stages, from outermost to innermost
+        self.peak_rss = None # bytes; the peak before the high-water mark was last reset
+
+    def __bool__(self):
+        return True
+
+    def __enter__(self):
+        # Fold the peak so far into the enclosing records before resetting it for this record
+        _fold_peak_rss()
+        self.peak_rss = None if not _reset_peak_rss() else _peak_rss()
+        _records.append(self)
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _fold_peak_rss()
+        _records.remove(self)
+        record = {
+            'tool': _tool,
+            'dataset': self.name,
+            'pid': os.getpid(),
+            'status': 'failed' if exc_type is not None else 'done',
+            **self.fields,
+            'wall_s': time.perf_counter() - self._start_wall,
+            'cpu_s': time.process_time() - self._start_cpu,
+            'peak_rss_bytes': self.peak_rss,
+            'stages': self.totals,
+        }
+        line = json.dumps(record) + '\n'
+        # Each record is appended with a single write, so that records from parallel processes
+        # don't get interleaved
+        with open(_output_path, 'a') as output_file:
+            output_file.write(line)
+        return False
+
+    def add(self, **counts):
+        pass
+
+    def set(self, **fields):
+        """Set fields of the record, e.g. its status."""
+        self.fields.update(fields)
+
+def _fold_peak_rss():
+    """Update the peaks of the active records with the peak since the high-water mark was reset.
+
+    Records whose peak couldn't be measured when they started are left without a peak.
+    """
+    peak_rss = _peak_rss()
+    if peak_rss is None:
+        return
+    for record in _records:
+        if record.peak_rss is not None:
+            record.peak_rss = max(record.peak_rss, peak_rss)
+
+class _Stage:
+    """An active stage of processing a dataset."""
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+        self.counts = {'bytes_read': 0, 'bytes_written': 0, 'objects': 0}
+
+    def __bool__(self):
+        return True
+
+    def __enter__(self):
+        self.record.stages.append(self)
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_s = time.perf_counter() - self._start_wall
+        cpu_s = time.process_time() - self._start_cpu
+        self.record.stages.remove(self)
+        totals = self.record.totals.setdefault(self.name, {
+            'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+            'bytes_read': 0, 'bytes_written': 0, 'objects': 0,
+        })
+        totals['calls'] += 1
+        totals['wall_s'] += wall_s
+        totals['cpu_s'] += cpu_s
+        for key, count in self.counts.items():
+            totals[key] += count
+        return False
+
+    def add(self, bytes_read=0, bytes_written=0, objects=0):
+        """Add to the counts of bytes read and written and objects processed in the stage."""
+        self.counts['bytes_read'] += bytes_read or 0
+        self.counts['bytes_written'] += bytes_written or 0
+        self.counts['objects'] += objects or 0
+
+    def set(self, **fields):
+        pass
@@ -4,20 +4,28 @@
 """Command line utility for splitting EcoTaxa export archives"""
 
 import argparse
-import io
+import contextlib
+import glob
 import json
 import math
 import os
 import pathlib
+import sys
 import tempfile
+import zipfile
 
+from .. import archive
+from .. import files
+from .. import profiling
+from ..export_metadata import ecotaxa as export_ecotaxa
+from ..export_metadata import results
 from . import ecotaxa
 
 def main():
     """Split the specified EcoTaxa export archive(s)."""
     parser = argparse.ArgumentParser(
-        prog='ecotaxa-metadata-edit',
-        description='Edit the metadata of a PlanktoScope EcoTaxa dataset export archive',
+        prog='ecotaxa-split-archives',
+        description='Split PlanktoScope EcoTaxa dataset export archives into smaller archives',
     )
     parser.add_argument(
         '-v', '--verbose',
@@ -25,11 +33,25 @@ def main():
         default=False,
         help='Print additional information for troubleshooting',
     )
+    parser.add_argument(
+        '--profile',
+        type=str,
+        default=None,
+        help=(
+            'Path of a file to append JSON lines to, recording the time, I/O, and memory usage of '
+            'each stage of processing each dataset'
+        ),
+    )
     subparsers = parser.add_subparsers()
     setup_single_parser(subparsers.add_parser('single'))
     setup_batch_parser(subparsers.add_parser('batch'))
+    setup_results_parser(subparsers.add_parser('results'))
     args = parser.parse_args()
-    args.func(args)
+    with profiling.session(args.profile, tool=parser.prog):
+        try:
+            args.func(args)
+        except ValueError as e: # e.g. an object which can't fit in a chunk of the maximum size
+            sys.exit(f'Error: {e}')
 
 # single subcommand
 
@@ -50,32 +72,97 @@ def setup_single_parser(parser):
         type=str,
         help='Directory in which to save the split-up EcoTaxa export archive chunks',
     )
+    _add_max_bytes_argument(parser)
     parser.set_defaults(func=lambda args: process_single_ecotaxa_archive(
-        args.input, args.num_chunks, args.output, verbose=args.verbose,
+        args.input, args.num_chunks, args.output, max_bytes=args.max_bytes, verbose=args.verbose,
     ))
 
-def process_single_ecotaxa_archive(input_path, num_chunks, output_dir_path, verbose=False):
+def _add_max_bytes_argument(parser):
+    """Add an argument to the (sub)parser for the maximum size of each chunk."""
+    parser.add_argument(
+        '--max-bytes',
+        type=files.parse_size,
+        default=None,
+        help=(
+            'Maximum size (e.g. 500MB) of each chunk; objects are packed into as few chunks as '
+            'possible within this size, and the number of chunks becomes the minimum number of '
+            'chunks to make (0 to make as few chunks as needed)'
+        ),
+    )
+
+def process_single_ecotaxa_archive(
+    input_path, num_chunks, output_dir_path, max_bytes=None, verbose=False,
+):
     """Split the EcoTaxa export archive into the specified number of chunks.
 
+    If a maximum size (in bytes) is specified for the chunks, objects are instead packed into as
+    few chunks as possible without exceeding the maximum size, but with at least the specified
+    number of chunks.
+
     The resulting chunks are saved to the specified output directory, each with a "-chunk{number}"
-    suffix appended before the ".zip" file extension.
+    suffix appended before the ".zip" file extension. Chunks are written atomically, and chunks
+    left over from a previous run which made more chunks are deleted.
     """
+    _check_num_chunks(num_chunks, max_bytes)
     input_path = pathlib.Path(input_path)
     with open(input_path, 'rb') as input_file:
         if verbose:
             input_file.seek(0, os.SEEK_END)
             print(f'EcoTaxa export archive size: {_print_size(input_file.tell())}')
             input_file.seek(0)
-        for i in range(num_chunks):
-            output_dir_path = pathlib.Path(output_dir_path)
-            output_path = f'{output_dir_path / input_path.stem}-chunk{i}.zip'
+        chunks = None
+        if max_bytes is not None:
             if verbose:
-                print(f'Writing {output_path}...')
-            with open(output_path, 'wb') as output_file:
-                ecotaxa.chunk_archive(input_file, num_chunks, i, output_file, verbose=verbose)
-        # TODO: split up the metadata table into num_chunks sub-tables
-        # TODO: copy the image from each row of each metadata table into the corresponding chunk
-        # TODO: actually split the file
+                print(f'Planning chunks of at most {_print_size(max_bytes)}...')
+            chunks = ecotaxa.plan_chunks(
+                input_file, max_bytes, min_chunks=num_chunks, verbose=verbose,
+            )
+            num_chunks = len(chunks)
+        output_dir_path = pathlib.Path(output_dir_path)
+        output_paths = [
+            output_dir_path / f'{input_path.stem}-chunk{i}.zip' for i in range(num_chunks)
+        ]
+        with contextlib.ExitStack() as stack:
+            output_files = [
+                stack.enter_context(files.atomic_output(output_path, mode='wb'))
+                for output_path in output_paths
+            ]
+            if verbose:
+                print(f'Writing {num_chunks} chunks to {output_dir_path}...')
+            ecotaxa.split_archive(input_file, output_files, chunks=chunks, verbose=verbose)
+    remove_stale_chunks(output_dir_path, input_path.stem, output_paths, verbose=verbose)
+    if verbose:
+        for output_path in output_paths:
+            print(f'{output_path}: {_print_size(os.path.getsize(output_path))}')
+
+def _check_num_chunks(num_chunks, max_bytes):
+    """Check that the number of chunks is usable, raising a ValueError if it isn't.
+
+    Without a maximum size, at least one chunk must be made; with a maximum size, the number of
+    chunks is only a minimum, so 0 is allowed.
+    """
+    if max_bytes is None and num_chunks < 1:
+        raise ValueError(
+            f'Number of chunks must be at least 1 without a maximum chunk size, not {num_chunks}',
+        )
+    if num_chunks < 0:
+        raise ValueError(f'Number of chunks must not be negative, not {num_chunks}')
+
+def remove_stale_chunks(output_dir_path, stem, output_paths, include_unsplit=False, verbose=False):
+    """Delete chunks (`{stem}-chunk{number}.zip`) in the output directory which weren't just made.
+
+    If include_unsplit is set, an unsplit `{stem}.zip` archive is also deleted unless it was just
+    made, e.g. when an archive which was previously kept unsplit is now split into chunks.
+    """
+    output_dir_path = pathlib.Path(output_dir_path)
+    stale_paths = set(output_dir_path.glob(f'{glob.escape(stem)}-chunk[0-9]*.zip'))
+    if include_unsplit:
+        stale_paths |= set(output_dir_path.glob(f'{glob.escape(stem)}.zip'))
+    stale_paths -= {pathlib.Path(output_path) for output_path in output_paths}
+    for stale_path in sorted(stale_paths):
+        if verbose:
+            print(f'Deleting {stale_path}, which was left over from a previous run...')
+        stale_path.unlink()
 
 def _print_size(size_bytes):
     """Nicely print the size of a file.
@@ -108,17 +195,20 @@ def setup_batch_parser(parser):
         type=str,
         help='Directory in which to save the split-up EcoTaxa export archive chunks',
     )
+    _add_max_bytes_argument(parser)
     parser.set_defaults(func=lambda args: process_all_ecotaxa_archives(
-        args.input, args.num_chunks, args.output, verbose=args.verbose,
+        args.input, args.num_chunks, args.output, max_bytes=args.max_bytes, verbose=args.verbose,
     ))
 
-def process_all_ecotaxa_archives(input_dir, num_chunks, output_dir, verbose=False):
+def process_all_ecotaxa_archives(input_dir, num_chunks, output_dir, max_bytes=None, verbose=False):
     """Split all EcoTaxa export archives into the specified number of chunks per archive.
 
-    The EcoTaxa archives should be provided as the path of a directory of archives.
+    The EcoTaxa archives should be provided as the path of a directory of archives. If a maximum
+    size is specified for the chunks, it's applied as in process_single_ecotaxa_archive.
 
     The split EcoTaxa export archive chunks will be saved to the export directory, each with a
-    "-chunk{number}" suffix appended before the ".zip" file extension.
+    "-chunk{number}" suffix appended before the ".zip" file extension. Each archive is profiled as
+    a separate dataset.
     """
     for archive_path in os.listdir(input_dir):
         archive_path = pathlib.Path(input_dir).joinpath(archive_path)
@@ -126,8 +216,156 @@ def process_all_ecotaxa_archives(input_dir, num_chunks, output_dir, verbose=Fals
             if verbose:
                 print(f'Skipping archive file {archive_path} because it\'s not a ZIP file!')
             continue
-        process_single_ecotaxa_archive(archive_path, num_chunks, output_dir, verbose=verbose)
+        # Datasets are named by acquisition ID, as in the profiles of the other batch subcommands
+        with profiling.dataset(archive_path.stem.removesuffix('-export')):
+            process_single_ecotaxa_archive(
+                archive_path, num_chunks, output_dir, max_bytes=max_bytes, verbose=verbose,
+            )
         print()
 
+# results subcommand
+
+def setup_results_parser(parser):
+    """Set up a (sub)parser for splitting a results archive into chunks with corrected metadata."""
+    parser.add_argument(
+        'input',
+        type=str,
+        help='Path of the results archive (ending in `-results.tar.gz`) to split',
+    )
+    parser.add_argument(
+        'corrections',
+        type=argparse.FileType(mode='r'),
+        help='Path of a JSON file consisting of an object with field names and corrected values',
+    )
+    parser.add_argument(
+        'num_chunks',
+        type=int,
+        help='Number of chunks to split the EcoTaxa export archive into',
+    )
+    parser.add_argument(
+        'output',
+        type=str,
+        help='Directory in which to save the split-up EcoTaxa export archive chunks',
+    )
+    parser.add_argument(
+        'changes',
+        type=argparse.FileType(mode='w'),
+        help='Path of JSON file to create listing the changes made',
+    )
+    _add_max_bytes_argument(parser)
+    parser.add_argument(
+        '--memory-cap',
+        type=files.parse_size,
+        default=files.default_memory_cap,
+        help=(
+            'Maximum size (e.g. 256M) of intermediate files to keep in memory before spilling them '
+            'to disk; 0 keeps them on disk'
+        ),
+    )
+    parser.set_defaults(func=lambda args: process_single_results_archive(
+        args.input, args.corrections, args.num_chunks, args.output, args.changes,
+        max_bytes=args.max_bytes, memory_cap=args.memory_cap, verbose=args.verbose,
+    ))
+
+def process_single_results_archive(
+    results_path, corrections, num_chunks, output_dir_path, changes_file,
+    max_bytes=None, memory_cap=files.default_memory_cap, keep_unsplit=False, verbose=False,
+):
+    """Split the EcoTaxa export archive of a results archive into chunks, correcting metadata.
+
+    This produces the same chunks as correcting the metadata with `ecotaxa-metadata-edit` and then
+    splitting the corrected EcoTaxa export archive, but without writing and re-reading a corrected
+    EcoTaxa export archive: the corrected metadata file is split directly, and images are copied
+    straight from the EcoTaxa export archive of the results archive to the chunks. The EcoTaxa
+    export archive is read directly out of the results archive if the results archive has an index,
+    and otherwise it's extracted to a temporary file (kept in memory up to the memory cap).
+
+    The corrections dict specifies the values of metadata fields to correct; it can instead be
+    provided as a file-like object containing a JSON string representing the corrections dict. The
+    number of chunks and the maximum size of each chunk are used as in
+    process_single_ecotaxa_archive.
+
+    The resulting chunks are saved to the specified output directory, each named as
+    `{acquisition-id}-export-chunk{number}.zip`; if keep_unsplit is set and only one chunk is made,
+    it's instead named as `{acquisition-id}-export.zip` (as made by `ecotaxa-metadata-edit`).
+    Chunks are written atomically, and chunks left over from a previous run (and, if keep_unsplit is
+    set, an unsplit archive left over from a previous run) are deleted. Changes made to the metadata are recorded as a JSON string in
+    the changes file, unless no changes file is provided.
+
+    Returns the paths of the chunks.
+    """
+    _check_num_chunks(num_chunks, max_bytes)
+    results_path = pathlib.Path(results_path)
+    acq_id = results_path.name.removesuffix('.tar.gz').removesuffix('-results')
+    corrections, object_overrides = export_ecotaxa.load_corrections(corrections)
+    with (
+        open(results_path, 'rb') as results_file,
+        results.open_ecotaxa_export(
+            results_file, memory_cap=memory_cap, verbose=verbose,
+        ) as ecotaxa_archive,
+        files.spooled_temporary_file(
+            memory_cap=memory_cap, mode='w+', encoding='utf-8', newline='',
+            prefix='tots-ps-ecotaxa-metadata', suffix='.tsv',
+        ) as metadata_file,
+    ):
+        if verbose:
+            print(f'Correcting metadata of {results_path}...')
+        with (
+            profiling.stage('rewrite_metadata') as stage,
+            zipfile.ZipFile(ecotaxa_archive, mode='r') as input_zip,
+            archive.open_metadata_file(input_zip) as input_metadata_file,
+        ):
+            updated_fields = export_ecotaxa.stream_rewrite_metadata(
+                input_metadata_file, metadata_file, corrections,
+                object_overrides=object_overrides, verbose=verbose,
+            )
+            if stage:
+                stage.add(
+                    bytes_read=input_zip.getinfo('ecotaxa_export.tsv').file_size,
+                    bytes_written=metadata_file.tell(),
+                )
+        chunks = None
+        if max_bytes is not None:
+            if verbose:
+                print(f'Planning chunks of at most {_print_size(max_bytes)}...')
+            metadata_file.seek(0)
+            chunks = ecotaxa.plan_chunks(
+                ecotaxa_archive, max_bytes, min_chunks=num_chunks, metadata_file=metadata_file,
+                verbose=verbose,
+            )
+            num_chunks = len(chunks)
+        metadata_file.seek(0)
+        output_paths = [
+            pathlib.Path(output_dir_path) / f'{acq_id}-export-chunk{i}.zip'
+            for i in range(num_chunks)
+        ]
+        if keep_unsplit and num_chunks == 1:
+            output_paths = [pathlib.Path(output_dir_path) / f'{acq_id}-export.zip']
+        with contextlib.ExitStack() as stack:
+            output_files = [
+                stack.enter_context(files.atomic_output(output_path, mode='wb'))
+                for output_path in output_paths
+            ]
+            if verbose:
+                print(f'Writing {num_chunks} chunks to {output_dir_path}...')
+            ecotaxa.split_archive(
+                ecotaxa_archive, output_files, chunks=chunks, metadata_file=metadata_file,
+                memory_cap=memory_cap, verbose=verbose,
+            )
+    remove_stale_chunks(
+        output_dir_path, f'{acq_id}-export', output_paths, include_unsplit=keep_unsplit,
+        verbose=verbose,
+    )
+    if verbose:
+        for output_path in output_paths:
+            print(f'{output_path}: {_print_size(os.path.getsize(output_path))}')
+    if changes_file is not None:
+        if verbose:
+            print(f'Recording changes to {changes_file.name}...')
+        json.dump(
+            export_ecotaxa.describe_changes(corrections, updated_fields), changes_file, indent=2,
+        )
+    return output_paths
+
 if __name__ == '__main__':
     main()
@@ -1,65 +1,261 @@
 # -*- coding: utf-8 -*-
 """Handling of PlanktoScope ecotaxa export files"""
 
-import collections
-import csv
-import tempfile
+import contextlib
 import zipfile
 
 from .. import archive
+from .. import files
 from .. import metadata
+from .. import profiling
 
 # EcoTaxa export archives
 
-def chunk_archive(input_archive, num_chunks, chunk_index, output_archive, verbose=False):
+def chunk_archive(
+    input_archive, num_chunks, chunk_index, output_archive, row_indices=None, verbose=False,
+):
     """Copy the specified chunk of the input archive to the output archive.
 
-    The input archive is not modified.
+    By default, objects are dealt out to the chunks round-robin. Alternatively, the indices of the
+    rows (among the data rows of the metadata file) of the objects in the chunk can be provided,
+    e.g. from plan_chunks.
+
+    To write all chunks of the input archive, split_archive is much faster, since it only needs to
+    read the input archive once. The input archive is not modified.
     """
-    with tempfile.TemporaryFile(
-        mode='w+', prefix='tots-ps-ecotaxa-metadata', suffix='.tsv',
-    ) as metadata_file:
-        archive.extract_metadata_file(input_archive, metadata_file)
-        metadata_file.seek(0)
-        data_rows = _chunk_metadata(
-            metadata_file, num_chunks, chunk_index, metadata_file,
-            verbose=verbose,
+    output_archives = [None] * num_chunks
+    output_archives[chunk_index] = output_archive
+    chunks = None
+    if row_indices is not None:
+        chunks = [[] for _ in range(num_chunks)]
+        chunks[chunk_index] = row_indices
+    split_archive(input_archive, output_archives, chunks=chunks, verbose=verbose)
+
+def split_archive(
+    input_archive, output_archives, chunks=None, metadata_file=None,
+    memory_cap=files.default_memory_cap, verbose=False,
+):
+    """Split the input archive into chunks, writing all of the chunks in a single pass.
+
+    One output archive should be provided for each chunk, or None for any chunk which shouldn't be
+    written. By default, objects are dealt out to the chunks round-robin. Alternatively, the chunks
+    can be provided as lists of the indices of rows (among the data rows of the metadata file) of
+    the objects in each chunk, e.g. from plan_chunks.
+
+    The metadata file is parsed only once. As each row is read, it's routed to the metadata file of
+    its chunk, and the image of its object is copied (without being decompressed or recompressed)
+    straight to the output archive of its chunk. The metadata file of each chunk is kept in a
+    temporary file (in memory unless it grows beyond the memory cap) until all images have been
+    copied, and then it's written to the output archive of the chunk. So splitting takes about as
+    long as a single sequential read of the input archive, regardless of the number of chunks.
+
+    If a metadata file (opened as a text stream) is provided, it's split instead of the metadata
+    file of the input archive, e.g. so that corrected metadata can be split directly. The input
+    archive is not modified.
+
+    Returns a list of the number of objects written to each chunk.
+    """
+    with profiling.stage('split_archive') as stage:
+        num_objects = _split_archive(
+            input_archive, output_archives, chunks=chunks, metadata_file=metadata_file,
+            memory_cap=memory_cap, verbose=verbose,
         )
+        if stage:
+            stage.add(
+                bytes_read=profiling.file_size(input_archive),
+                bytes_written=sum(
+                    profiling.file_size(output_archive) or 0
+                    for output_archive in output_archives if output_archive is not None
+                ),
+                objects=sum(num_objects),
+            )
+    return num_objects
+
+def _split_archive(
+    input_archive, output_archives, chunks=None, metadata_file=None,
+    memory_cap=files.default_memory_cap, verbose=False,
+):
+    """Split the input archive into chunks, as described for split_archive."""
+    num_chunks = len(output_archives)
+    chunk_indices = None
+    if chunks is not None:
+        if len(chunks) != num_chunks:
+            raise ValueError(f'Got {len(chunks)} chunks but {num_chunks} output archives')
+        chunk_indices = {
+            row_index: chunk_index
+            for chunk_index, row_indices in enumerate(chunks)
+            for row_index in row_indices
+        }
+    with contextlib.ExitStack() as stack:
+        input_zip = stack.enter_context(zipfile.ZipFile(input_archive, mode='r'))
+        if metadata_file is None:
+            metadata_file = stack.enter_context(archive.open_metadata_file(input_zip))
+        field_names, field_types, data_rows = metadata.read_rows(metadata_file)
+        image_column = field_names.index('img_file_name')
+        output_zips = [
+            None if output_archive is None
+            else stack.enter_context(zipfile.ZipFile(output_archive, mode='w'))
+            for output_archive in output_archives
+        ]
+        chunk_metadata_files = [
+            None if output_zip is None
+            else stack.enter_context(files.spooled_temporary_file(
+                memory_cap=memory_cap, mode='w+', encoding='utf-8', newline='',
+                prefix='tots-ps-ecotaxa-metadata', suffix='.tsv',
+            ))
+            for output_zip in output_zips
+        ]
+        writers = [
+            None if chunk_metadata_file is None
+            else metadata.make_writer(chunk_metadata_file, field_names, field_types)
+            for chunk_metadata_file in chunk_metadata_files
+        ]
+
+        num_objects = [0] * num_chunks
+        num_rows = 0
+        for row_index, row in enumerate(data_rows):
+            num_rows += 1
+            if chunk_indices is None:
+                chunk_index = row_index % num_chunks
+            else:
+                chunk_index = chunk_indices.get(row_index)
+            if chunk_index is None or output_zips[chunk_index] is None:
+                continue
+            row.extend([''] * (len(field_names) - len(row)))
+            writers[chunk_index].writerow(row)
+            archive.copy_member(
+                input_zip, input_zip.getinfo(row[image_column]), output_zips[chunk_index],
+            )
+            num_objects[chunk_index] += 1
+
         if verbose:
-            print(f'Writing metadata to {output_archive.name}...')
-        with (
-            zipfile.ZipFile(output_archive, mode='w') as output_zip,
-            zipfile.ZipFile(input_archive, mode='r') as input_zip,
+            print(f'  Number of objects in all chunks: {num_rows}')
+        for chunk_index, (output_zip, chunk_metadata_file) in enumerate(
+            zip(output_zips, chunk_metadata_files),
         ):
-            metadata_file.seek(0)
-            output_zip.writestr('ecotaxa_export.tsv', metadata_file.read())
-            for data_row in data_rows:
-                image_path = data_row['img_file_name']
-                output_zip.writestr(image_path, input_zip.read(image_path))
+            if output_zip is None:
+                continue
+            if verbose:
+                print(f'  Number of objects in chunk {chunk_index}: {num_objects[chunk_index]}')
+                print(f'Writing metadata to {output_archives[chunk_index].name}...')
+            chunk_metadata_file.seek(0)
+            archive.write_metadata_file(output_zip, chunk_metadata_file)
+    return num_objects
 
-# EcoTaxa metadata tables
+def plan_chunks(input_archive, max_bytes, min_chunks=1, metadata_file=None, verbose=False):
+    """Assign the objects of the input archive to chunks which each fit within the size budget.
 
-def _chunk_metadata(metadata_file, num_chunks, chunk_index, output_file, verbose=False):
-    """Rewrite the EcoTaxa object metadata TSV file to only include the specified chunk.
+    The size of each object in a chunk is determined from the compressed size of its image (as
+    recorded in the central directory of the input archive) and the size of its row in the metadata
+    file, together with the overhead of zip file headers; the metadata file of each chunk is assumed
+    to be incompressible, so that every chunk written by split_archive is guaranteed to be no larger
+    than the maximum number of bytes. Objects are packed into as few chunks as possible (by
+    first-fit decreasing), unless that would be fewer than the minimum number of chunks, in which
+    case objects are spread out evenly over the minimum number of chunks.
 
-    Returns the rows of the specified chunk.
+    Returns a list of chunks, each as a list of the indices (in increasing order) of the rows of
+    its objects among the data rows of the metadata file. Raises a ValueError if any object can't
+    fit in a chunk by itself.
 
-    The cursor of the table file must be at the appropriate location before the function is called,
-    and it is left at the end of the file."""
-    field_types, data_rows = metadata.read_file(metadata_file)
-    if verbose:
-        print(f'  Number of objects in all chunks: {len(data_rows)}')
-    chunks = list(_chunk_rows(data_rows, num_chunks))
-    data_rows = chunks[chunk_index]
+    If a metadata file (opened as a text stream) is provided, it's used instead of the metadata
+    file of the input archive, in the same way as for split_archive.
+    """
+    with profiling.stage('plan_chunks') as stage:
+        chunks = _plan_chunks(
+            input_archive, max_bytes, min_chunks=min_chunks, metadata_file=metadata_file,
+            verbose=verbose,
+        )
+        if stage:
+            stage.add(objects=sum(len(row_indices) for row_indices in chunks))
+    return chunks
+
+def _plan_chunks(input_archive, max_bytes, min_chunks=1, metadata_file=None, verbose=False):
+    """Assign the objects of the input archive to chunks, as described for plan_chunks."""
+    zip64_offset = max_bytes > _zip64_offset_limit
+    with contextlib.ExitStack() as stack:
+        input_zip = stack.enter_context(zipfile.ZipFile(input_archive, mode='r'))
+        if metadata_file is None:
+            metadata_file = stack.enter_context(archive.open_metadata_file(input_zip))
+        field_names, field_types, data_rows = metadata.read_rows(metadata_file)
+        image_column = field_names.index('img_file_name')
+        header_size = metadata.row_size(field_names) + metadata.row_size(field_types)
+        object_sizes = []
+        for row in data_rows:
+            # Missing values are written out as empty values in each chunk
+            row.extend([''] * (len(field_names) - len(row)))
+            image_size = archive.copied_member_size(
+                input_zip.getinfo(row[image_column]), zip64_offset=zip64_offset,
+            )
+            object_sizes.append((image_size, metadata.row_size(row)))
+
+    def chunk_size(images_size, rows_size):
+        return (
+            images_size
+            + archive.metadata_file_size_bound(header_size + rows_size, zip64_offset=zip64_offset)
+            + archive.end_of_archive_size
+        )
+
+    for i, (image_size, row_size) in enumerate(object_sizes):
+        if chunk_size(image_size, row_size) > max_bytes:
+            raise ValueError(
+                f'Object {i} needs up to {chunk_size(image_size, row_size):,} bytes by itself, '
+                f'which exceeds the maximum chunk size of {max_bytes:,} bytes',
+            )
+    chunks = _pack_first_fit(object_sizes, chunk_size, max_bytes)
+    if len(chunks) < min_chunks:
+        chunks = _pack_evenly(object_sizes, chunk_size, max_bytes, min_chunks)
+    chunks = [sorted(row_indices) for row_indices in chunks] or [[]]
     if verbose:
-        print(f'  Number of objects in chunk {chunk_index}: {len(data_rows)}')
-        print(f'  Images: {data_rows[0]["img_file_name"]}, {data_rows[1]["img_file_name"]}, ...')
-    output_file.seek(0)
-    output_file.truncate()
-    metadata.write_file(output_file, field_types, data_rows)
-    return data_rows
-
-def _chunk_rows(data_rows, num_chunks):
-    """Split up the provided list of rows into the specified number of lists."""
-    for i in range(0, num_chunks):
-        yield data_rows[i::num_chunks]
+        print(f'  Number of objects in all chunks: {len(object_sizes)}')
+        for i, row_indices in enumerate(chunks):
+            images_size = sum(object_sizes[j][0] for j in row_indices)
+            rows_size = sum(object_sizes[j][1] for j in row_indices)
+            print(
+                f'  Chunk {i}: {len(row_indices)} objects, at most '
+                f'{chunk_size(images_size, rows_size):,} bytes',
+            )
+    return chunks
+
+_zip64_offset_limit = 0xFFFFFFFF # bytes
+
+def _pack_first_fit(object_sizes, chunk_size, max_bytes):
+    """Pack objects into as few chunks as possible, placing the largest objects first.
+
+    Returns a list of chunks, each as a list of the indices of its objects.
+    """
+    chunks = [] # each as [images size, rows size, object indices]
+    for i in sorted(range(len(object_sizes)), key=lambda i: sum(object_sizes[i]), reverse=True):
+        image_size, row_size = object_sizes[i]
+        for chunk in chunks:
+            if chunk_size(chunk[0] + image_size, chunk[1] + row_size) <= max_bytes:
+                break
+        else:
+            chunk = [0, 0, []]
+            chunks.append(chunk)
+        chunk[0] += image_size
+        chunk[1] += row_size
+        chunk[2].append(i)
+    return [chunk[2] for chunk in chunks]
+
+def _pack_evenly(object_sizes, chunk_size, max_bytes, num_chunks):
+    """Pack objects into the specified number of chunks, filling the emptiest chunk first.
+
+    More chunks are added if an object doesn't fit in any of the chunks. Returns a list of chunks,
+    each as a list of the indices of its objects.
+    """
+    chunks = [[0, 0, []] for _ in range(num_chunks)]
+    for i in sorted(range(len(object_sizes)), key=lambda i: sum(object_sizes[i]), reverse=True):
+        image_size, row_size = object_sizes[i]
+        fitting_chunks = [
+            chunk for chunk in chunks
+            if chunk_size(chunk[0] + image_size, chunk[1] + row_size) <= max_bytes
+        ]
+        if fitting_chunks:
+            chunk = min(fitting_chunks, key=lambda chunk: chunk[0] + chunk[1])
+        else:
+            chunk = [0, 0, []]
+            chunks.append(chunk)
+        chunk[0] += image_size
+        chunk[1] += row_size
+        chunk[2].append(i)
+    return [chunk[2] for chunk in chunks]
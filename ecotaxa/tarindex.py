@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+"""Random-access indexing of gzip-compressed tar archives, such as PlanktoScope results archives
+
+An index records the offset and size of each regular file in the uncompressed tar stream, along with
+periodic checkpoints of the state of the gzip decompressor (in the style of the zran.c example
+from zlib), so that any member can be read by decompressing from the nearest preceding checkpoint
+rather than from the start of the archive. Indexes are saved as JSON sidecar files next to their
+archives.
+
+Resuming decompression from a checkpoint needs zlib features which Python's zlib module doesn't
+expose (Z_BLOCK and inflatePrime), so the zlib shared library is used through ctypes instead. If it
+can't be loaded, indexes can't be built or used, and readers should fall back to decompressing
+archives from the start.
+"""
+
+import base64
+import bisect
+import ctypes
+import ctypes.util
+import io
+import json
+import os
+import pathlib
+import tarfile
+import zlib
+
+from . import files
+
+index_suffix = '.index.json'
+_index_format = 1
+
+_window_size = 32 * 1024 # bytes; this is the maximum distance of a back-reference in deflate
+default_span = 4 * 1024 * 1024 # bytes of uncompressed data between checkpoints
+_input_block_size = 64 * 1024 # bytes
+_output_block_size = 256 * 1024 # bytes
+
+# zlib bindings
+
+_Z_OK = 0
+_Z_STREAM_END = 1
+_Z_BUF_ERROR = -5
+_Z_NO_FLUSH = 0
+_Z_BLOCK = 5
+_gzip_window_bits = 32 + 15 # decode a gzip (or zlib) header
+_raw_window_bits = -15 # decode raw deflate data, e.g. starting from a checkpoint
+_data_type_block_boundary = 128
+_data_type_last_block = 64
+_data_type_unused_bits = 7
+
+class _ZStream(ctypes.Structure):
+    """The z_stream struct of zlib."""
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+_libz = None
+
+def _load_libz():
+    """Load the zlib shared library, raising an OSError if it can't be found."""
+    global _libz
+    if _libz is not None:
+        return _libz
+    candidates = [ctypes.util.find_library('z'), 'libz.so.1', 'libz.dylib']
+    for candidate in candidates:
+        if candidate is None:
+            continue
+        try:
+            libz = ctypes.CDLL(candidate)
+            break
+        except OSError:
+            continue
+    else:
+        raise OSError('Couldn\'t load the zlib shared library')
+    stream_pointer = ctypes.POINTER(_ZStream)
+    libz.zlibVersion.restype = ctypes.c_char_p
+    libz.zlibVersion.argtypes = []
+    libz.inflateInit2_.restype = ctypes.c_int
+    libz.inflateInit2_.argtypes = [stream_pointer, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    libz.inflate.restype = ctypes.c_int
+    libz.inflate.argtypes = [stream_pointer, ctypes.c_int]
+    libz.inflateEnd.restype = ctypes.c_int
+    libz.inflateEnd.argtypes = [stream_pointer]
+    libz.inflatePrime.restype = ctypes.c_int
+    libz.inflatePrime.argtypes = [stream_pointer, ctypes.c_int, ctypes.c_int]
+    libz.inflateSetDictionary.restype = ctypes.c_int
+    libz.inflateSetDictionary.argtypes = [stream_pointer, ctypes.c_char_p, ctypes.c_uint]
+    _libz = libz
+    return _libz
+
+def available():
+    """Check whether indexes can be built and used, i.e. whether zlib can be loaded via ctypes."""
+    try:
+        _load_libz()
+    except OSError:
+        return False
+    return True
+
+class _Inflater:
+    """A zlib inflate stream which reads compressed data from a position in a file.
+
+    The position in the file is tracked independently of the file's cursor, so that multiple
+    inflaters can share the same file.
+    """
+
+    def __init__(self, input_file, input_position, window_bits):
+        self._initialized = False
+        self._libz = _load_libz()
+        self._stream = _ZStream()
+        self._input_file = input_file
+        self._input_position = input_position
+        self._input_buffer = ctypes.create_string_buffer(_input_block_size)
+        self._input_eof = False
+        ret = self._libz.inflateInit2_(
+            ctypes.byref(self._stream), window_bits, self._libz.zlibVersion(),
+            ctypes.sizeof(_ZStream),
+        )
+        if ret != _Z_OK:
+            raise zlib.error(f'Couldn\'t initialize zlib inflate stream (error {ret})')
+        self._initialized = True
+
+    def close(self):
+        """Free the resources of the inflate stream."""
+        if self._initialized:
+            self._libz.inflateEnd(ctypes.byref(self._stream))
+            self._initialized = False
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def total_in(self):
+        """Number of compressed bytes consumed so far."""
+        return self._stream.total_in
+
+    @property
+    def data_type(self):
+        """The data_type field of the stream, which describes the decoder's position in a block."""
+        return self._stream.data_type
+
+    def prime(self, bits, value):
+        """Insert bits into the input stream, to resume decompression in the middle of a byte."""
+        ret = self._libz.inflatePrime(ctypes.byref(self._stream), bits, value)
+        if ret != _Z_OK:
+            raise zlib.error(f'Couldn\'t prime zlib inflate stream (error {ret})')
+
+    def set_dictionary(self, window):
+        """Set the window of preceding data, to resume decompression at a checkpoint."""
+        ret = self._libz.inflateSetDictionary(ctypes.byref(self._stream), window, len(window))
+        if ret != _Z_OK:
+            raise zlib.error(f'Couldn\'t set zlib inflate dictionary (error {ret})')
+
+    def has_trailing_data(self):
+        """Check whether there's any more compressed data after the end of the stream."""
+        if self._stream.avail_in > 0:
+            return True
+        self._input_file.seek(self._input_position)
+        return bool(self._input_file.read(1))
+
+    def inflate(self, output_address, output_size, flush=_Z_NO_FLUSH):
+        """Decompress data into the memory at the specified address.
+
+        With the Z_NO_FLUSH flush mode, this returns as soon as any data was decompressed; with the
+        Z_BLOCK flush mode, this also returns at every deflate block boundary.
+
+        Returns the number of bytes decompressed, and whether the end of the stream was reached.
+        """
+        stream = self._stream
+        stream.next_out = output_address
+        stream.avail_out = output_size
+        while True:
+            if stream.avail_in == 0 and not self._input_eof:
+                self._input_file.seek(self._input_position)
+                input_size = self._input_file.readinto(self._input_buffer)
+                if not input_size:
+                    self._input_eof = True
+                else:
+                    self._input_position += input_size
+                    stream.next_in = ctypes.addressof(self._input_buffer)
+                    stream.avail_in = input_size
+            ret = self._libz.inflate(ctypes.byref(stream), flush)
+            output_length = output_size - stream.avail_out
+            if ret == _Z_STREAM_END:
+                return output_length, True
+            if ret == _Z_BUF_ERROR:
+                if self._input_eof and stream.avail_in == 0:
+                    raise EOFError('Compressed file ended before the end of the compressed stream')
+                continue
+            if ret != _Z_OK:
+                message = stream.msg.decode('utf-8', 'replace') if stream.msg else ret
+                raise zlib.error(f'Error while decompressing: {message}')
+            if output_length > 0 or stream.avail_out == 0 or flush == _Z_BLOCK:
+                return output_length, False
+
+# Index building
+
+def build_index(archive_path, span=default_span, verbose=False):
+    """Build an index for the gzip-compressed tar archive at the specified path.
+
+    The archive is decompressed once from start to end. The index is saved as a sidecar file next to
+    the archive, and it's also returned.
+    """
+    archive_path = pathlib.Path(archive_path)
+    if verbose:
+        print(f'Indexing {archive_path}...')
+    with open(archive_path, 'rb') as archive_file:
+        stat = os.fstat(archive_file.fileno())
+        index = index_archive(archive_file, span=span)
+    index['archive'] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    save_index(index, archive_path)
+    if verbose:
+        print(
+            f'Indexed {len(index["members"])} members with {len(index["checkpoints"])} '
+            f'checkpoints in {index_path(archive_path)}',
+        )
+    return index
+
+def index_archive(archive_file, span=default_span):
+    """Build an index for the gzip-compressed tar archive in the file, without saving it.
+
+    Both the checkpoints and the member offsets are recorded in a single pass over the archive.
+    """
+    archive_file.seek(0)
+    reader = _IndexingReader(archive_file, span)
+    members = []
+    with tarfile.open(fileobj=io.BufferedReader(reader), mode='r|') as archive_tar:
+        for tarinfo in archive_tar:
+            if tarinfo.isreg():
+                members.append((tarinfo.name, tarinfo.offset_data, tarinfo.size))
+    while not reader.eof:
+        reader.advance()
+    return make_index(span, reader.total_out, reader.checkpoints, members)
+
+def make_index(span, uncompressed_size, checkpoints, members, **fields):
+    """Assemble an index from the checkpoints and member offsets recorded for an archive.
+
+    Checkpoints are (uncompressed offset, compressed offset, unused bits, window) tuples, and
+    members are (name, uncompressed offset, size) tuples of the archive's regular files. Any other
+    fields are included in the index as-is.
+    """
+    return {
+        'format': _index_format,
+        'span': span,
+        'uncompressed_size': uncompressed_size,
+        'checkpoints': checkpoints,
+        'members': members,
+        **fields,
+    }
+
+class _IndexingReader(io.RawIOBase):
+    """A reader which decompresses a gzip file from the start, recording checkpoints along the way.
+
+    Checkpoints are recorded at deflate block boundaries, at least the span apart. Each checkpoint
+    is an (uncompressed offset, compressed offset, unused bits, window) tuple, where the window is
+    the 32 kiB of uncompressed data preceding the checkpoint.
+    """
+
+    def __init__(self, input_file, span):
+        super().__init__()
+        self._inflater = _Inflater(input_file, input_file.tell(), _gzip_window_bits)
+        self._span = span
+        self._window = bytearray(_window_size) # circular buffer of the latest uncompressed data
+        self._window_view = (ctypes.c_char * _window_size).from_buffer(self._window)
+        self._window_position = 0
+        self._unread_start = 0
+        self._unread_end = 0
+        self._last_checkpoint = None
+        self.checkpoints = []
+        self.total_out = 0
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._unread_start == self._unread_end:
+            if self.eof:
+                return 0
+            self.advance()
+        size = min(len(buffer), self._unread_end - self._unread_start)
+        buffer[:size] = self._window[self._unread_start:self._unread_start + size]
+        self._unread_start += size
+        return size
+
+    def advance(self):
+        """Decompress data up to the next block boundary, adding a checkpoint there if needed.
+
+        Any previously-decompressed data which hasn't been read yet is discarded.
+        """
+        if self._window_position == _window_size:
+            self._window_position = 0
+        start = self._window_position
+        output_length, stream_end = self._inflater.inflate(
+            ctypes.addressof(self._window_view) + start, _window_size - start, flush=_Z_BLOCK,
+        )
+        self._window_position += output_length
+        self._unread_start = start
+        self._unread_end = start + output_length
+        self.total_out += output_length
+        if stream_end:
+            self.eof = True
+            if self._inflater.has_trailing_data():
+                raise ValueError('Archives with multiple gzip streams aren\'t supported')
+            self._inflater.close()
+            return
+        data_type = self._inflater.data_type
+        if not data_type & _data_type_block_boundary or data_type & _data_type_last_block:
+            return
+        if (
+            self._last_checkpoint is not None
+            and self.total_out - self._last_checkpoint <= self._span
+        ):
+            return
+        window = bytes(self._window[self._window_position:] + self._window[:self._window_position])
+        self.checkpoints.append(
+            (self.total_out, self._inflater.total_in, data_type & _data_type_unused_bits, window),
+        )
+        self._last_checkpoint = self.total_out
+
+# Index files
+
+def index_path(archive_path):
+    """Determine the path of the index sidecar file for the archive at the specified path."""
+    return pathlib.Path(f'{archive_path}{index_suffix}')
+
+def save_index(index, archive_path):
+    """Atomically save the index as a sidecar file next to the archive at the specified path."""
+    serialized = dict(index)
+    serialized['checkpoints'] = [
+        [out_offset, in_offset, bits, base64.b64encode(zlib.compress(window)).decode('ascii')]
+        for (out_offset, in_offset, bits, window) in index['checkpoints']
+    ]
+    serialized['members'] = [list(member) for member in index['members']]
+    with files.atomic_output(index_path(archive_path), mode='w') as index_file:
+        json.dump(serialized, index_file)
+
+def load_index(archive_path):
+    """Load the index of the archive at the specified path, if it has an up-to-date index.
+
+    Returns None if the archive has no index, if its index is out-of-date (i.e. the archive was
+    modified after it was indexed), or if indexes can't be used.
+    """
+    if archive_path is None or not available():
+        return None
+    try:
+        with open(index_path(archive_path), 'r') as index_file:
+            serialized = json.load(index_file)
+        stat = os.stat(archive_path)
+    except (OSError, ValueError):
+        return None
+    if serialized.get('format') != _index_format:
+        return None
+    if serialized.get('archive') != {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}:
+        return None
+    index = dict(serialized)
+    index['checkpoints'] = [
+        (out_offset, in_offset, bits, window)
+        for (out_offset, in_offset, bits, window) in serialized['checkpoints']
+    ]
+    index['members'] = [tuple(member) for member in serialized['members']]
+    return index
+
+def member_names(index):
+    """List the names of the regular files in the indexed archive, in archive order."""
+    return [name for (name, _, _) in index['members']]
+
+# Random access
+
+def open_member(archive_file, index, name):
+    """Open a member of the indexed archive as a seekable binary file object for reading.
+
+    Only the compressed data between the nearest checkpoint preceding the member and the end of the
+    member needs to be decompressed.
+    """
+    for member_name, offset, size in index['members']:
+        if member_name == name:
+            break
+    else:
+        raise KeyError(f'{name} not found in archive index')
+    return io.BufferedReader(_MemberReader(archive_file, index, offset, size))
+
+class _MemberReader(io.RawIOBase):
+    """A seekable reader for a range of the uncompressed data of an indexed archive."""
+
+    def __init__(self, archive_file, index, offset, size):
+        super().__init__()
+        self._archive_file = archive_file
+        self._checkpoints = index['checkpoints']
+        self._checkpoint_offsets = [checkpoint[0] for checkpoint in self._checkpoints]
+        self._span = index['span']
+        self._offset = offset
+        self._size = size
+        self._position = 0
+        self._inflater = None
+        self._inflater_offset = None # uncompressed offset where the inflater will produce data
+        self._output = bytearray(_output_block_size)
+        self._output_view = (ctypes.c_char * _output_block_size).from_buffer(self._output)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError(f'Invalid whence: {whence}')
+        if position < 0:
+            raise ValueError(f'Negative seek position {position}')
+        self._position = position
+        return position
+
+    def readinto(self, buffer):
+        if self._position >= self._size:
+            return 0
+        target = self._offset + self._position
+        if self._inflater_offset != target:
+            self._reposition(target)
+        size = min(len(buffer), self._size - self._position, _output_block_size)
+        output_length = self._inflate(size)
+        buffer[:output_length] = self._output[:output_length]
+        self._position += output_length
+        return output_length
+
+    def close(self):
+        if self._inflater is not None:
+            self._inflater.close()
+            self._inflater = None
+        super().close()
+
+    def _inflate(self, size):
+        """Decompress up to the specified number of bytes into the output buffer."""
+        output_length, stream_end = self._inflater.inflate(
+            ctypes.addressof(self._output_view), size,
+        )
+        if output_length == 0 and stream_end:
+            raise EOFError('Archive ended before the end of the member')
+        self._inflater_offset += output_length
+        return output_length
+
+    def _reposition(self, target):
+        """Prepare the inflater to decompress data starting at the specified uncompressed offset."""
+        if (
+            self._inflater is None
+            or not self._inflater_offset <= target < self._inflater_offset + self._span
+        ):
+            self._restart(target)
+        while self._inflater_offset < target:
+            self._inflate(min(target - self._inflater_offset, _output_block_size))
+
+    def _restart(self, target):
+        """Restart decompression from the nearest checkpoint preceding the uncompressed offset."""
+        if self._inflater is not None:
+            self._inflater.close()
+        i = bisect.bisect_right(self._checkpoint_offsets, target) - 1
+        out_offset, in_offset, bits, window = self._checkpoints[i]
+        if isinstance(window, str): # windows of loaded indexes are only decoded when first needed
+            window = zlib.decompress(base64.b64decode(window))
+            self._checkpoints[i] = (out_offset, in_offset, bits, window)
+        if bits:
+            self._archive_file.seek(in_offset - 1)
+            value = self._archive_file.read(1)[0] >> (8 - bits)
+        self._inflater = _Inflater(self._archive_file, in_offset, _raw_window_bits)
+        if bits:
+            self._inflater.prime(bits, value)
+        self._inflater.set_dictionary(window)
+        self._inflater_offset = out_offset
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""Adjustment of the brightness of raw frames, like ImageMagick's `-evaluate add`"""
+
+import concurrent.futures
+import contextlib
+import functools
+import os
+import pathlib
+import re
+
+from ecotaxa import batch
+from . import imaging
+
+_adjustment_pattern = re.compile(r'([+-]?[0-9]+(?:\.[0-9]*)?)%')
+_frame_suffixes = ('.jpg', '.jpeg')
+_staged_suffix = '.adjusted.tmp'
+
+def parse_adjustment(adjustment):
+    """Parse a brightness adjustment (e.g. '5%') as a percentage of the full brightness range.
+
+    Raises a ValueError if the adjustment can't be parsed.
+    """
+    match = _adjustment_pattern.fullmatch(adjustment.strip())
+    if match is None:
+        raise ValueError(f'Invalid brightness adjustment (expected e.g. 5%): {adjustment}')
+    return float(match.group(1))
+
+def load_adjustments(adjustments_dir):
+    """Load the brightness adjustments of datasets from the lists in the directory.
+
+    Each list is a text file (ending in `.txt`) with one dataset per line, given as its acquisition
+    ID followed by its brightness adjustment (e.g. `tots-ps-acq-588 5%`); blank lines and lines
+    starting with `#` are ignored. Returns a dict associating acquisition IDs with adjustments (as
+    strings). Raises a ValueError if a line can't be parsed, or if a dataset is listed with
+    different adjustments.
+    """
+    adjustments = {}
+    sources = {}
+    for list_path in sorted(pathlib.Path(adjustments_dir).glob('*.txt')):
+        with open(list_path, 'r') as list_file:
+            for line_number, line in enumerate(list_file, start=1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                location = f'{list_path}:{line_number}'
+                parts = line.split()
+                if len(parts) != 2:
+                    raise ValueError(f'Invalid line in {location}: {line}')
+                acq_id, adjustment = parts
+                parse_adjustment(adjustment)
+                if acq_id in adjustments and adjustments[acq_id] != adjustment:
+                    raise ValueError(
+                        f'Conflicting brightness adjustments for {acq_id}: '
+                        f'{adjustments[acq_id]} (in {sources[acq_id]}) and {adjustment} '
+                        f'(in {location})',
+                    )
+                adjustments[acq_id] = adjustment
+                sources[acq_id] = location
+    return adjustments
+
+def make_lookup_table(percentage):
+    """Make a table mapping each 8-bit value to its value after the brightness adjustment.
+
+    As with ImageMagick's `-evaluate add`, the percentage of the full range is added to each value
+    (of each color channel), and the results are rounded and clipped to the 8-bit range.
+    """
+    imaging.require()
+    np = imaging.np
+    offset = percentage / 100 * 255
+    return np.clip(np.rint(np.arange(256) + offset), 0, 255).astype(np.uint8)
+
+def stage_adjusted_frame(path, lookup_table):
+    """Write the JPEG frame at the path with its brightness adjusted to a staging file next to it.
+
+    The frame is re-encoded with its original quantization tables, chroma subsampling, and embedded
+    metadata. The frame itself is left untouched; returns the path of the staging file, which should
+    be renamed over the frame to replace it.
+    """
+    staged_path = _staged_path(path)
+    pixels, encoding = imaging.read_jpeg(path)
+    adjusted = lookup_table[pixels]
+    try:
+        with open(staged_path, 'wb') as output_file:
+            imaging.write_jpeg(output_file, adjusted, encoding)
+            output_file.flush()
+            os.fsync(output_file.fileno())
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(staged_path)
+        raise
+    return staged_path
+
+def _staged_path(path):
+    """Determine the path of the staging file of the adjusted frame at the path."""
+    path = pathlib.Path(path)
+    return os.fspath(path.with_name(f'.{path.name}{_staged_suffix}'))
+
+def _try_stage_adjusted_frame(path, lookup_table):
+    """Stage the adjusted frame, returning a (staging path, error message) pair.
+
+    Only one of the two is set, depending on whether the frame could be adjusted.
+    """
+    try:
+        return stage_adjusted_frame(path, lookup_table), None
+    except Exception as e: # a bad frame shouldn't stop the other frames from being checked
+        return None, f'{type(e).__name__}: {e}'
+
+def find_frames(frames_dir):
+    """List the paths of the JPEG frames in the directory and its subdirectories, in order."""
+    return sorted(
+        path for path in pathlib.Path(frames_dir).rglob('*')
+        if path.suffix.lower() in _frame_suffixes and path.is_file()
+    )
+
+def adjust_frames(frame_paths, adjustment, jobs=1, on_progress=None):
+    """Adjust the brightness of the JPEG frames in place, with the specified number of processes.
+
+    The adjustment is given as a string (e.g. '5%'). If a callback function is provided, it's
+    called with the number of frames processed so far, after each frame.
+
+    Frames are only replaced once all of them have been adjusted, so that the adjustment is never
+    applied to only some of the frames (which would make it impossible to simply re-run the
+    adjustment): every frame is adjusted into a staging file next to it, and the staging files are
+    only renamed over the frames if no frame failed. Returns a dict associating the path of each
+    frame which failed with an error message; if it's empty, all frames were adjusted, and
+    otherwise no frames were changed. An adjustment of 0% leaves the frames untouched.
+    """
+    imaging.require()
+    percentage = parse_adjustment(adjustment)
+    if percentage == 0:
+        return {}
+    lookup_table = make_lookup_table(percentage)
+    frame_paths = [os.fspath(path) for path in frame_paths]
+    failures = {}
+    replaced = False
+    try:
+        with contextlib.closing(
+            _stage_adjusted_frames(frame_paths, lookup_table, jobs),
+        ) as staged_frames:
+            for i, (path, (_, error)) in enumerate(zip(frame_paths, staged_frames)):
+                if error is not None:
+                    failures[path] = error
+                if on_progress is not None:
+                    on_progress(i + 1)
+        if not failures:
+            for path in frame_paths:
+                os.replace(_staged_path(path), path)
+            replaced = True
+    finally:
+        if not replaced:
+            # This also cleans up after an interruption, once any running workers have finished
+            for path in frame_paths:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(_staged_path(path))
+    return failures
+
+def _stage_adjusted_frames(frame_paths, lookup_table, jobs):
+    """Stage the adjusted frames with the specified number of processes.
+
+    Yields a (staging path, error message) pair for each frame, in order.
+    """
+    jobs = batch.resolve_jobs(jobs)
+    if jobs == 1 or len(frame_paths) <= 1:
+        for path in frame_paths:
+            yield _try_stage_adjusted_frame(path, lookup_table)
+        return
+
+    # Frames are sent to the workers in chunks, to amortize the cost of each round trip to a worker
+    chunk_size = max(1, min(64, len(frame_paths) // (jobs * 4)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(
+            functools.partial(_try_stage_adjusted_frame, lookup_table=lookup_table), frame_paths,
+            chunksize=chunk_size,
+        )
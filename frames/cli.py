@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Command line utility for working with the raw frames of ToTS PlanktoScope datasets"""
+
+import argparse
+import json
+import os
+import pathlib
+import sys
+import time
+import traceback
+
+from ecotaxa import batch
+from ecotaxa import files
+from ecotaxa.catalog import store as catalog_store
+from . import brightness
+from . import imaging
+from . import statistics
+
+def main():
+    """Adjust or scan the raw frames of PlanktoScope datasets."""
+    parser = argparse.ArgumentParser(
+        prog='tots-frames',
+        description='Work with the raw frames of ToTS PlanktoScope datasets',
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        default=False,
+        help='Print additional information for troubleshooting',
+    )
+    subparsers = parser.add_subparsers()
+    setup_adjust_parser(subparsers.add_parser('adjust'))
+    setup_scan_parser(subparsers.add_parser('scan'))
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except ImportError as e:
+        sys.exit(f'Error: {e}')
+
+# adjust subcommand
+
+def _check_adjustment(adjustment):
+    """Check that a brightness adjustment can be parsed, for use as an argparse type."""
+    brightness.parse_adjustment(adjustment)
+    return adjustment
+
+def setup_adjust_parser(parser):
+    """Set up a (sub)parser to adjust the brightness of the raw frames of a dataset in place."""
+    parser.add_argument(
+        'frames',
+        type=str,
+        help=(
+            'Directory of raw JPEG frames to adjust in place, including frames in its '
+            'subdirectories (e.g. /home/pi/data/img)'
+        ),
+    )
+    parser.add_argument(
+        '--adjustment',
+        type=_check_adjustment,
+        default=None,
+        help=(
+            'Brightness adjustment (e.g. 5%%) to add to every pixel, as a percentage of the full '
+            'brightness range; if --dataset and --adjustments are also given, this is only used '
+            'when the dataset isn\'t in the lists of adjustments'
+        ),
+    )
+    parser.add_argument(
+        '--dataset',
+        type=str,
+        default=None,
+        help='tots-ps acquisition ID of the dataset, to look up in the lists of adjustments',
+    )
+    parser.add_argument(
+        '--adjustments',
+        type=str,
+        default=None,
+        help=(
+            'Directory of text files listing the brightness adjustments of datasets, one dataset '
+            'per line (e.g. `tots-ps-acq-588 5%%`), such as project-metadata/brightness-adjustments'
+        ),
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=batch.parse_jobs,
+        default=0,
+        help='Number of frames to adjust in parallel (by default, 0 to use all CPU cores)',
+    )
+    parser.set_defaults(func=lambda args: adjust_dataset_frames(
+        args.frames, adjustment=args.adjustment, acq_id=args.dataset,
+        adjustments_dir=args.adjustments, jobs=args.jobs, verbose=args.verbose,
+    ))
+
+def adjust_dataset_frames(
+    frames_dir, adjustment=None, acq_id=None, adjustments_dir=None, jobs=0, verbose=False,
+):
+    """Adjust the brightness of the frames in the directory, in place.
+
+    If an acquisition ID and a directory of lists of adjustments are provided, the dataset's listed
+    adjustment is used, falling back to the provided adjustment if the dataset isn't listed. The
+    frames are left untouched if no adjustment applies. If any frame can't be adjusted, no frames
+    are changed, and the failures are reported before exiting with an error.
+    """
+    imaging.require()
+    if acq_id is not None and adjustments_dir is not None:
+        listed_adjustments = brightness.load_adjustments(adjustments_dir)
+        if acq_id in listed_adjustments:
+            adjustment = listed_adjustments[acq_id]
+            if verbose:
+                print(f'Using the listed brightness adjustment for {acq_id}: {adjustment}')
+    if adjustment is None or brightness.parse_adjustment(adjustment) == 0:
+        print('No brightness adjustment to apply!')
+        return
+
+    frame_paths = brightness.find_frames(frames_dir)
+    print(f'Adjusting the brightness of {len(frame_paths)} frames by {adjustment}...')
+    start_time = time.monotonic()
+    progress_interval = max(1, len(frame_paths) // 10)
+
+    def report_progress(num_processed):
+        if verbose and num_processed % progress_interval == 0:
+            print(f'  Processed {num_processed}/{len(frame_paths)} frames...')
+
+    failures = brightness.adjust_frames(
+        frame_paths, adjustment, jobs=jobs, on_progress=report_progress,
+    )
+    elapsed = time.monotonic() - start_time
+    if failures:
+        for path, error in failures.items():
+            print(f'Couldn\'t adjust {path}: {error}')
+        sys.exit(
+            f'Error: {len(failures)} of {len(frame_paths)} frames couldn\'t be adjusted, so no '
+            'frames were changed',
+        )
+    print(f'Adjusted {len(frame_paths)} frames in {elapsed:.1f} s!')
+
+# scan subcommand
+
+def _positive_int(value):
+    """Parse a whole number which is at least 1, for use as an argparse type."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, not {number}')
+    return number
+
+def setup_scan_parser(parser):
+    """Set up a (sub)parser to scan the brightness of the raw frames of datasets."""
+    parser.add_argument(
+        'archives',
+        type=str,
+        help='Directory of raw dataset archives (e.g. tots-ps-acq-588.tar.gz) to scan',
+    )
+    parser.add_argument(
+        'output',
+        type=str,
+        help='Directory in which to save a JSON file summarizing the brightness of each dataset',
+    )
+    parser.add_argument(
+        '-d', '--datasets',
+        type=argparse.FileType(mode='r'),
+        default=None,
+        help=(
+            'Path of a text file listing the acquisition IDs (one per line) of the datasets to '
+            'scan, instead of all raw dataset archives; use - to read the list from stdin'
+        ),
+    )
+    parser.add_argument(
+        '--every',
+        type=_positive_int,
+        default=1,
+        help='Only decode every n-th frame of each dataset, to scan faster',
+    )
+    parser.add_argument(
+        '--reduce',
+        type=int,
+        choices=[1, 2, 4, 8],
+        default=4,
+        help='Factor by which to downscale frames while decoding them, to scan faster',
+    )
+    parser.add_argument(
+        '--target',
+        type=int,
+        default=statistics.default_target,
+        help=(
+            'Median brightness (from 0 to 255) which suggested brightness adjustments should '
+            'bring datasets towards'
+        ),
+    )
+    parser.add_argument(
+        '--rescan',
+        action='store_true',
+        default=False,
+        help='Scan datasets again even if their archives haven\'t changed since they were scanned',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=batch.parse_jobs,
+        default=0,
+        help='Number of frames to decode in parallel (by default, 0 to use all CPU cores)',
+    )
+    parser.set_defaults(func=lambda args: sys.exit(scan_datasets(
+        args.archives, args.output,
+        acq_ids=None if args.datasets is None else batch.read_dataset_list(args.datasets),
+        every=args.every, reduce=args.reduce, target=args.target, rescan=args.rescan,
+        jobs=args.jobs, verbose=args.verbose,
+    )))
+
+def scan_datasets(
+    archives_root, output_dir, acq_ids=None, every=1, reduce=4, target=statistics.default_target,
+    rescan=False, jobs=0, verbose=False,
+):
+    """Scan the brightness of the frames of raw dataset archives, saving a summary of each.
+
+    Summaries are saved as `{acquisition-id}.json` in the output directory. Datasets whose archives
+    haven't changed (in size or modification time) since their summaries were saved are skipped,
+    unless they should be rescanned. Once all datasets have been scanned, the suggested brightness
+    adjustments of the datasets which would need one are printed in the format of the lists in
+    `project-metadata/brightness-adjustments`.
+
+    Returns 1 if any dataset failed to be scanned, and 0 otherwise.
+    """
+    imaging.require()
+    archives_root = pathlib.Path(archives_root)
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    archive_paths = {}
+    for entry in os.scandir(archives_root):
+        parsed = catalog_store.parse_archive_name(entry.name)
+        if parsed is not None and not parsed[1]:
+            archive_paths[parsed[0]] = pathlib.Path(entry.path)
+    if acq_ids is None:
+        acq_ids = sorted(archive_paths.keys(), key=catalog_store.natural_sort_key)
+
+    histograms = {}
+    failed = []
+    executor = statistics.make_executor(jobs)
+    try:
+        for acq_id in acq_ids:
+            if acq_id not in archive_paths:
+                print(f'[failed] {acq_id}: no raw dataset archive in {archives_root}')
+                failed.append(acq_id)
+                continue
+            try:
+                summary = _scan_dataset(
+                    acq_id, archive_paths[acq_id], output_dir / f'{acq_id}.json', executor,
+                    every=every, reduce=reduce, target=target, rescan=rescan, jobs=jobs,
+                    verbose=verbose,
+                )
+            except Exception as e: # failures should only affect the dataset which failed
+                if verbose:
+                    traceback.print_exc()
+                print(f'[failed] {acq_id}: {type(e).__name__}: {e}')
+                failed.append(acq_id)
+                continue
+            histograms[acq_id] = summary['histogram']
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    print()
+    print(f'Suggested brightness adjustments (for a median brightness of {target}):')
+    for acq_id, histogram in histograms.items():
+        adjustment = statistics.suggest_adjustment(histogram, target=target)
+        if adjustment not in (None, '0%'):
+            print(f'{acq_id} {adjustment}')
+    if failed:
+        print(f'Failed to scan {len(failed)} datasets: {", ".join(failed)}')
+        return 1
+    return 0
+
+def _scan_dataset(
+    acq_id, archive_path, summary_path, executor, every=1, reduce=4,
+    target=statistics.default_target, rescan=False, jobs=0, verbose=False,
+):
+    """Scan a raw dataset archive and save its summary, unless an up-to-date summary exists.
+
+    Returns the summary.
+    """
+    archive_stat = archive_path.stat()
+    archive = {'size': archive_stat.st_size, 'mtime': archive_stat.st_mtime}
+    scan = {'every': every, 'reduce': reduce}
+    if not rescan and summary_path.exists():
+        with open(summary_path, 'r') as summary_file:
+            summary = json.load(summary_file)
+        if summary.get('archive') == archive and summary.get('scan') == scan:
+            if verbose:
+                print(f'[skipped] {acq_id}: already scanned')
+            return summary
+
+    start_time = time.monotonic()
+    with open(archive_path, 'rb') as archive_file:
+        result = statistics.scan_archive(
+            archive_file, executor=executor, every=every, reduce=reduce,
+            max_in_flight=4 * batch.resolve_jobs(jobs),
+        )
+    summary = {
+        'dataset': acq_id,
+        'archive': archive,
+        'scan': scan,
+        'frames': result['frames'],
+        'frames_scanned': result['frames_scanned'],
+        'statistics': result['statistics'],
+        'suggested_adjustment': statistics.suggest_adjustment(result['histogram'], target=target),
+        'target': target,
+        'histogram': result['histogram'],
+        'frame_statistics': result['frame_statistics'],
+    }
+    with files.atomic_output(summary_path, mode='w') as summary_file:
+        json.dump(summary, summary_file)
+    elapsed = time.monotonic() - start_time
+    print(
+        f'[done] {acq_id} ({elapsed:.1f} s): scanned {result["frames_scanned"]} of '
+        f'{result["frames"]} frames; median brightness {result["statistics"]["p50"]}, '
+        f'suggested adjustment {summary["suggested_adjustment"]}',
+    )
+    return summary
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Decoding and encoding of JPEG frames as NumPy arrays
+
+NumPy and Pillow are optional dependencies (the `frames` extra), which are only needed for working
+with the pixels of raw frames; they can be added to an installation of these tools with
+`pipx inject tots-planktoscope-analysis numpy pillow`.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    from PIL import Image
+    from PIL import JpegImagePlugin
+except ImportError:
+    Image = None
+    JpegImagePlugin = None
+
+_supported_modes = ('L', 'RGB')
+
+def available():
+    """Check whether frames can be decoded and encoded, i.e. whether NumPy and Pillow exist."""
+    return np is not None and Image is not None
+
+def require():
+    """Raise an ImportError explaining how to install NumPy and Pillow, if they aren't installed."""
+    if available():
+        return
+    missing = [name for name, module in (('numpy', np), ('pillow', Image)) if module is None]
+    raise ImportError(
+        f'Working with frames requires {" and ".join(missing)}, which can be installed with '
+        f'`pipx inject tots-planktoscope-analysis {" ".join(missing)}` (or by installing these '
+        'tools with the `frames` extra)',
+    )
+
+def read_jpeg(file, reduce=1):
+    """Decode a JPEG frame from a path or file-like object.
+
+    Returns the pixels as an array of 8-bit values (with a third axis for color channels, if the
+    frame isn't grayscale), along with a dict of the frame's encoding parameters (quantization
+    tables, chroma subsampling, and embedded metadata) to pass to write_jpeg, so that the frame can
+    be re-encoded in the same way. If a reduction factor (1, 2, 4, or 8) is provided, the frame is
+    downscaled by that factor while it's decoded, which is much faster than decoding it in full.
+    """
+    require()
+    with Image.open(file) as image:
+        if image.format != 'JPEG':
+            raise ValueError(f'Frame is a {image.format} image, not a JPEG image')
+        if reduce != 1:
+            image.draft(image.mode, (image.width // reduce, image.height // reduce))
+        if image.mode not in _supported_modes:
+            raise ValueError(f'Unsupported color mode for frames: {image.mode}')
+        encoding = {
+            'qtables': image.quantization,
+            'subsampling': JpegImagePlugin.get_sampling(image),
+        }
+        for key in ('exif', 'icc_profile', 'dpi'):
+            if key in image.info:
+                encoding[key] = image.info[key]
+        pixels = np.asarray(image)
+    return pixels, encoding
+
+def read_jpeg_luma(file, reduce=1):
+    """Decode only the brightness (luma) channel of a JPEG frame from a path or file-like object.
+
+    Returns the pixels as a 2-D array of 8-bit values. Decoding skips the color channels entirely,
+    and, as with read_jpeg, a reduction factor (1, 2, 4, or 8) downscales the frame while decoding.
+    """
+    require()
+    with Image.open(file) as image:
+        if image.format != 'JPEG':
+            raise ValueError(f'Frame is a {image.format} image, not a JPEG image')
+        image.draft('L', (image.width // reduce, image.height // reduce))
+        if image.mode != 'L':
+            image = image.convert('L')
+        return np.asarray(image)
+
+def write_jpeg(file, pixels, encoding):
+    """Encode the pixels of a frame as a JPEG image, with encoding parameters from read_jpeg."""
+    require()
+    encoding = {key: value for key, value in encoding.items() if value is not None}
+    if encoding.get('subsampling') == -1:
+        del encoding['subsampling'] # e.g. for grayscale frames, which have no chroma subsampling
+    Image.fromarray(pixels).save(file, format='JPEG', **encoding)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Brightness statistics of the raw frames in dataset archives, for choosing adjustments"""
+
+import concurrent.futures
+import functools
+import io
+import math
+import os
+import tarfile
+
+from ecotaxa import batch
+from . import imaging
+
+default_target = 200 # median brightness (out of 255) which suggested adjustments aim for
+default_step = 5 # percent; suggested adjustments are multiples of this, as in the lists
+default_max_clipped = 0.01 # fraction of pixels which may be saturated by suggested adjustments
+percentiles = (1, 5, 50, 95, 99)
+_frame_suffixes = ('.jpg', '.jpeg')
+
+def frame_histogram(data, reduce=1):
+    """Decode the brightness of a JPEG frame (given as bytes) into a histogram of 256 bins."""
+    pixels = imaging.read_jpeg_luma(io.BytesIO(data), reduce=reduce)
+    return imaging.np.bincount(pixels.ravel(), minlength=256)
+
+def histogram_statistics(histogram):
+    """Compute the mean and the percentiles (see `percentiles`) of brightness from a histogram.
+
+    Returns a dict with the keys 'pixels', 'mean', and `p{percentile}` for each percentile, where
+    each percentile is the lowest brightness at or below which that percentage of pixels lie.
+    """
+    np = imaging.np
+    histogram = np.asarray(histogram, dtype=np.int64)
+    total = int(histogram.sum())
+    statistics = {'pixels': total}
+    if total == 0:
+        statistics['mean'] = None
+        statistics.update({f'p{percentile}': None for percentile in percentiles})
+        return statistics
+    statistics['mean'] = round(float(np.dot(histogram, np.arange(256)) / total), 2)
+    cumulative = np.cumsum(histogram)
+    for percentile in percentiles:
+        threshold = math.ceil(total * percentile / 100)
+        statistics[f'p{percentile}'] = int(np.searchsorted(cumulative, max(threshold, 1)))
+    return statistics
+
+def suggest_adjustment(
+    histogram, target=default_target, step=default_step, max_clipped=default_max_clipped,
+):
+    """Suggest a brightness adjustment (e.g. '5%') for the frames of a dataset from their histogram.
+
+    The suggested adjustment moves the median brightness as close to the target as possible, in
+    multiples of the step (as a percentage of the full brightness range), without brightening the
+    frames so much that more than the maximum fraction of pixels would be saturated.
+    """
+    np = imaging.np
+    histogram = np.asarray(histogram, dtype=np.int64)
+    total = int(histogram.sum())
+    if total == 0:
+        return None
+    cumulative = np.cumsum(histogram)
+    median = int(np.searchsorted(cumulative, math.ceil(total / 2)))
+    # The brightest value which isn't among the brightest max_clipped fraction of pixels
+    unclipped = int(np.searchsorted(cumulative, math.ceil(total * (1 - max_clipped))))
+    headroom = (255 - unclipped) / 255 * 100
+    percentage = step * round((target - median) / 255 * 100 / step)
+    while percentage > 0 and percentage > headroom:
+        percentage -= step
+    return f'{percentage:g}%'
+
+def scan_archive(archive_file, executor=None, every=1, reduce=1, max_in_flight=16):
+    """Compute brightness statistics of the JPEG frames in a dataset archive (a .tar.gz file).
+
+    The archive is read as a stream, without extracting it to disk; if a process pool executor is
+    provided, frames are decoded in its workers while the archive is being read, with no more than
+    the maximum number of frames waiting to be decoded at any time (to bound memory usage). To scan
+    faster, only every n-th frame can be decoded, and frames can be reduced by a factor (1, 2, 4,
+    or 8) while being decoded.
+
+    Returns a dict with the number of frames in the archive and scanned, the histogram and
+    statistics of the brightness of all scanned frames together, and a list of the statistics
+    of each scanned frame (as [name, mean, p5, p50, p95] lists, in the order of the archive).
+    """
+    imaging.require()
+    np = imaging.np
+    decode = functools.partial(frame_histogram, reduce=reduce)
+    names = [] # of the scanned frames, in the order of the archive
+    histograms = {} # index of a scanned frame -> its histogram
+    in_flight = {}
+    num_frames = 0
+
+    def collect(wait_for_all=False):
+        if not in_flight:
+            return
+        finished, _ = concurrent.futures.wait(
+            in_flight.keys(), return_when=(
+                concurrent.futures.ALL_COMPLETED if wait_for_all
+                else concurrent.futures.FIRST_COMPLETED
+            ),
+        )
+        for future in finished:
+            histograms[in_flight.pop(future)] = future.result()
+
+    with tarfile.open(fileobj=archive_file, mode='r|gz') as archive:
+        for member in archive:
+            if not member.isfile() or not member.name.lower().endswith(_frame_suffixes):
+                continue
+            num_frames += 1
+            if (num_frames - 1) % every != 0:
+                continue
+            index = len(names)
+            names.append(member.name)
+            data = archive.extractfile(member).read()
+            if executor is None:
+                histograms[index] = decode(data)
+                continue
+            in_flight[executor.submit(decode, data)] = index
+            if len(in_flight) >= max_in_flight:
+                collect()
+        collect(wait_for_all=True)
+
+    total_histogram = np.zeros(256, dtype=np.int64)
+    frame_statistics = []
+    for index, name in enumerate(names):
+        histogram = histograms[index]
+        total_histogram += histogram
+        statistics = histogram_statistics(histogram)
+        frame_statistics.append([
+            os.path.basename(name), statistics['mean'], statistics['p5'], statistics['p50'],
+            statistics['p95'],
+        ])
+    return {
+        'frames': num_frames,
+        'frames_scanned': len(histograms),
+        'histogram': total_histogram.tolist(),
+        'statistics': histogram_statistics(total_histogram),
+        'frame_statistics': frame_statistics,
+    }
+
+def make_executor(jobs):
+    """Make a process pool executor for decoding frames, or None to decode them in this process."""
+    jobs = batch.resolve_jobs(jobs)
+    if jobs == 1:
+        return None
+    return concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
@@ -4,6 +4,7 @@
 """Command line utility for generating metadata corrections from the ToTS PlanktoScope logsheet."""
 
 import argparse
+import contextlib
 import io
 import json
 import math
@@ -11,7 +12,12 @@ import os
 import pathlib
 import tempfile
 
+from ecotaxa import batch
+from ecotaxa import files
+from ecotaxa import profiling
+from ecotaxa.export_metadata import ecotaxa as export_ecotaxa
 from . import ecotaxa
+from . import store
 from . import tables
 
 def main():
@@ -26,11 +32,25 @@ def main():
         default=False,
         help='Print additional information for troubleshooting',
     )
+    parser.add_argument(
+        '--profile',
+        type=str,
+        default=None,
+        help=(
+            'Path of a file to append JSON lines to, recording the time, I/O, and memory usage of '
+            'each stage of processing each dataset'
+        ),
+    )
     subparsers = parser.add_subparsers()
     setup_single_parser(subparsers.add_parser('single'))
     setup_batch_parser(subparsers.add_parser('batch'))
+    setup_update_parser(subparsers.add_parser('update'))
+    setup_import_parser(subparsers.add_parser('import'))
+    setup_stored_parser(subparsers.add_parser('stored'))
+    setup_history_parser(subparsers.add_parser('history'))
     args = parser.parse_args()
-    args.func(args)
+    with profiling.session(args.profile, tool=parser.prog):
+        args.func(args)
 
 # single subcommand
 
@@ -58,8 +78,11 @@ def setup_single_parser(parser):
     )
     parser.add_argument(
         'output',
-        type=argparse.FileType(mode='w'),
-        help='Path of the EcoTaxa metadata corrections JSON file to create',
+        type=str,
+        help=(
+            'Path of the EcoTaxa metadata corrections JSON file to create (per-object overrides in '
+            'an existing file are kept)'
+        ),
     )
     parser.set_defaults(func=lambda args: generate_single_corrections(
         args.logsheet_src, args.logsheet_adj, args.logsheet_acq,
@@ -67,12 +90,13 @@ def setup_single_parser(parser):
     ))
 
 def generate_single_corrections(
-    logsheet_src_file, logsheet_adj_file, logsheet_acq_file, acq_id, output_file, verbose=False,
+    logsheet_src_file, logsheet_adj_file, logsheet_acq_file, acq_id, output_path, verbose=False,
 ):
     """Generate a metadata corrections file for the specified acquisition, based on the logsheet.
 
     The logsheet should be provided as a dict associating table names to file-like objects of TSV
-    files for their respective tables.
+    files for their respective tables. The corrections file is written as by
+    write_corrections_file.
     """
     logsheet_files = {
         'src': logsheet_src_file,
@@ -92,8 +116,7 @@ def generate_single_corrections(
         print(f'Corrections for {acq_id}:')
         for field, value in corrections.items():
             print(f'  - {field}: {value}')
-        print(f'Writing corrections to {output_file.name}...')
-    json.dump(corrections, output_file, indent=2)
+    write_corrections_file(corrections, output_path, verbose=verbose)
 
 # batch subcommand
 
@@ -109,17 +132,64 @@ def setup_batch_parser(parser):
         type=str,
         help='Directory in which to create EcoTaxa metadata corrections JSON files',
     )
+    parser.add_argument(
+        '-d', '--datasets',
+        type=argparse.FileType(mode='r'),
+        default=None,
+        help=(
+            'Path of a text file listing the acquisition IDs (one per line) of the datasets to '
+            'generate corrections for, instead of all acquisitions in the logsheet; use - to read '
+            'the list from stdin'
+        ),
+    )
     parser.set_defaults(func=lambda args: generate_all_corrections(
-        args.logsheet, args.output, verbose=args.verbose,
+        args.logsheet, args.output,
+        acq_ids=None if args.datasets is None else batch.read_dataset_list(args.datasets),
+        verbose=args.verbose,
     ))
 
-def generate_all_corrections(logsheet_dir, output_dir, verbose=False):
+def generate_all_corrections(logsheet_dir, output_dir, acq_ids=None, verbose=False):
     """Generate a metadata corrections file for each acquisition in the logsheet.
 
     The logsheet should be provided as the path of a directory of TSV files for their respective
     tables in the logsheet. The name of each table should be `{tablename}.tsv`.
+
+    If a list of acquisition IDs is provided, corrections files are only generated for those
+    acquisitions; the logsheet is still only loaded once. Acquisitions which aren't in the logsheet
+    are skipped.
     """
-    # Load logsheet
+    joined_rows, index = load_logsheet_dir(logsheet_dir, verbose=verbose)
+
+    # Generate corrections for each acquisition in the logsheet
+    if acq_ids is None:
+        acq_ids = index.keys()
+    updated_acq_ids = []
+    for acq_id in acq_ids:
+        if acq_id not in index:
+            print(f'Skipping acquisition {acq_id} because it\'s not in the log sheet!')
+            continue
+        if _generate_corrections_file(joined_rows[index[acq_id]], acq_id, output_dir, verbose):
+            updated_acq_ids.append(acq_id)
+    return updated_acq_ids
+
+def load_logsheet_dir(logsheet_dir, verbose=False):
+    """Load the logsheet from a directory of TSV files for its tables, as joined by tables.load."""
+    logsheet_files = _open_logsheet_files(logsheet_dir, verbose=verbose)
+    if verbose:
+        print('Loading log sheet from:')
+        for table_name, file in logsheet_files.items():
+            print(f'  {table_name}: {file.name}')
+    with profiling.stage('load_logsheet') as stage:
+        joined_rows, index = tables.load(logsheet_files, verbose=verbose)
+        if stage:
+            stage.add(
+                bytes_read=sum(profiling.file_size(file) or 0 for file in logsheet_files.values()),
+                objects=len(joined_rows),
+            )
+    return joined_rows, index
+
+def _open_logsheet_files(logsheet_dir, verbose=False):
+    """Open the TSV files for the logsheet's tables in the directory, as a dict by table name."""
     logsheet_files = {}
     for file_path in os.listdir(logsheet_dir):
         parsed_path = pathlib.Path(logsheet_dir).joinpath(file_path)
@@ -129,26 +199,269 @@ def generate_all_corrections(logsheet_dir, output_dir, verbose=False):
             continue
         file = open(parsed_path, 'r') # we rely on CPython to close open files upon completion
         logsheet_files[parsed_path.stem] = file
-    if verbose:
-        print('Loading log sheet from:')
-        for table_name, file in logsheet_files.items():
-            print(f'  {table_name}: {file.name}')
-    joined_rows, index = tables.load(logsheet_files, verbose=verbose)
+    return logsheet_files
 
-    # Generate corrections for each acquisition in the logsheet
-    for acq_id in index.keys():
+def _generate_corrections_file(joined_row, acq_id, output_dir, verbose=False):
+    """Generate the metadata corrections file for an acquisition from its joined logsheet row.
+
+    The corrections file is written as by write_corrections_file. Returns whether the corrections
+    file was written.
+    """
+    with profiling.dataset(acq_id):
         if verbose:
             print(f'Generating corrections for {acq_id}...')
-        corrections = ecotaxa.generate_corrections(joined_rows[index[acq_id]], verbose=verbose)
+        with profiling.stage('generate_corrections') as stage:
+            corrections = ecotaxa.generate_corrections(joined_row, verbose=verbose)
+            stage.add(objects=1)
         if verbose:
             print(f'Corrections for {acq_id}:')
             for field, value in corrections.items():
                 print(f'  - {field}: {value}')
         output_path = pathlib.Path(output_dir).joinpath(acq_id + '.json')
-        with open(output_path, 'w') as output_file:
-            if verbose:
-                print(f'Writing corrections to {output_file.name}...')
-            json.dump(corrections, output_file, indent=2)
+        return write_corrections_file(corrections, output_path, verbose=verbose)
+
+def write_corrections_file(corrections, output_path, verbose=False):
+    """Write the corrections dict to a metadata corrections file.
+
+    The corrections file is only written if it doesn't exist or its contents would change, so that
+    the modification times of unchanged corrections files are preserved. Per-object overrides in an
+    existing corrections file aren't generated from the logsheet, so they're kept as they are (and
+    added to the corrections dict). The corrections file is written atomically, so that an
+    interrupted run never leaves a truncated corrections file. Returns whether the corrections file
+    was written.
+    """
+    try:
+        with open(output_path, 'r') as output_file:
+            existing = output_file.read()
+    except FileNotFoundError:
+        existing = None
+    if existing is not None:
+        try:
+            object_overrides = json.loads(existing).get(export_ecotaxa.object_overrides_key)
+        except (ValueError, AttributeError):
+            object_overrides = None
+        if object_overrides is not None:
+            corrections[export_ecotaxa.object_overrides_key] = object_overrides
+    serialized = json.dumps(corrections, indent=2)
+    if existing == serialized:
+        if verbose:
+            print(f'Corrections in {output_path} are already up-to-date!')
+        return False
+    with (
+        profiling.stage('write_corrections') as stage,
+        files.atomic_output(output_path, mode='w') as output_file,
+    ):
+        if verbose:
+            print(f'Writing corrections to {output_path}...')
+        output_file.write(serialized)
+        stage.add(bytes_written=len(serialized), objects=1)
+    return True
+
+# update subcommand
+
+def setup_update_parser(parser):
+    """Set up a (sub)parser to update corrections based on changes between logsheet snapshots."""
+    parser.add_argument(
+        'old_logsheet',
+        type=str,
+        help='Directory of TSV files of the previous snapshot of the PlanktoScope logsheet tables',
+    )
+    parser.add_argument(
+        'new_logsheet',
+        type=str,
+        help='Directory of TSV files of the new snapshot of the PlanktoScope logsheet tables',
+    )
+    parser.add_argument(
+        'output',
+        type=str,
+        help='Directory of EcoTaxa metadata corrections JSON files to update',
+    )
+    parser.add_argument(
+        '-a', '--affected',
+        type=argparse.FileType(mode='w'),
+        default=None,
+        help=(
+            'Path of a text file in which to list the acquisition IDs (one per line) of the '
+            'datasets whose corrections files were updated; use - to print the list to stdout'
+        ),
+    )
+    parser.set_defaults(func=lambda args: update_corrections(
+        args.old_logsheet, args.new_logsheet, args.output,
+        affected_file=args.affected, verbose=args.verbose,
+    ))
+
+def update_corrections(
+    old_logsheet_dir, new_logsheet_dir, output_dir, affected_file=None, verbose=False,
+):
+    """Update the metadata corrections files for acquisitions which changed between snapshots.
+
+    The snapshots of the logsheet should each be provided as the path of a directory of TSV files,
+    in the same way as for generate_all_corrections. The joined rows of the snapshots are compared
+    by acquisition ID, and corrections are only regenerated for acquisitions which were added or
+    changed in the new snapshot; of those, corrections files are only written if their contents
+    change, so that the modification times of all other corrections files are preserved (and
+    downstream batch processing can skip their datasets).
+
+    The acquisition IDs of the datasets whose corrections files were written are listed in the
+    affected file (if provided), in the dataset list format accepted by the `--datasets` option of
+    the batch subcommands. Returns the list of those acquisition IDs.
+    """
+    old_joined = load_logsheet_dir(old_logsheet_dir, verbose=verbose)
+    new_joined = load_logsheet_dir(new_logsheet_dir, verbose=verbose)
+    if verbose:
+        print('Comparing log sheet snapshots...')
+    differences = tables.diff(old_joined, new_joined)
+    if verbose:
+        print(
+            f'Acquisitions in the new log sheet snapshot: {len(differences["added"])} added, '
+            f'{len(differences["changed"])} changed, {len(differences["removed"])} removed',
+        )
+        for acq_id in differences['removed']:
+            print(f'Keeping corrections for {acq_id}, which was removed from the log sheet...')
+    candidate_acq_ids = set(differences['added']) | set(differences['changed'])
+    joined_rows, index = new_joined
+    updated_acq_ids = []
+    for acq_id in index.keys():
+        if acq_id not in candidate_acq_ids:
+            continue
+        if _generate_corrections_file(joined_rows[index[acq_id]], acq_id, output_dir, verbose):
+            updated_acq_ids.append(acq_id)
+    if verbose:
+        print(f'Updated corrections files for {len(updated_acq_ids)} acquisitions')
+    if affected_file is not None:
+        for acq_id in updated_acq_ids:
+            print(acq_id, file=affected_file)
+        affected_file.flush()
+    return updated_acq_ids
+
+# import subcommand
+
+def setup_import_parser(parser):
+    """Set up a (sub)parser to import a logsheet snapshot into a logsheet database."""
+    parser.add_argument(
+        'database',
+        type=str,
+        help='Path of the SQLite database of logsheet snapshots (created if it doesn\'t exist)',
+    )
+    parser.add_argument(
+        'logsheet',
+        type=str,
+        help='Directory of TSV files of the PlanktoScope logsheet\'s tables to import',
+    )
+    parser.add_argument(
+        '-s', '--snapshot',
+        type=str,
+        default=None,
+        help='Name of the snapshot (by default, the name of the logsheet directory, e.g. its date)',
+    )
+    parser.set_defaults(func=lambda args: import_snapshot(
+        args.database, args.logsheet, snapshot=args.snapshot, verbose=args.verbose,
+    ))
+
+def import_snapshot(database_path, logsheet_dir, snapshot=None, verbose=False):
+    """Import a snapshot of the logsheet into the database of logsheet snapshots.
+
+    The logsheet should be provided as the path of a directory of TSV files, in the same way as for
+    generate_all_corrections. If no snapshot name is provided, the name of the directory is used.
+    """
+    if snapshot is None:
+        snapshot = pathlib.Path(logsheet_dir).resolve().name
+    logsheet_files = _open_logsheet_files(logsheet_dir, verbose=verbose)
+    if verbose:
+        print(f'Importing log sheet snapshot {snapshot} into {database_path}...')
+    with contextlib.closing(store.connect(database_path)) as connection:
+        store.import_snapshot(connection, snapshot, logsheet_files, verbose=verbose)
+
+# stored subcommand
+
+def setup_stored_parser(parser):
+    """Set up a (sub)parser to generate corrections for a dataset from a logsheet database."""
+    parser.add_argument(
+        'database',
+        type=str,
+        help='Path of the SQLite database of logsheet snapshots',
+    )
+    parser.add_argument(
+        'acq_id',
+        type=str,
+        help='tots-ps acquisition ID of the acquisition to generate a metadata correction file for',
+    )
+    parser.add_argument(
+        'output',
+        type=str,
+        help=(
+            'Path of the EcoTaxa metadata corrections JSON file to create (per-object overrides in '
+            'an existing file are kept)'
+        ),
+    )
+    parser.add_argument(
+        '-s', '--snapshot',
+        type=str,
+        default=None,
+        help='Name of the logsheet snapshot to use (by default, the latest snapshot)',
+    )
+    parser.set_defaults(func=lambda args: generate_stored_corrections(
+        args.database, args.acq_id, args.output, snapshot=args.snapshot, verbose=args.verbose,
+    ))
+
+def generate_stored_corrections(database_path, acq_id, output_path, snapshot=None, verbose=False):
+    """Generate a metadata corrections file for the acquisition from the logsheet database.
+
+    Only the acquisition's joined row is queried from the database, so no TSV files are parsed. The
+    corrections file is written as by write_corrections_file.
+    """
+    with contextlib.closing(store.connect(database_path)) as connection:
+        joined_row = store.load_joined_row(connection, acq_id, snapshot=snapshot)
+    if verbose:
+        print(f'Generating corrections for {acq_id}...')
+    corrections = ecotaxa.generate_corrections(joined_row, verbose=verbose)
+    if verbose:
+        print(f'Corrections for {acq_id}:')
+        for field, value in corrections.items():
+            print(f'  - {field}: {value}')
+    write_corrections_file(corrections, output_path, verbose=verbose)
+
+# history subcommand
+
+def setup_history_parser(parser):
+    """Set up a (sub)parser to show how a dataset's logsheet row changed across snapshots."""
+    parser.add_argument(
+        'database',
+        type=str,
+        help='Path of the SQLite database of logsheet snapshots',
+    )
+    parser.add_argument(
+        'acq_id',
+        type=str,
+        help='tots-ps acquisition ID of the acquisition to show the history of',
+    )
+    parser.set_defaults(func=lambda args: print_history(
+        args.database, args.acq_id, verbose=args.verbose,
+    ))
+
+def print_history(database_path, acq_id, verbose=False):
+    """Print the joined logsheet row of the acquisition in each snapshot which has it.
+
+    The full row is printed for the first snapshot; for later snapshots, only changed values are
+    printed.
+    """
+    with contextlib.closing(store.connect(database_path)) as connection:
+        history = store.load_history(connection, acq_id)
+    if not history:
+        print(f'Acquisition {acq_id} isn\'t in any log sheet snapshot!')
+        return
+    previous_row = {}
+    for snapshot, joined_row in history:
+        print(f'{snapshot}:')
+        changed = False
+        for (table, column), value in joined_row.items():
+            if previous_row.get((table, column)) == value and previous_row:
+                continue
+            changed = True
+            print(f'  - {table}.{column}: {value}')
+        if not changed:
+            print('  (no changes)')
+        previous_row = joined_row
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Storage of versioned snapshots of the ToTS PlanktoScope logsheet in a SQLite database."""
+
+import datetime
+import sqlite3
+
+from . import tables
+
+def connect(database_path):
+    """Open the SQLite database of logsheet snapshots, creating its tables if needed."""
+    connection = sqlite3.connect(database_path)
+    with connection:
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY, imported_at TEXT)',
+        )
+        for table_name, column_names in tables._column_names.items():
+            connection.execute(_create_table_statement(table_name, column_names))
+            # This index makes lookups of a row's history across snapshots fast
+            connection.execute(
+                f'CREATE INDEX IF NOT EXISTS {table_name}_id ON {table_name} (id, snapshot)',
+            )
+    return connection
+
+def _create_table_statement(table_name, column_names):
+    """Make the SQL statement to create the table for a logsheet table, with a snapshot column.
+
+    The primary key of the table is the snapshot together with the logsheet table's primary key,
+    and the logsheet's foreign keys refer to rows in the same snapshot.
+    """
+    definitions = ['snapshot TEXT NOT NULL REFERENCES snapshots (name)']
+    definitions.extend(f'"{column}" TEXT' for column in column_names.keys())
+    definitions.append('PRIMARY KEY (snapshot, id)')
+    for (referrer_table, column), referent_table in tables._foreign_keys.items():
+        if referrer_table != table_name:
+            continue
+        definitions.append(
+            f'FOREIGN KEY (snapshot, "{column}") REFERENCES {referent_table} (snapshot, id)',
+        )
+    return f'CREATE TABLE IF NOT EXISTS {table_name} ({", ".join(definitions)})'
+
+def import_snapshot(connection, snapshot, table_files, verbose=False):
+    """Import a snapshot of the logsheet from the TSV files of its tables into the database.
+
+    The files should be provided as for tables.load. Only the columns in the logsheet's column
+    mappings are imported. Any previously-imported snapshot with the same name is replaced.
+    """
+    with connection:
+        connection.execute(
+            'INSERT OR REPLACE INTO snapshots (name, imported_at) VALUES (?, ?)',
+            (snapshot, datetime.datetime.now(datetime.timezone.utc).isoformat()),
+        )
+        for table_name, table_file in table_files.items():
+            if verbose:
+                print(f'Importing table "{table_name}"...')
+            columns = tables._load_columns(table_file, tables._column_names[table_name])
+            # Check for duplicate ids before touching the database
+            tables._index_column(columns['id'])
+            connection.execute(f'DELETE FROM {table_name} WHERE snapshot = ?', (snapshot,))
+            column_list = ', '.join(f'"{column}"' for column in columns.keys())
+            placeholders = ', '.join('?' * (len(columns) + 1))
+            connection.executemany(
+                f'INSERT INTO {table_name} (snapshot, {column_list}) VALUES ({placeholders})',
+                zip([snapshot] * len(columns['id']), *columns.values()),
+            )
+            if verbose:
+                print(f'Imported {len(columns["id"])} rows')
+
+def list_snapshots(connection):
+    """List the names of the snapshots in the database, in order (of their names)."""
+    return [row[0] for row in connection.execute('SELECT name FROM snapshots ORDER BY name')]
+
+def load_joined_row(connection, acq_id, snapshot=None):
+    """Load the joined logsheet row of the specified acquisition in the specified snapshot.
+
+    By default, the latest snapshot (by name) is used. The row is returned as a dict associating
+    (table, column name) pairs to values, in the same way as the rows returned by tables.load.
+    Raises a KeyError if the acquisition isn't in the snapshot, or if a foreign key of the
+    acquisition refers to a row which is missing from the snapshot.
+    """
+    if snapshot is None:
+        snapshots = list_snapshots(connection)
+        if not snapshots:
+            raise KeyError(acq_id)
+        snapshot = snapshots[-1]
+    keys, references, query = _joined_query()
+    result = connection.execute(
+        f'{query} WHERE {tables._primary_table}.snapshot = ? AND {tables._primary_table}.id = ?',
+        (snapshot, acq_id),
+    ).fetchone()
+    if result is None:
+        raise KeyError(acq_id)
+    return _parse_joined_result(keys, references, result)[1]
+
+def load_history(connection, acq_id):
+    """Load the joined logsheet rows of the specified acquisition across all snapshots.
+
+    Returns a list of (snapshot, joined row) pairs in order of snapshots, for the snapshots which
+    have the acquisition. Raises a KeyError if a foreign key of the acquisition refers to a row
+    which is missing from its snapshot.
+    """
+    keys, references, query = _joined_query()
+    results = connection.execute(
+        f'{query} WHERE {tables._primary_table}.id = ? ORDER BY {tables._primary_table}.snapshot',
+        (acq_id,),
+    )
+    return [_parse_joined_result(keys, references, result) for result in results]
+
+def _joined_query():
+    """Make a SQL query to join the logsheet tables, in the same way as tables.load.
+
+    Tables are left-joined, so that rows with foreign keys referring to missing rows are still
+    selected (and can be reported by _parse_joined_result). Returns the (table, column name) pairs
+    of the joined columns, the resolved foreign keys as (table, column name, referent table)
+    triples, and a query which selects the snapshot followed by the joined columns and then, for
+    each resolved foreign key, its value and the id of the row it refers to.
+    """
+    primary_table = tables._primary_table
+    keys = [(primary_table, column) for column in tables._column_names[primary_table].keys()]
+    references = []
+    joins = []
+    remaining = dict(tables._foreign_keys)
+    while len(remaining) > 0:
+        for reference, referent_table in remaining.items():
+            if reference in keys:
+                break
+        else:
+            raise ValueError(f'Couldn\'t resolve remaining foreign keys: {remaining}')
+        del remaining[reference]
+        referrer_table, column = reference
+        references.append((referrer_table, column, referent_table))
+        joins.append(
+            f'LEFT JOIN {referent_table} ON {referent_table}.snapshot = {referrer_table}.snapshot '
+            f'AND {referent_table}.id = {referrer_table}."{column}"',
+        )
+        keys.remove(reference)
+        keys.extend(
+            (referent_table, column) for column in tables._column_names[referent_table].keys()
+        )
+    selected = [f'{table}."{column}"' for table, column in keys]
+    for referrer_table, column, referent_table in references:
+        selected.extend([f'{referrer_table}."{column}"', f'{referent_table}.id'])
+    query = (
+        f'SELECT {primary_table}.snapshot, {", ".join(selected)} '
+        f'FROM {primary_table} {" ".join(joins)}'
+    )
+    return keys, references, query
+
+def _parse_joined_result(keys, references, result):
+    """Make a (snapshot, joined row) pair from a result of the query made by _joined_query.
+
+    Raises a KeyError if any foreign key refers to a row which is missing from the snapshot.
+    """
+    snapshot = result[0]
+    values = result[1:len(keys) + 1]
+    checks = result[len(keys) + 1:]
+    for i, (referrer_table, column, referent_table) in enumerate(references):
+        value, referent_id = checks[2 * i:2 * i + 2]
+        if referent_id is None:
+            acq_id = values[keys.index((tables._primary_table, 'id'))]
+            raise KeyError(
+                f'{referrer_table}.{column} of acquisition {acq_id} refers to {referent_table} row '
+                f'{value!r}, which is missing from snapshot {snapshot}',
+            )
+    return snapshot, dict(zip(keys, values))
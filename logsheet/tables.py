@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import array
+import collections.abc
 import csv
-import operator
 
 """Parsing of the ToTS PlanktoScope logsheet."""
 
@@ -38,12 +39,15 @@ def load(table_files, verbose=False):
 
     The files should be provided as a dict associating table names to file-like objects of TSV files
     for their respective tables.
+
+    Tables are stored column-by-column, and the joined rows are lightweight views into the columns
+    of the tables (see _join_tables).
     """
     tables = {}
     for table_name, table_file in table_files.items():
         if verbose:
             print(f'Loading table "{table_name}"...')
-        tables[table_name] = _extract_columns(_load_table(table_file), _column_names[table_name])
+        tables[table_name] = _load_columns(table_file, _column_names[table_name])
     if verbose:
         print('Joining tables...')
     return _join_tables(tables, _foreign_keys, _primary_table, verbose=verbose)
@@ -54,25 +58,38 @@ _tsv_format = {
     'quoting': csv.QUOTE_MINIMAL,
 }
 
-def _load_table(tsv_file):
-    """Load the specified file-like object containing a TSV table as a list of dicts."""
-    reader = csv.DictReader(tsv_file, **_tsv_format)
-    rows = [row for row in reader]
-    return rows
+def _load_columns(tsv_file, column_names):
+    """Load and rename the specified columns from the file-like object containing a TSV table.
 
-def _extract_columns(table_rows, column_names):
-    """Extracts and renames the specified columns from the table.
+    The column names should be specified as a dict associating desired column names as keys for the
+    original table's column names as values. Only the specified columns are loaded.
 
-    The table should be provided as a list of dicts. The column names should be specified as a dict
-    associating desired column names as keys for the original table's column names as values.
+    Returns a dict associating the desired column names with lists of the values in the columns.
+    Missing values at the ends of rows are loaded as None, and blank rows are ignored.
     """
-    extracted_rows = []
-    for row in table_rows:
-        extracted_row = {}
-        for new_name, old_name in column_names.items():
-            extracted_row[new_name] = row[old_name]
-        extracted_rows.append(extracted_row)
-    return extracted_rows
+    reader = csv.reader(tsv_file, **_tsv_format)
+    header = next(reader, [])
+    positions = {}
+    for new_name, old_name in column_names.items():
+        try:
+            positions[new_name] = header.index(old_name)
+        except ValueError as e:
+            raise KeyError(old_name) from e
+    columns = {new_name: [] for new_name in column_names}
+    appenders = [
+        # Repeated values within a column are stored only once, since many values repeat
+        (columns[new_name].append, {}.setdefault, position)
+        for new_name, position in positions.items()
+    ]
+    for row in reader:
+        if not row:
+            continue
+        if len(row) < len(header):
+            row.extend([None] * (len(header) - len(row)))
+        for append, deduplicate, position in appenders:
+            value = row[position]
+            append(deduplicate(value, value))
+    return columns
 
 _foreign_keys = {
     ('acq', 'adj_id'): 'adj',
@@ -83,38 +100,37 @@ _primary_table = 'acq'
 def _join_tables(tables, foreign_keys, primary_table, verbose=False):
     """Joins the provided tables into a single table, starting with the specified primary table/id.
 
-    Tables should be provided as a dict associating table names to lists of table rows (each being
-    an object associating column names to values).
+    Tables should be provided as a dict associating table names to dicts associating column names
+    to lists of column values.
     Columns are joined by foreign keys, which should be specified as a dict associating
     (table, column name) pairs of foreign key columns to table names. Each table's primary id column
     is assumed to be named 'id'.
     The primary table should be specified by its table name.
 
-    Returns a list of table rows (each being an object associating (table, column name) pairs to
-    values), and an index dict associating the primary key values in the (primary_table, 'id')
-    column with array indices in the list of table rows.
+    Rather than copying values into each joined row, each foreign key is resolved into an array of
+    the indices of the referenced rows (in the referenced table) for all joined rows at once.
+
+    Returns a sequence of table rows (each being a read-only mapping associating
+    (table, column name) pairs to values), and an index dict associating the primary key values in
+    the (primary_table, 'id') column with array indices in the sequence of table rows.
     """
     if verbose:
         print('Indexing tables...')
     indices = {}
-    for table_name, rows in tables.items():
+    for table_name, columns in tables.items():
         if table_name == primary_table:
             continue
-        indices[table_name] = _index_table(rows, id_column='id')
+        indices[table_name] = _index_column(columns['id'])
 
     if verbose:
         print(f'Joining starting with table "{primary_table}"...')
-    root = tables[primary_table]
-    joined_rows = []
-    for row in tables[primary_table]:
-        joined_row = {}
-        _copy_join_columns(joined_row, primary_table, row)
-        joined_rows.append(joined_row)
-
-    remaining = dict(_foreign_keys)
+    row_indices = {primary_table: array.array('q', range(len(tables[primary_table]['id'])))}
+    keys = [(primary_table, column) for column in tables[primary_table].keys()]
+
+    remaining = dict(foreign_keys)
     while len(remaining) > 0:
         for reference, referent_table in remaining.items():
-            if reference not in joined_rows[0]:
+            if reference not in keys:
                 # The foreign key hasn't yet been added to the joined table,
                 # so we'll skip it for now and try again later
                 continue
@@ -127,32 +143,98 @@ def _join_tables(tables, foreign_keys, primary_table, verbose=False):
         del remaining[reference]
         if verbose:
             print(f'Resolving foreign key {reference} => ({referent_table}, \'id\')...')
+        referrer_table, column = reference
+        references = tables[referrer_table][column]
         index = indices[referent_table]
-        for joined_row in joined_rows:
-            resolved_row = tables[referent_table][index[joined_row[reference]]]
-            del joined_row[reference]
-            _copy_join_columns(joined_row, referent_table, resolved_row)
+        row_indices[referent_table] = array.array(
+            'q', (index[references[i]] for i in row_indices[referrer_table]),
+        )
+        keys.remove(reference)
+        keys.extend((referent_table, column) for column in tables[referent_table].keys())
 
-    return joined_rows, _index_table(joined_rows, id_column=(primary_table, 'id'))
+    joined_rows = _JoinedRows(tables, row_indices, keys)
+    return joined_rows, _index_column(tables[primary_table]['id'])
 
-def _index_table(rows, id_column='id'):
-    """Build an index of a table's rows by its id column.
+def _index_column(values):
+    """Build an index of a table's rows by the values in its id column.
 
     Returns a dict associating table IDs with row indices.
-
-    The table is provided as a list of dicts, each of which should have an 'id' key.
     """
     index = {}
-    for i, row in enumerate(rows):
-        if row[id_column] in index:
-            raise KeyError(f'Duplicate id {row[id_column]} found!')
-        index[row[id_column]] = i
+    for i, value in enumerate(values):
+        if value in index:
+            raise KeyError(f'Duplicate id {value} found!')
+        index[value] = i
     return index
 
-def _copy_join_columns(joined_row, source_table_name, source_row):
-    """Adds the columns from the specified source table's specified row to the joined row.
+class _JoinedRows(collections.abc.Sequence):
+    """The rows of a joined table, as views into the columns of the tables which were joined."""
+
+    def __init__(self, tables, row_indices, keys):
+        self._tables = tables
+        self._row_indices = row_indices
+        self._keys = tuple(keys)
+        self._key_set = frozenset(keys)
+        self._length = len(next(iter(row_indices.values()))) if row_indices else 0
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [_JoinedRow(self, j) for j in range(*i.indices(self._length))]
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError('joined row index out of range')
+        return _JoinedRow(self, i)
+
+    def value(self, i, key):
+        """Get the value of the (table, column name) pair in the specified row."""
+        if key not in self._key_set:
+            raise KeyError(key)
+        table, column = key
+        return self._tables[table][column][self._row_indices[table][i]]
+
+class _JoinedRow(collections.abc.Mapping):
+    """A read-only mapping of (table, column name) pairs to values of a row of a joined table."""
+
+    __slots__ = ('_rows', '_i')
+
+    def __init__(self, rows, i):
+        self._rows = rows
+        self._i = i
+
+    def __getitem__(self, key):
+        return self._rows.value(self._i, key)
+
+    def __iter__(self):
+        return iter(self._rows._keys)
+
+    def __len__(self):
+        return len(self._rows._keys)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({dict(self)!r})'
+
+def diff(old_joined, new_joined):
+    """Compare the joined rows of two versions of the logsheet by primary key.
+
+    Each version should be provided as a (joined rows, index) pair, as returned by load.
 
-    Column names are (source_table_name, column) pairs.
+    Returns a dict with lists of the primary keys which were 'added' to the new version, 'removed'
+    from the new version, and 'changed' (i.e. which have different values in any column) between
+    the versions, each in the order of the rows of the version with the key.
     """
-    for column, value in source_row.items():
-        joined_row[(source_table_name, column)] = value
+    old_rows, old_index = old_joined
+    new_rows, new_index = new_joined
+    differences = {'added': [], 'removed': [], 'changed': []}
+    for key, i in new_index.items():
+        if key not in old_index:
+            differences['added'].append(key)
+        elif new_rows[i] != old_rows[old_index[key]]:
+            differences['changed'].append(key)
+    for key in old_index.keys():
+        if key not in new_index:
+            differences['removed'].append(key)
+    return differences
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Command line utility for refreshing the EcoTaxa export archives of all ToTS datasets at once"""
+
+import argparse
+import contextlib
+import os
+import pathlib
+import time
+
+from ecotaxa import batch
+from ecotaxa import files
+from ecotaxa import profiling
+from ecotaxa.export_metadata import ecotaxa as export_ecotaxa
+from ecotaxa.split_archives import cli as split_cli
+from logsheet import cli as logsheet_cli
+from logsheet import ecotaxa as logsheet_ecotaxa
+
+def main():
+    """Refresh the EcoTaxa export archives of the datasets from the specified logsheet."""
+    parser = argparse.ArgumentParser(
+        prog='tots-pipeline',
+        description=(
+            'Generate metadata corrections from the ToTS PlanktoScope logsheet, apply them to '
+            'EcoTaxa export archives, and split the archives for upload, in a single pass'
+        ),
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        default=False,
+        help='Print additional information for troubleshooting',
+    )
+    parser.add_argument(
+        '--profile',
+        type=str,
+        default=None,
+        help=(
+            'Path of a file to append JSON lines to, recording the time, I/O, and memory usage of '
+            'each stage of processing each dataset'
+        ),
+    )
+    parser.add_argument(
+        'logsheet',
+        type=str,
+        help='Directory of TSV files of the PlanktoScope logsheet\'s tables to load',
+    )
+    parser.add_argument(
+        'input',
+        type=str,
+        help='Directory of results archives, ending in `-results.tar.gz`',
+    )
+    parser.add_argument(
+        'output',
+        type=str,
+        help='Directory in which to create the EcoTaxa export archives with corrected metadata',
+    )
+    parser.add_argument(
+        '--max-bytes',
+        type=files.parse_size,
+        default=None,
+        help=(
+            'Maximum size (e.g. 500MB) of each EcoTaxa export archive; datasets whose corrected '
+            'EcoTaxa export archive would be larger are split into as few chunks as possible '
+            'within this size'
+        ),
+    )
+    parser.add_argument(
+        '--corrections',
+        type=str,
+        default=None,
+        help=(
+            'Directory in which to save the EcoTaxa metadata corrections JSON files; per-object '
+            'overrides in existing corrections files are also applied'
+        ),
+    )
+    parser.add_argument(
+        '--changes',
+        type=str,
+        default=None,
+        help='Directory in which to create JSON files listing the metadata changes made',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=batch.parse_jobs,
+        default=1,
+        help='Number of results archives to process in parallel (0 to use all CPU cores)',
+    )
+    parser.add_argument(
+        '--memory-cap',
+        type=files.parse_size,
+        default=files.default_memory_cap,
+        help=(
+            'Maximum size (e.g. 256M) of intermediate files to keep in memory before spilling them '
+            'to disk; 0 keeps them on disk'
+        ),
+    )
+    parser.add_argument(
+        '-d', '--datasets',
+        type=argparse.FileType(mode='r'),
+        default=None,
+        help=(
+            'Path of a text file listing the acquisition IDs (one per line) of the datasets to '
+            'process, instead of all datasets with results archives; use - to read the list from '
+            'stdin'
+        ),
+    )
+    args = parser.parse_args()
+    with profiling.session(args.profile, tool=parser.prog):
+        run_pipeline(
+            args.logsheet, args.input, args.output,
+            corrections_dir=args.corrections, changes_dir=args.changes, max_bytes=args.max_bytes,
+            jobs=args.jobs, memory_cap=args.memory_cap,
+            acq_ids=None if args.datasets is None else batch.read_dataset_list(args.datasets),
+            verbose=args.verbose,
+        )
+
+def run_pipeline(
+    logsheet_dir, results_dir, ecotaxa_export_dir,
+    corrections_dir=None, changes_dir=None, max_bytes=None, jobs=1,
+    memory_cap=files.default_memory_cap, acq_ids=None, verbose=False,
+):
+    """Make EcoTaxa export archives with metadata corrected according to the logsheet.
+
+    This produces the same EcoTaxa export archives as running `logsheet-corrections-generate
+    batch`, `ecotaxa-metadata-edit batch`, and `ecotaxa-split-archives` one after another, but
+    without writing and re-reading any intermediate files: the logsheet is loaded once and kept in
+    memory, the corrections generated from it are passed directly to the processing of each
+    results archive, and each corrected metadata file is split (if needed) while the images are
+    copied straight from the results archive.
+
+    The logsheet should be provided as the path of a directory of TSV files, in the same way as for
+    `logsheet-corrections-generate batch`. The results archives should be provided as the path of a
+    directory of archives named as `{acquisition-id}-results.tar.gz`; by default, every dataset
+    with a results archive is processed, but a list of acquisition IDs can instead be provided.
+
+    If a maximum size is specified, each dataset whose corrected EcoTaxa export archive would be
+    larger than the maximum size is split into as few chunks as possible within the maximum size,
+    named as `{acquisition-id}-export-chunk{number}.zip`; all other EcoTaxa export archives are
+    named as `{acquisition-id}-export.zip`. Outputs left over from previous runs which split a
+    dataset differently are deleted.
+
+    Corrections files are only written to the corrections directory (in the same way as for
+    `logsheet-corrections-generate batch`) if one is provided; then any per-object overrides in
+    existing corrections files are also applied. Likewise, changes files are only written to the
+    changes directory if one is provided.
+
+    Up to the specified number of jobs will process results archives in parallel, as for
+    `ecotaxa-metadata-edit batch`.
+    """
+    joined_rows, index = logsheet_cli.load_logsheet_dir(logsheet_dir, verbose=verbose)
+    if acq_ids is None:
+        acq_ids = _find_results_archives(results_dir, verbose=verbose)
+    tasks = []
+    for acq_id in acq_ids:
+        if acq_id not in index:
+            print(f'Skipping dataset {acq_id} because it\'s not in the log sheet!')
+            continue
+        corrections = logsheet_ecotaxa.generate_corrections(
+            joined_rows[index[acq_id]], verbose=verbose,
+        )
+        if corrections_dir is not None:
+            corrections_path = pathlib.Path(corrections_dir).joinpath(acq_id + '.json')
+            logsheet_cli.write_corrections_file(corrections, corrections_path, verbose=verbose)
+            overrides_path = export_ecotaxa.object_overrides_path(
+                corrections, base_dir=corrections_dir,
+            )
+            if overrides_path is not None:
+                corrections[export_ecotaxa.object_overrides_key] = overrides_path
+        tasks.append((acq_id, _process_dataset, (
+            corrections,
+            pathlib.Path(results_dir).joinpath(acq_id + '-results.tar.gz'),
+            ecotaxa_export_dir,
+            None if changes_dir is None else pathlib.Path(changes_dir).joinpath(acq_id + '.json'),
+        ), {
+            'max_bytes': max_bytes,
+            'memory_cap': memory_cap,
+            'verbose': verbose,
+        }))
+
+    start_time = time.perf_counter()
+    task_results = batch.run_tasks(tasks, jobs=jobs)
+    batch.print_summary(task_results, wall_time=time.perf_counter() - start_time)
+
+def _find_results_archives(results_dir, verbose=False):
+    """List the acquisition IDs of the results archives in the directory."""
+    acq_ids = []
+    for results_path in sorted(os.listdir(results_dir)):
+        if not results_path.endswith('-results.tar.gz'):
+            if verbose:
+                print(f'Skipping file {results_path} because it\'s not a results archive!')
+            continue
+        acq_ids.append(results_path.removesuffix('-results.tar.gz'))
+    return acq_ids
+
+def _process_dataset(
+    corrections, results_path, ecotaxa_export_dir, changes_path,
+    max_bytes=None, memory_cap=files.default_memory_cap, verbose=False,
+):
+    """Process the results archive of a single dataset in the pipeline.
+
+    Returns a (status, message) pair for batch.run_tasks.
+    """
+    try:
+        with contextlib.ExitStack() as stack:
+            changes_file = None
+            if changes_path is not None:
+                changes_file = stack.enter_context(files.atomic_output(changes_path, mode='w'))
+            output_paths = split_cli.process_single_results_archive(
+                results_path, corrections, 0 if max_bytes is not None else 1,
+                ecotaxa_export_dir, changes_file,
+                max_bytes=max_bytes, memory_cap=memory_cap, keep_unsplit=True, verbose=verbose,
+            )
+    except OSError as e:
+        return ('skipped', f'unopenable file (e.g. missing results archive): {e}')
+    if len(output_paths) > 1:
+        return ('done', f'split into {len(output_paths)} chunks')
+    return ('done', '')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Round-trip tests of reading and copying members of EcoTaxa export archives at the byte level"""
+
+import io
+import random
+import zipfile
+
+import pytest
+
+from ecotaxa import archive
+
+class _UnseekableWriter(io.RawIOBase):
+    """A write-only stream, so that zipfile writes data descriptors after the data of members."""
+
+    def __init__(self):
+        super().__init__()
+        self.output = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.output.write(data)
+
+class _SequentialStream:
+    """A stream which can only be read sequentially, like a member extracted from a tar stream."""
+
+    def __init__(self, data):
+        self._file = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+def _make_members(seed=0):
+    """Make the contents of images and of a metadata file, in archive order."""
+    rng = random.Random(seed)
+    members = {}
+    for i, size in enumerate([0, 1, 70_000, 3_000, 200_000]):
+        members[f'object-{i}.jpg'] = rng.randbytes(size)
+    rows = [
+        'img_file_name\tobject_id\tobject_lat\tsample_id',
+        '[t]\t[t]\t[f]\t[t]',
+        *(f'object-{i}.jpg\tobject-{i}\t71.3947\ttots-ps-sample-1' for i in range(5000)),
+        'ümlaut.jpg\tümlaut\t-90.0000\ttots-ps-sample-2',
+    ]
+    members['ecotaxa_export.tsv'] = ('\n'.join(rows) + '\n').encode('utf-8')
+    members['zz-after.txt'] = b'after the metadata file\n' * 1000
+    return members
+
+def _write_zip(members, compress_type, streamed):
+    """Write the members to a zip archive, with data descriptors if it's written as a stream."""
+    output_file = _UnseekableWriter() if streamed else io.BytesIO()
+    with zipfile.ZipFile(output_file, mode='w', compression=compress_type) as output_zip:
+        for name, contents in members.items():
+            output_zip.writestr(name, contents)
+    data = output_file.output.getvalue() if streamed else output_file.getvalue()
+    with zipfile.ZipFile(io.BytesIO(data)) as input_zip:
+        has_descriptors = any(
+            zipinfo.flag_bits & archive._data_descriptor_flag for zipinfo in input_zip.infolist()
+        )
+    assert has_descriptors == streamed
+    return data
+
+_layouts = [
+    pytest.param(compress_type, streamed, id=f'{name}-{"streamed" if streamed else "seekable"}')
+    for name, compress_type in [('stored', zipfile.ZIP_STORED), ('deflated', zipfile.ZIP_DEFLATED)]
+    for streamed in [False, True]
+]
+
+@pytest.mark.parametrize('compress_type,streamed', _layouts)
+def test_streamed_metadata_file_matches_zipfile(compress_type, streamed):
+    data = _write_zip(_make_members(), compress_type, streamed)
+    with (
+        zipfile.ZipFile(io.BytesIO(data)) as input_zip,
+        archive.open_metadata_file(input_zip) as metadata_file,
+    ):
+        expected = metadata_file.read()
+    with archive.open_streamed_metadata_file(_SequentialStream(data)) as metadata_file:
+        assert metadata_file.read() == expected
+
+@pytest.mark.parametrize('compress_type,streamed', _layouts)
+def test_streamed_metadata_file_is_required(compress_type, streamed):
+    members = _make_members()
+    del members['ecotaxa_export.tsv']
+    data = _write_zip(members, compress_type, streamed)
+    with pytest.raises(KeyError):
+        archive.open_streamed_metadata_file(_SequentialStream(data))
+
+@pytest.mark.parametrize('compress_type,streamed', _layouts)
+def test_copied_members_match_zipfile(compress_type, streamed):
+    members = _make_members()
+    data = _write_zip(members, compress_type, streamed)
+    output_file = io.BytesIO()
+    with (
+        zipfile.ZipFile(io.BytesIO(data)) as input_zip,
+        zipfile.ZipFile(output_file, mode='w') as output_zip,
+    ):
+        for zipinfo in input_zip.infolist():
+            start = output_file.tell()
+            archive.copy_member(input_zip, zipinfo, output_zip)
+            assert output_file.tell() - start <= archive.copied_member_size(zipinfo)
+    output_file.seek(0)
+    with zipfile.ZipFile(output_file) as copied_zip:
+        assert copied_zip.testzip() is None
+        assert {name: copied_zip.read(name) for name in copied_zip.namelist()} == members
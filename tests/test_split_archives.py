@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Tests that EcoTaxa export archives are split into chunks within the maximum chunk size"""
+
+import csv
+import io
+import random
+import zipfile
+
+import pytest
+
+from ecotaxa import archive
+from ecotaxa import metadata
+from ecotaxa.split_archives import ecotaxa
+
+_num_objects = 60
+
+def _make_export_archive(seed=0, max_image_size=30_000, comment_size=0):
+    """Make an EcoTaxa export archive with incompressible images of various sizes.
+
+    Each row of the metadata file can also get an incompressible comment of up to the comment size,
+    so that the metadata file takes up most of each chunk.
+    """
+    rng = random.Random(seed)
+    field_names = ['img_file_name', 'object_id', 'object_lat', 'sample_comment']
+    rows = [field_names, ['[t]', '[t]', '[f]', '[t]']]
+    input_file = io.BytesIO()
+    with zipfile.ZipFile(input_file, mode='w', compression=zipfile.ZIP_DEFLATED) as input_zip:
+        for i in range(_num_objects):
+            image_name = f'tots-ps-acq-1_{i}.jpg'
+            input_zip.writestr(image_name, rng.randbytes(rng.randint(0, max_image_size)))
+            # Some rows are missing their trailing values, and some values need quoting
+            comment = rng.randbytes(rng.randint(0, comment_size)).hex()
+            rows.append(
+                [image_name, f'object-{i}', '71.3947', f'a "quoted"\t{comment}'][:2 + i % 3],
+            )
+        metadata_file = io.StringIO(newline='')
+        writer = csv.writer(
+            metadata_file, dialect='unix', delimiter='\t', quoting=csv.QUOTE_MINIMAL,
+        )
+        writer.writerows(rows)
+        input_zip.writestr('ecotaxa_export.tsv', metadata_file.getvalue())
+    return input_file
+
+def _read_chunk(output_file):
+    """Read the data rows of a chunk and the names of its images, checking its consistency."""
+    output_file.seek(0)
+    with zipfile.ZipFile(output_file) as output_zip:
+        assert output_zip.testzip() is None
+        with archive.open_metadata_file(output_zip) as metadata_file:
+            field_names, _, data_rows = metadata.read_rows(metadata_file)
+            data_rows = list(data_rows)
+        image_names = sorted(set(output_zip.namelist()) - {'ecotaxa_export.tsv'})
+    image_column = field_names.index('img_file_name')
+    assert sorted(row[image_column] for row in data_rows) == image_names
+    assert all(len(row) == len(field_names) for row in data_rows)
+    return data_rows
+
+_contents = {
+    'images': {},
+    'metadata': {'max_image_size': 100, 'comment_size': 10_000},
+}
+
+@pytest.mark.parametrize('contents', _contents.keys())
+@pytest.mark.parametrize('max_bytes', [40_000, 100_000, 300_000, 10_000_000])
+@pytest.mark.parametrize('min_chunks', [0, 1, 7])
+def test_chunks_fit_within_max_bytes(contents, max_bytes, min_chunks):
+    input_file = _make_export_archive(**_contents[contents])
+    chunks = ecotaxa.plan_chunks(input_file, max_bytes, min_chunks=min_chunks)
+    assert len(chunks) >= max(min_chunks, 1)
+    output_files = [io.BytesIO() for _ in chunks]
+    num_objects = ecotaxa.split_archive(input_file, output_files, chunks=chunks)
+    assert num_objects == [len(row_indices) for row_indices in chunks]
+    object_ids = []
+    for output_file in output_files:
+        assert len(output_file.getvalue()) <= max_bytes
+        object_ids.extend(row[1] for row in _read_chunk(output_file))
+    assert sorted(object_ids) == sorted(f'object-{i}' for i in range(_num_objects))
+
+def test_chunks_fill_max_bytes():
+    input_file = _make_export_archive()
+    total_size = len(input_file.getvalue())
+    chunks = ecotaxa.plan_chunks(input_file, total_size // 3, min_chunks=0)
+    # First-fit decreasing packing shouldn't need many more chunks than the size requires
+    assert 3 <= len(chunks) <= 5
+
+def test_object_too_large_for_a_chunk():
+    input_file = _make_export_archive()
+    with pytest.raises(ValueError):
+        ecotaxa.plan_chunks(input_file, 20_000, min_chunks=0)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Round-trip tests of reading members of gzip-compressed tar archives through their indexes"""
+
+import gzip
+import io
+import random
+import tarfile
+
+import pytest
+
+from ecotaxa import pgzip
+from ecotaxa import tarindex
+from ecotaxa.pack_results import results as pack_results
+
+pytestmark = pytest.mark.skipif(not tarindex.available(), reason='zlib can\'t be loaded via ctypes')
+
+_span = 16 * 1024 # bytes; small, so that members are spread over many checkpoints
+
+def _make_members(seed=0):
+    """Make the contents of members of various sizes, some compressible and some not."""
+    rng = random.Random(seed)
+    members = {}
+    for i, size in enumerate([0, 1, 511, 512, 513, 40_000, 200_000, 3_000, 120_000]):
+        if i % 2:
+            contents = rng.randbytes(size)
+        else:
+            contents = (b'tots-ps-acq-1\t71.3947\t-158.4567\n' * (size // 32 + 1))[:size]
+        members[f'export/member-{i}.bin'] = contents
+    return members
+
+def _write_tar(tar_file, members):
+    """Write the members to a tar archive opened for writing as a stream."""
+    with tarfile.open(fileobj=tar_file, mode='w|', format=tarfile.GNU_FORMAT) as archive_tar:
+        for name, contents in members.items():
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(contents)
+            archive_tar.addfile(tarinfo, io.BytesIO(contents))
+
+def _check_members(archive_file, index, members):
+    """Check that every member read through the index matches what tarfile reads."""
+    archive_file.seek(0)
+    with tarfile.open(fileobj=archive_file, mode='r:gz') as archive_tar:
+        expected = {
+            tarinfo.name: archive_tar.extractfile(tarinfo).read()
+            for tarinfo in archive_tar if tarinfo.isreg()
+        }
+    assert expected == members
+    assert tarindex.member_names(index) == list(members.keys())
+    for name, contents in expected.items():
+        with tarindex.open_member(archive_file, index, name) as member_file:
+            assert member_file.read() == contents
+            # Seeking backwards within the member restarts decompression from a checkpoint
+            member_file.seek(len(contents) // 2)
+            assert member_file.read(1000) == contents[len(contents) // 2:][:1000]
+
+def test_indexed_members_match_tarfile():
+    members = _make_members()
+    archive_file = io.BytesIO()
+    with gzip.GzipFile(fileobj=archive_file, mode='wb', mtime=0) as gzip_file:
+        _write_tar(gzip_file, members)
+    index = tarindex.index_archive(archive_file, span=_span)
+    assert len(index['checkpoints']) > 1
+    _check_members(archive_file, index, members)
+
+def test_parallel_gzip_round_trip():
+    data = _make_members(seed=1)
+    contents = b''.join(data.values())
+    archive_file = io.BytesIO()
+    with pgzip.ParallelGzipWriter(archive_file, threads=3, block_size=10_000) as writer:
+        # Writes which aren't aligned with blocks are split and joined across blocks
+        for i in range(0, len(contents), 7_777):
+            writer.write(contents[i:i + 7_777])
+    assert gzip.decompress(archive_file.getvalue()) == contents
+    assert writer.uncompressed_size == len(contents)
+    assert writer.compressed_size == len(archive_file.getvalue())
+
+def test_packed_archive_index_matches_tarfile(tmp_path):
+    members = _make_members(seed=2)
+    # The writer only records checkpoints between its blocks, so this spans several blocks
+    members['objects/large.jpg'] = random.Random(3).randbytes(3 * pgzip.default_block_size)
+    processing_dir = tmp_path / 'processing'
+    for name, contents in members.items():
+        (processing_dir / name).parent.mkdir(parents=True, exist_ok=True)
+        (processing_dir / name).write_bytes(contents)
+    output_path = tmp_path / 'tots-ps-acq-1-results.tar.gz'
+    index = pack_results.pack_results_archive(processing_dir, output_path, threads=2, span=_span)
+    assert index['objects'] == 1
+    assert len(index['checkpoints']) > 1
+    # Windows of checkpoints in the saved index are only decoded when they're first needed
+    loaded_index = tarindex.load_index(output_path)
+    assert loaded_index['members'] == index['members']
+    with open(output_path, 'rb') as archive_file:
+        # The index is built from the writer's checkpoints, without reading the archive back
+        _check_members(archive_file, index, members)
+        _check_members(archive_file, loaded_index, members)
+        # An index built by reading the archive must work just as well
+        _check_members(archive_file, tarindex.index_archive(archive_file, span=_span), members)